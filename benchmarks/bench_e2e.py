@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# End-to-end time of the command line of tax_myPHAGE, without the time of the tools
+# mash, blastdbcmd, makeblastdb and blastn are replaced on the PATH by the stand-ins
+# of stub_tools.py, which log when they run, and the time during which at least one
+# of them was running is taken out of the wall time of each run
+# The start of the interpreter of the stand-ins, a few milliseconds per run of a
+# tool, is not logged and counted with tax_myPHAGE
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from statistics import median
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from stub_tools import TOOLS, read_fasta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(BENCHMARKS_DIR, "..", "tax_myPHAGE.py")
+DEFAULT_INPUTS = [
+    os.path.join(BENCHMARKS_DIR, "..", "test.fna"),
+    os.path.join(BENCHMARKS_DIR, "..", "UP30.fsa"),
+]
+
+
+def install_stubs(bin_dir):
+    """Write a script running the stand-in of each tool in a folder to put first
+    on the PATH.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(BENCHMARKS_DIR, "stub_tools.py")
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(
+                f'#!/bin/sh\nTAXMYPHAGE_STUB_TOOL={tool} exec "{sys.executable}" -S "{stub}" "$@"\n'
+            )
+        os.chmod(path, 0o755)
+
+
+def write_batch(inputs, num_genomes, path):
+    """Write a batch of genomes taken in turn from the input files, renamed when
+    they are repeated.
+    Returns:
+        int: Number of genomes of the batch
+    """
+    records = [record for input_path in inputs for record in read_fasta(input_path)]
+    num_genomes = num_genomes or len(records)
+    with open(path, "w") as f:
+        for i in range(num_genomes):
+            name, seq = records[i % len(records)]
+            copy = i // len(records)
+            f.write(f">{name}{f'_copy{copy}' if copy else ''}\n{seq}\n")
+
+    return num_genomes
+
+
+def tool_time(log_path):
+    """Time during which at least one tool was running, and the number of runs
+    of each tool, from the log of the stand-ins.
+    """
+    intervals, runs = [], {}
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                tool, start, end = line.split("\t")
+                intervals.append((float(start), float(end)))
+                runs[tool] = runs.get(tool, 0) + 1
+
+    total, current_end = 0.0, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            total += end - start
+            current_end = end
+        elif end > current_end:
+            total += end - current_end
+            current_end = end
+
+    return total, runs
+
+
+def run_cli(cmd, env, log_path):
+    """Wall time of a run of the command line and the time of its tools."""
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+    start = time.time()
+    process = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.time() - start
+    if process.returncode:
+        sys.exit(f"{' '.join(cmd)} failed:\n{process.stderr[-2000:]}")
+
+    return (wall, *tool_time(log_path))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the command line of tax_myPHAGE with stand-ins of the tools."
+        " Arguments after -- are given to tax_myPHAGE"
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="inputs",
+        nargs="+",
+        default=DEFAULT_INPUTS,
+        help="FASTA files of the genomes to classify (default: test.fna UP30.fsa)",
+    )
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        type=int,
+        default=0,
+        help="Number of genomes classified per run, the input genomes are repeated (default: the inputs)",
+    )
+    parser.add_argument(
+        "--db_genomes",
+        dest="db_genomes",
+        type=int,
+        default=200,
+        help="Number of genomes of the synthetic database",
+    )
+    parser.add_argument(
+        "--db_length",
+        dest="db_length",
+        type=int,
+        default=40_000,
+        help="Length of the genomes of the synthetic database",
+    )
+    parser.add_argument(
+        "--mash_hits", dest="mash_hits", type=int, default=10, help="mash hits of each genome"
+    )
+    parser.add_argument(
+        "--hsps", dest="hsps", type=int, default=4, help="blastn HSPs of each pair of genomes"
+    )
+    parser.add_argument(
+        "--hsp_length", dest="hsp_length", type=int, default=2000, help="Length of the HSPs"
+    )
+    parser.add_argument("-t", "--threads", dest="threads", default="4", help="Threads of tax_myPHAGE")
+    parser.add_argument("-j", "--jobs", dest="jobs", default="1", help="Jobs of tax_myPHAGE")
+    parser.add_argument(
+        "-n", "--repeats", dest="repeats", type=int, default=3, help="Number of runs"
+    )
+    parser.add_argument(
+        "--keep", dest="keep", action="store_true", help="Keep the folder of the runs"
+    )
+    args, cli_args = parser.parse_known_args()
+    cli_args = [arg for arg in cli_args if arg != "--"]
+
+    workdir = tempfile.mkdtemp(prefix="taxmyphage_e2e_")
+    try:
+        install_stubs(os.path.join(workdir, "bin"))
+
+        # A reference database without a query, in its own home for cold caches on the first run
+        rng = np.random.default_rng(0)
+        db_path = os.path.join(workdir, "db.fasta")
+        lineage_path = os.path.join(workdir, "lineage.tsv")
+        synthetic.write_fasta(
+            db_path, synthetic.random_genomes(args.db_genomes, args.db_length, rng), query=False
+        )
+        synthetic.write_lineage_table(lineage_path, args.db_genomes, query=False)
+
+        batch_path = os.path.join(workdir, "batch.fasta")
+        num_genomes = write_batch(args.inputs, args.batch, batch_path)
+
+        log_path = os.path.join(workdir, "tools.log")
+        env = {
+            **os.environ,
+            "HOME": os.path.join(workdir, "home"),
+            "PATH": os.path.join(workdir, "bin") + os.pathsep + os.environ["PATH"],
+            "MPLBACKEND": "Agg",
+            "TAXMYPHAGE_STUB_LOG": log_path,
+            "TAXMYPHAGE_STUB_MASH_HITS": str(args.mash_hits),
+            "TAXMYPHAGE_STUB_HSPS": str(args.hsps),
+            "TAXMYPHAGE_STUB_HSP_LENGTH": str(args.hsp_length),
+        }
+
+        print(
+            f"{num_genomes} genomes against {args.db_genomes} genomes of {args.db_length} bp,"
+            f" {args.mash_hits} mash hits, {args.hsps} HSPs of {args.hsp_length} bp per pair\n"
+        )
+        python_times = []
+        for repeat in range(args.repeats):
+            output = os.path.join(workdir, "output")
+            shutil.rmtree(output, ignore_errors=True)
+            cmd = [
+                sys.executable,
+                SCRIPT,
+                "-i", batch_path,
+                "-db", db_path,
+                "--VMR", lineage_path,
+                "--perso_database",
+                "-o", output,
+                "-t", args.threads,
+                "-j", args.jobs,
+                *cli_args,
+            ]
+            wall, tools, runs = run_cli(cmd, env, log_path)
+            python_time = wall - tools
+            python_times.append(python_time)
+
+            runs = " ".join(f"{tool}={count}" for tool, count in sorted(runs.items()))
+            print(
+                f"run {repeat + 1}{' (cold caches)' if repeat == 0 else ''}: wall {wall:.2f}s,"
+                f" tools {tools:.2f}s ({runs}),"
+                f" {python_time / num_genomes:.3f}s per genome without the tools"
+            )
+
+        if args.repeats > 1:
+            warm = python_times[1:]
+            print(
+                f"\nWarm runs: {median(warm) / num_genomes:.3f}s per genome without the tools (median)"
+            )
+    finally:
+        if args.keep:
+            print(f"\nRuns kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Time and memory of the Python kernels of tax_myPHAGE on synthetic inputs:
+# parse_blastn_file, calculate_distances, sim2cluster, check_VMR and heatmap
+# parse_blastn_lines is the line by line parser parse_blastn_file replaced, as a reference
+# The results are compared to the baselines stored in baselines.json, saved with --save
+
+import gzip
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import redirect_stderr
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from synthetic import SCALES
+
+import tax_myPHAGE
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# similarity thresholds of the clusters, as in PoorMansViridic.cluster_all
+THRESHOLDS = {"genus": 70, "species": 95}
+
+# minimum total time of the timed runs of a kernel, fast kernels are run more times
+MIN_TOTAL_SECONDS = 0.5
+
+
+def parse_blastn_lines(blastn_result_file):
+    """Identity of each pair of genomes and size of each genome, read line by line
+    with a vector of the query per pair, as tax_myPHAGE did before parse_blastn_file.
+    """
+    size_dict, M = {}, {}
+    previous_pair = None
+    with gzip.open(blastn_result_file, "rt") as df:
+        for line in df:
+            fields = dict(zip(tax_myPHAGE.BLASTN_COLUMNS, line.rstrip().split()))
+            key = (fields["qseqid"], fields["sseqid"])
+            if key != previous_pair:
+                if previous_pair:
+                    M[previous_pair] = np.sum(np.where(M[previous_pair] != 0, 1, 0))
+                previous_pair = key
+
+            M.setdefault(key, np.zeros(int(fields["qlen"])))
+            size_dict.setdefault(fields["qseqid"], int(fields["qlen"]))
+            size_dict.setdefault(fields["sseqid"], int(fields["slen"]))
+
+            qseq = np.frombuffer(fields["qseq"].encode(), dtype="S1")
+            sseq = np.frombuffer(fields["sseq"].encode(), dtype="S1")
+            v = np.where(qseq == sseq, 1, 0)
+            M[key][int(fields["qstart"]) - 1 : int(fields["qend"])] += v[qseq != b"-"]
+
+    if previous_pair:
+        M[previous_pair] = np.sum(np.where(M[previous_pair] != 0, 1, 0))
+
+    return M, size_dict
+
+
+def setup(files, workdir):
+    """Inputs of each kernel, computed with the kernels before it.
+    Args:
+        files (dict): The synthetic files, as returned by synthetic.generate
+        workdir (str): Folder for the outputs of the kernels
+    Returns:
+        dict: The function running each kernel, in the order of the pipeline
+    """
+    tax_myPHAGE.ic.disable()
+    pmv = tax_myPHAGE.PoorMansViridic(files["fasta"])
+    aligner = tax_myPHAGE.BlastnAligner(files["fasta"])
+    with redirect_stderr(io.StringIO()):
+        pmv.M, pmv.size_dict = aligner.parse_blastn_file(files["blastn"])
+    pmv.calculate_distances()
+    dfM = pmv.dfM
+
+    def parse_blastn_file():
+        aligner.parse_blastn_file(files["blastn"])
+
+    def parse_blastn_lines_():
+        parse_blastn_lines(files["blastn"])
+
+    def calculate_distances():
+        pmv.calculate_distances()
+
+    def sim2cluster():
+        pmv.sim2cluster(THRESHOLDS)
+
+    def check_VMR():
+        tax_myPHAGE.check_VMR(files["lineage"])
+
+    def heatmap():
+        tax_myPHAGE.heatmap(
+            dfM.copy(),
+            os.path.join(workdir, "heatmap"),
+            os.path.join(workdir, "top_right_matrix.tsv"),
+            files["genera"],
+            formats=("png",),
+        )
+
+    return {
+        "parse_blastn_file": parse_blastn_file,
+        "parse_blastn_lines": parse_blastn_lines_,
+        "calculate_distances": calculate_distances,
+        "sim2cluster": sim2cluster,
+        "check_VMR": check_VMR,
+        "heatmap": heatmap,
+    }
+
+
+def measure(kernel, repeats):
+    """Fastest wall time of a kernel and the peak of the memory it allocates.
+    The memory is measured in a separate run, as tracing slows the allocations.
+    The progress bars of the kernels are hidden.
+    Args:
+        kernel (callable): The kernel
+        repeats (int): Minimum number of timed runs
+    Returns:
+        tuple: The time in seconds and the peak memory in MB
+    """
+    times = []
+    with redirect_stderr(io.StringIO()):
+        while len(times) < repeats or sum(times) < MIN_TOTAL_SECONDS:
+            start = time.perf_counter()
+            kernel()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        kernel()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return min(times), peak / 2**20
+
+
+def compare(name, seconds, peak_mb, baseline, tolerance):
+    """Line of the report of a kernel, and whether it regressed."""
+    line = f"{name:<32}{seconds:>10.4f}s{peak_mb:>10.1f}MB"
+    if baseline is None:
+        return line + "   no baseline", False
+
+    time_ratio = seconds / baseline["seconds"]
+    memory_ratio = peak_mb / baseline["peak_mb"] if baseline["peak_mb"] else 1
+    regressed = time_ratio > tolerance or memory_ratio > tolerance
+    line += f"   x{time_ratio:.2f} time  x{memory_ratio:.2f} memory"
+
+    return line + ("   REGRESSION" if regressed else ""), regressed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the Python kernels of tax_myPHAGE")
+    parser.add_argument(
+        "--scales",
+        dest="scales",
+        choices=list(SCALES),
+        nargs="+",
+        default=["small", "medium"],
+        help="Scales of the synthetic inputs (default: small medium)",
+    )
+    parser.add_argument(
+        "--kernels",
+        dest="kernels",
+        nargs="+",
+        default=None,
+        help="Kernels to run, all of them by default",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=3,
+        help="Number of timed runs of each kernel",
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=1.5,
+        help="Exit with an error when a kernel is this many times slower or larger than its baseline",
+    )
+    parser.add_argument(
+        "--save",
+        dest="save",
+        action="store_true",
+        help="Store the results as the new baselines",
+    )
+    parser.add_argument(
+        "--data",
+        dest="data",
+        default=None,
+        help="Folder to keep the synthetic inputs in, a temporary folder by default",
+    )
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+    except OSError:
+        baselines = {"results": {}}
+
+    data = args.data or tempfile.mkdtemp(prefix="taxmyphage_bench_")
+    results, regressions = {}, []
+    try:
+        for scale in args.scales:
+            files = synthetic.generate(os.path.join(data, scale), **SCALES[scale])
+            print(f"\n{scale}: {SCALES[scale]}, {files['num_hsps']} HSPs")
+
+            kernels = setup(files, os.path.join(data, scale))
+            for kernel_name in args.kernels or kernels:
+                name = f"{kernel_name}@{scale}"
+                seconds, peak_mb = measure(kernels[kernel_name], args.repeats)
+                results[name] = {"seconds": round(seconds, 6), "peak_mb": round(peak_mb, 3)}
+
+                line, regressed = compare(
+                    name, seconds, peak_mb, baselines["results"].get(name), args.tolerance
+                )
+                print(line)
+                if regressed:
+                    regressions.append(name)
+    finally:
+        if args.data is None:
+            shutil.rmtree(data)
+
+    if args.save:
+        baselines = {
+            "machine": {
+                "platform": platform.platform(),
+                "processor": platform.processor() or platform.machine(),
+                "python": platform.python_version(),
+            },
+            "results": {**baselines["results"], **results},
+        }
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=1)
+        print(f"\nBaselines saved to {BASELINES_PATH}")
+
+    if regressions:
+        sys.exit(f"\n{len(regressions)} kernels regressed: {' '.join(regressions)}")
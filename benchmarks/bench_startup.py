@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Startup time of tax_myPHAGE: import of the module and parsing of the command line
+# Runs each command in a new interpreter and reports the fastest and median times
+
+import os
+import re
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from statistics import median
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tax_myPHAGE.py")
+
+
+def time_command(cmd, repeats):
+    """Wall time of a command, run several times.
+    Args:
+        cmd (list): The command and its arguments
+        repeats (int): Number of runs
+    Returns:
+        list: The time of each run, in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def slowest_imports(num_modules):
+    """Top level modules that take the longest to import with tax_myPHAGE.
+    Args:
+        num_modules (int): Number of modules to report
+    Returns:
+        list: (cumulative time in seconds, module name), the slowest first
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import tax_myPHAGE"],
+        cwd=os.path.dirname(SCRIPT),
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        text=True,
+        check=True,
+    ).stderr
+
+    # Lines of the modules imported by tax_myPHAGE itself are indented by 2 spaces
+    imports = [
+        (int(cumulative) / 1e6, name)
+        for cumulative, name in re.findall(r"\|\s*(\d+) \|   (\S+)$", stderr, re.M)
+    ]
+
+    return sorted(imports, reverse=True)[:num_modules]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the startup time of tax_myPHAGE")
+    parser.add_argument(
+        "-n",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=5,
+        help="Number of runs of each command",
+    )
+    parser.add_argument(
+        "--max_seconds",
+        dest="max_seconds",
+        type=float,
+        default=None,
+        help="Exit with an error when the median time of a command is above this",
+    )
+    args = parser.parse_args()
+
+    commands = {
+        "import": [sys.executable, "-c", "import tax_myPHAGE"],
+        "--help": [sys.executable, SCRIPT, "--help"],
+    }
+
+    too_slow = False
+    for name, cmd in commands.items():
+        times = time_command(cmd, args.repeats)
+        print(f"{name:>8}: min {min(times):.3f}s  median {median(times):.3f}s")
+        if args.max_seconds is not None and median(times) > args.max_seconds:
+            too_slow = True
+
+    print("\nSlowest imports:")
+    for seconds, name in slowest_imports(10):
+        print(f"{seconds:8.3f}s  {name}")
+
+    if too_slow:
+        sys.exit(f"Startup is slower than {args.max_seconds}s")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Check that a Classifier can be shared by threads: the genomes of two batches are
+# classified by two threads at once, with the debug output switched on in one of
+# them, and their results compared to the ones of the batches classified in turn
+# The classifications sketch and align the genomes in-process, with --native_mash
+# and --aligner kmer, on a synthetic database, so that no tool is needed
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stdout
+from io import StringIO
+
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+import tax_myPHAGE
+
+
+def query_batches(genomes, num_genomes, rng):
+    """Two batches of queries: mutated copies of the reference genomes, of their
+    species, and random genomes without hits.
+    """
+    batches = ([], [])
+    for i in range(num_genomes):
+        if i % 4 == 3:
+            seq = synthetic.mutate(genomes[0], 1, rng)
+        else:
+            seq = synthetic.mutate(genomes[(7 * i) % len(genomes)], 0.02, rng)
+        batches[i % 2].append(SeqRecord(Seq(seq.tobytes().decode()), id=f"Q{i:03d}"))
+
+    return batches
+
+
+@contextmanager
+def captured_output(output):
+    """Keep the standard output and error of the process, including the ones of
+    icecream and tqdm, in a list instead of printing them."""
+    with redirect_stdout(StringIO()) as stdout, tempfile.TemporaryFile("w+") as stderr:
+        saved_stderr = os.dup(2)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stderr.flush()
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stderr)
+            stderr.seek(0)
+            output.append(stdout.getvalue() + stderr.read())
+
+
+def summary(results):
+    return {
+        result.genome_id: (result.status, result.lineage.get("Genus"))
+        for result in results
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Classify genomes from two threads at once")
+    parser.add_argument(
+        "--db_genomes", dest="db_genomes", type=int, default=40, help="Genomes of the database"
+    )
+    parser.add_argument(
+        "--length", dest="length", type=int, default=20_000, help="Length of the genomes"
+    )
+    parser.add_argument(
+        "--queries", dest="queries", type=int, default=8, help="Number of query genomes"
+    )
+    parser.add_argument(
+        "--keep", dest="keep", action="store_true", help="Keep the folder of the runs"
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="taxmyphage_threads_")
+    try:
+        # The caches of the reference data are built in the folder of the check
+        tax_myPHAGE.LINEAGE_CACHE_DIR = os.path.join(workdir, "cache", "lineages")
+        tax_myPHAGE.CATALOG_CACHE_DIR = os.path.join(workdir, "cache", "catalogs")
+        tax_myPHAGE.SKETCH_CACHE_DIR = os.path.join(workdir, "cache", "sketches")
+
+        rng = np.random.default_rng(0)
+        genomes = synthetic.random_genomes(args.db_genomes, args.length, rng)
+        db_path = os.path.join(workdir, "db.fasta")
+        lineage_path = os.path.join(workdir, "lineage.tsv")
+        synthetic.write_fasta(db_path, genomes, query=False)
+        synthetic.write_lineage_table(lineage_path, args.db_genomes, query=False)
+        batches = query_batches(genomes, args.queries, rng)
+
+        config = tax_myPHAGE.Config(
+            output=os.path.join(workdir, "in_turn"),
+            VMR_path=lineage_path,
+            blastdb_path=db_path,
+            threads=2,
+            figures=False,
+            native_mash=True,
+            aligner="kmer",
+        )
+
+        output = []
+        with captured_output(output):
+            classifier = tax_myPHAGE.Classifier(config)
+            expected = [summary(classifier.classify(batch)) for batch in batches]
+
+        # One classifier shared by the threads, and one with the debug output on
+        classifiers = [
+            tax_myPHAGE.Classifier(config.replace(output=os.path.join(workdir, "shared"))),
+            tax_myPHAGE.Classifier(
+                config.replace(output=os.path.join(workdir, "verbose"), verbose=True)
+            ),
+        ]
+        results, errors = [None] * 4, []
+
+        def classify(i, classifier, batch):
+            try:
+                results[i] = summary(classifier.classify(batch))
+            except Exception as e:
+                errors.append(f"thread {i}: {e!r}")
+
+        threads = [
+            threading.Thread(target=classify, args=(i, classifiers[i // 2], batches[i % 2]))
+            for i in range(4)
+        ]
+        with captured_output(output):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        for i, result in enumerate(results):
+            if result is not None and result != expected[i % 2]:
+                errors.append(f"thread {i}: {result} instead of {expected[i % 2]}")
+        # The lines of icecream start with "ic| ", between the escape codes of its colors
+        debug = ["ic| " in re.sub("\x1b\\[[0-9;]*m", "", text) for text in output]
+        if debug[0] or not debug[1]:
+            errors.append("the debug output does not follow the configurations")
+        if tax_myPHAGE.ic.enabled:
+            errors.append("the debug output of the process was switched on")
+
+        statuses = sorted({status for batch in expected for status, _ in batch.values()})
+        print(f"{args.queries} genomes classified by 4 threads, statuses: {', '.join(statuses)}")
+        if errors:
+            sys.exit("\n".join(errors))
+        print("Same results as the classifications in turn")
+    finally:
+        if args.keep:
+            print(f"Runs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
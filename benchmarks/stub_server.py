@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Stand-in for the servers of the reference files, to try the downloads of
+# tax_myPHAGE on a local HTTP server
+# The files of a folder are served with range requests, If-Range and an ETag that is
+# their MD5, as S3 does for the files uploaded in one part
+# --drop_after cuts each response after that many bytes, to try the resumed downloads
+#
+#   python benchmarks/stub_server.py references/ --port 8000 --drop_after 100000
+#   python tax_myPHAGE.py ... --download_manifest manifest.json
+#
+# with the urls of manifest.json set to http://127.0.0.1:8000/<file>
+
+import hashlib
+import os
+import re
+from argparse import ArgumentParser
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@lru_cache(maxsize=None)
+def file_md5(path, mtime):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Handler(BaseHTTPRequestHandler):
+    root = "."
+    drop_after = 0
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = os.path.join(self.root, os.path.basename(self.path.split("?")[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        etag = f'"{file_md5(path, os.path.getmtime(path))}"'
+        start, end = 0, size - 1
+        partial = False
+
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            partial = True
+
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        remaining = end - start + 1
+        if self.drop_after:
+            remaining = min(remaining, self.drop_after)
+        with open(path, "rb") as f:
+            f.seek(start)
+            while remaining > 0 and (chunk := f.read(min(2**16, remaining))):
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+        if self.drop_after:
+            self.close_connection = True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve the files of a folder with range requests")
+    parser.add_argument("folder", help="Folder of the files to serve")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", dest="port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--drop_after",
+        dest="drop_after",
+        type=int,
+        default=0,
+        help="Close each response after this many bytes, 0 to send the files whole",
+    )
+    args = parser.parse_args()
+
+    Handler.root = args.folder
+    Handler.drop_after = args.drop_after
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Serving {args.folder} on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Stand-ins for mash, blastdbcmd, makeblastdb and blastn returning canned outputs,
+# for bench_e2e.py to time the orchestration of tax_myPHAGE without the tools
+# The tool is given by TAXMYPHAGE_STUB_TOOL, or by the name the script is called with
+# The sizes of the outputs are set by environment variables:
+#   TAXMYPHAGE_STUB_MASH_HITS    mash hits of each query (default 10)
+#   TAXMYPHAGE_STUB_HSPS         blastn HSPs of each pair of genomes (default 4)
+#   TAXMYPHAGE_STUB_HSP_LENGTH   length of the HSPs (default 2000)
+# Each run appends its name, start and end time to TAXMYPHAGE_STUB_LOG
+
+import gzip
+import os
+import sys
+import time
+import zlib
+
+# substitution of the mutated positions of the subject, so that they differ
+MUTATE = bytes.maketrans(b"ACGTacgt", b"CATGcatg")
+
+
+def read_fasta(path):
+    """Names and sequences of the records of a FASTA file, gzipped or not."""
+    handle = gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+    name, seq = None, []
+    with handle:
+        for line in handle:
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, "".join(seq)
+                name, seq = line[1:].split()[0], []
+            else:
+                seq.append(line.strip())
+    if name is not None:
+        yield name, "".join(seq)
+
+
+def read_names(path):
+    """Names of the records of a FASTA file."""
+    handle = gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+    with handle:
+        return [line[1:].split()[0] for line in handle if line.startswith(">")]
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def positional(args, with_values):
+    """Arguments that are neither options nor the values of options."""
+    return [
+        arg
+        for i, arg in enumerate(args)
+        if not arg.startswith("-") and (i == 0 or args[i - 1] not in with_values)
+    ]
+
+
+def mash(args):
+    """mash sketch writes the path of the genomes as the index, a copy of its
+    standard input read with -, mash dist gives each query a run of consecutive
+    references with increasing distances.
+    """
+    if args[0] == "sketch":
+        output = option(args, "-o")
+        output = output if output.endswith(".msh") else output + ".msh"
+        files = positional(args[1:], ("-o", "-p", "-k", "-s"))
+        if args[-1] == "-":
+            files.append(f"{output}.stdin.fa")
+            with open(files[-1], "wb") as f:
+                f.write(sys.stdin.buffer.read())
+        with open(output, "w") as f:
+            f.write("\n".join(os.path.abspath(path) for path in files) + "\n")
+        return
+
+    max_dist = float(option(args, "-d", 1))
+    index, *query_paths = positional(args[1:], ("-d", "-p"))
+    with open(index) as f:
+        references = [name for path in f.read().split() for name in read_names(path)]
+
+    queries = (
+        [name for path in query_paths for name in read_names(path)]
+        if "-i" in args
+        else query_paths
+    )
+    num_hits = int(os.environ.get("TAXMYPHAGE_STUB_MASH_HITS", 10))
+    for query_name in queries:
+        first = zlib.crc32(query_name.encode()) % max(1, len(references))
+        for i in range(min(num_hits, len(references))):
+            dist = 0.02 + 0.01 * i
+            if dist <= max_dist:
+                reference = references[(first + i) % len(references)]
+                print(f"{reference}\t{query_name}\t{dist:.6g}\t0\t{1000 - 50 * i}/1000")
+
+
+def blastdbcmd(args):
+    """Copy the entries of the database to the output, as FASTA."""
+    entries = option(args, "-entry", "")
+    if "-entry_batch" in args:
+        with open(option(args, "-entry_batch")) as f:
+            entries = ",".join(f.read().split())
+    wanted = set(entries.split(","))
+    with open(option(args, "-out"), "w") as f:
+        for name, seq in read_fasta(option(args, "-db")):
+            if name in wanted or name.split(".")[0] in wanted:
+                f.write(f">{name}\n{seq}\n")
+
+
+def makeblastdb(args):
+    """Create the files of a nucleotide database, empty."""
+    if option(args, "-in") == "-":
+        sys.stdin.buffer.read()
+    for extension in ("nhr", "nin", "nsq"):
+        open(f"{option(args, '-out', option(args, '-in'))}.{extension}", "w").close()
+
+
+def hsp(qseq, identity, qstart, qlen, slen, names, columns):
+    """A line of blastn output whose subject is the query with a substitution
+    every 1 / (1 - identity) positions.
+    """
+    sseq = bytearray(qseq.encode())
+    step = 0
+    if identity < 1:
+        step = max(2, round(1 / (1 - identity)))
+        sseq[::step] = bytes(sseq[::step]).translate(MUTATE)
+    sseq = sseq.decode()
+
+    length = len(qseq)
+    mismatches = len(range(0, length, step)) if step else 0
+    btop = []
+    if step:
+        for position in range(0, length, step):
+            btop.append(f"{qseq[position]}{sseq[position]}")
+            btop.append(str(min(step - 1, length - position - 1)))
+    else:
+        btop.append(str(length))
+
+    values = {
+        "qseqid": names[0],
+        "sseqid": names[1],
+        "pident": f"{100 * (length - mismatches) / length:.3f}",
+        "length": length,
+        "qlen": qlen,
+        "slen": slen,
+        "mismatch": mismatches,
+        "nident": length - mismatches,
+        "gapopen": 0,
+        "qstart": qstart + 1,
+        "qend": qstart + length,
+        "sstart": qstart + 1,
+        "send": qstart + length,
+        "qseq": qseq,
+        "sseq": sseq,
+        "evalue": "0.0",
+        "bitscore": 2 * (length - mismatches),
+        "btop": "".join(part for part in btop if part != "0"),
+    }
+    return "\t".join(str(values[column]) for column in columns)
+
+
+def blastn(args):
+    """Every pair of genomes gets the same number of HSPs, spread along the
+    query, with an identity set by the names of the genomes.
+    """
+    columns = option(args, "-outfmt").split()[1:]
+    num_hsps = int(os.environ.get("TAXMYPHAGE_STUB_HSPS", 4))
+    hsp_length = int(os.environ.get("TAXMYPHAGE_STUB_HSP_LENGTH", 2000))
+    subjects = [(name, len(seq)) for name, seq in read_fasta(option(args, "-db"))]
+
+    out = sys.stdout
+    for query_name, query in read_fasta(option(args, "-query")):
+        for subject_name, slen in subjects:
+            names = (query_name, subject_name)
+            if query_name == subject_name:
+                out.write(hsp(query, 1, 0, len(query), slen, names, columns) + "\n")
+                continue
+
+            identity = 0.7 + 0.3 * (zlib.crc32(" ".join(sorted(names)).encode()) % 100) / 100
+            length = min(hsp_length, len(query) // num_hsps, slen // num_hsps)
+            for i in range(num_hsps):
+                qstart = i * (min(len(query), slen) // num_hsps)
+                qseq = query[qstart : qstart + length]
+                out.write(hsp(qseq, identity, qstart, len(query), slen, names, columns) + "\n")
+
+
+TOOLS = {"mash": mash, "blastdbcmd": blastdbcmd, "makeblastdb": makeblastdb, "blastn": blastn}
+
+
+if __name__ == "__main__":
+    start = time.time()
+    tool = os.environ.get("TAXMYPHAGE_STUB_TOOL") or os.path.basename(sys.argv[0])
+    try:
+        TOOLS[tool](sys.argv[1:])
+    finally:
+        log_path = os.environ.get("TAXMYPHAGE_STUB_LOG")
+        if log_path:
+            with open(log_path, "a") as f:
+                f.write(f"{tool}\t{start}\t{time.time()}\n")
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Synthetic inputs of tax_myPHAGE: phage genomes, the tabular blastn output of
+# their all-versus-all alignment and their lineage table
+# The genomes are grouped in genera and species, related genomes share HSPs with
+# an identity set by how close they are, so that the clustering finds the groups
+# The last genome is the query, as in the viridic_in.fa file of a classification
+
+import gzip
+import os
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tax_myPHAGE import BLASTN_COLUMNS
+
+# number of genomes, genome length and HSPs per 10 kb of related genomes of each scale
+SCALES = {
+    "small": {"num_genomes": 10, "length": 40_000, "hsp_density": 1},
+    "medium": {"num_genomes": 50, "length": 50_000, "hsp_density": 2},
+    "large": {"num_genomes": 200, "length": 30_000, "hsp_density": 2},
+    "jumbo": {"num_genomes": 20, "length": 400_000, "hsp_density": 1},
+}
+
+# genomes per species and species per genus
+SPECIES_SIZE = 2
+GENUS_SIZE = 5
+
+# identity of the HSPs of genomes of the same species, of the same genus and of others
+SPECIES_IDENTITY = 0.97
+GENUS_IDENTITY = (0.75, 0.9)
+DISTANT_IDENTITY = 0.7
+# fraction of a query covered by the HSPs of genomes of the same species or genus
+SPECIES_COVERAGE = 0.95
+GENUS_COVERAGE = 0.7
+# probability that genomes of different genera share a single short HSP
+DISTANT_PAIRS = 0.05
+# fraction of the aligned positions that are gaps
+GAP_RATE = 0.005
+
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def genome_id(i, num_genomes=0):
+    """Name of a genome, the last of num_genomes genomes is the query."""
+    return f"query_SYN{i:06d}" if i == num_genomes - 1 else f"SYN{i:06d}"
+
+
+def taxon_of(i):
+    """Species and genus numbers of a genome."""
+    species = i // SPECIES_SIZE
+    return species, species // GENUS_SIZE
+
+
+def random_genomes(num_genomes, length, rng):
+    """Genomes derived from the ancestor of their genus, closer within a species.
+    Args:
+        num_genomes (int): Number of genomes
+        length (int): Length of each genome
+        rng (np.random.Generator): Random numbers
+    Returns:
+        list: The sequence of each genome, as an array of bytes
+    """
+    genomes, genus_ancestors, species_ancestors = [], {}, {}
+    for i in range(num_genomes):
+        species, genus = taxon_of(i)
+        if genus not in genus_ancestors:
+            genus_ancestors[genus] = rng.choice(NUCLEOTIDES, length)
+        if species not in species_ancestors:
+            species_ancestors[species] = mutate(genus_ancestors[genus], 0.1, rng)
+        genomes.append(mutate(species_ancestors[species], 0.01, rng))
+
+    return genomes
+
+
+def mutate(seq, rate, rng):
+    """Copy of a sequence with a fraction of its positions substituted."""
+    seq = seq.copy()
+    positions = np.flatnonzero(rng.random(len(seq)) < rate)
+    seq[positions] = rng.choice(NUCLEOTIDES, len(positions))
+    return seq
+
+
+def hsp_line(query, subject, A, B, qstart, sstart, hsp_length, identity, rng):
+    """One line of tabular blastn output, in the columns of BLASTN_COLUMNS.
+    The HSPs of a genome with itself have no substitution and no gap.
+    """
+    qseq = query[qstart : qstart + hsp_length].copy()
+    sseq = mutate(qseq, 1 - identity, rng)
+    gaps = np.flatnonzero(rng.random(hsp_length) < (GAP_RATE if identity < 1 else 0))
+    in_query = rng.random(len(gaps)) < 0.5
+    qseq[gaps[in_query]] = ord("-")
+    sseq[gaps[~in_query]] = ord("-")
+
+    nident = int(np.count_nonzero(qseq == sseq))
+    values = {
+        "qseqid": A,
+        "sseqid": B,
+        "pident": f"{100 * nident / hsp_length:.3f}",
+        "length": hsp_length,
+        "qlen": len(query),
+        "slen": len(subject),
+        "mismatch": hsp_length - nident - len(gaps),
+        "nident": nident,
+        "gapopen": len(gaps),
+        "qstart": qstart + 1,
+        "qend": qstart + hsp_length - int(np.count_nonzero(qseq == ord("-"))),
+        "sstart": sstart + 1,
+        "send": sstart + hsp_length - int(np.count_nonzero(sseq == ord("-"))),
+        "qseq": qseq.tobytes().decode(),
+        "sseq": sseq.tobytes().decode(),
+        "evalue": "0.0",
+        "bitscore": 2 * nident,
+    }
+    return "\t".join(str(values[column]) for column in BLASTN_COLUMNS) + "\n"
+
+
+def write_blastn_output(path, genomes, hsp_density, rng):
+    """Write the all-versus-all blastn output of the genomes, gzipped.
+    The HSPs of a pair tile the query in windows of 10 kb / hsp_density, each
+    window aligned with a probability given by the coverage of the pair.
+    Args:
+        path (str): Path to the .tab.gz file
+        genomes (list): The sequence of each genome
+        hsp_density (float): Number of HSPs per 10 kb of related genomes
+        rng (np.random.Generator): Random numbers
+    Returns:
+        int: Number of HSPs written
+    """
+    window = max(100, int(10_000 / hsp_density))
+    num_hsps = 0
+    with gzip.open(path, "wt", compresslevel=1) as f:
+        for a, query in enumerate(genomes):
+            for b, subject in enumerate(genomes):
+                A, B = genome_id(a, len(genomes)), genome_id(b, len(genomes))
+                if a == b:
+                    f.write(hsp_line(query, subject, A, B, 0, 0, len(query), 1, rng))
+                    num_hsps += 1
+                    continue
+
+                (species_a, genus_a), (species_b, genus_b) = taxon_of(a), taxon_of(b)
+                if species_a == species_b:
+                    identity, coverage = SPECIES_IDENTITY, SPECIES_COVERAGE
+                elif genus_a == genus_b:
+                    identity, coverage = rng.uniform(*GENUS_IDENTITY), GENUS_COVERAGE
+                elif rng.random() < DISTANT_PAIRS:
+                    qstart = int(rng.integers(0, len(query) - window))
+                    f.write(
+                        hsp_line(query, subject, A, B, qstart, qstart, window // 2, DISTANT_IDENTITY, rng)
+                    )
+                    num_hsps += 1
+                    continue
+                else:
+                    continue
+
+                end = min(len(query), len(subject))
+                for qstart in range(0, end - window + 1, window):
+                    if rng.random() < coverage:
+                        f.write(
+                            hsp_line(query, subject, A, B, qstart, qstart, window, identity, rng)
+                        )
+                        num_hsps += 1
+
+    return num_hsps
+
+
+def write_lineage_table(path, num_genomes, query=True):
+    """Write the tab separated lineage table of the genomes but the query, in the
+    format of --genome_ids Genome_id --lineage Lineage. Every other genus is in a
+    subfamily.
+    """
+    with open(path, "w") as f:
+        f.write("Genome_id\tLineage\n")
+        for i in range(num_genomes - 1 if query else num_genomes):
+            species, genus = taxon_of(i)
+            family = genus // 4
+            subfamily = f";Sub{genus // 2}virinae" if genus % 2 else ""
+            f.write(
+                f"{genome_id(i)}\tDuplodnaviria;Heunggongvirae;Uroviricota;Caudoviricetes;"
+                f"Fam{family}viridae{subfamily};Gen{genus}virus;Gen{genus}virus sp{species}\n"
+            )
+
+
+def write_fasta(path, genomes, query=True):
+    """Write the genomes, the last one named as the query unless query is False."""
+    with open(path, "w") as f:
+        for i, seq in enumerate(genomes):
+            name = genome_id(i, len(genomes) if query else 0)
+            f.write(f">{name}\n{seq.tobytes().decode()}\n")
+
+
+def generate(outdir, num_genomes, length, hsp_density, seed=0):
+    """Write the genomes, blastn output and lineage table of a scale.
+    Args:
+        outdir (str): Folder of the files
+        num_genomes (int): Number of genomes
+        length (int): Length of each genome
+        hsp_density (float): Number of HSPs per 10 kb of related genomes
+        seed (int): Seed of the random numbers
+    Returns:
+        dict: Paths of the files, genus of each genome and number of HSPs
+    """
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    genomes = random_genomes(num_genomes, length, rng)
+
+    paths = {
+        "fasta": os.path.join(outdir, "genomes.fa"),
+        "blastn": os.path.join(outdir, "genomes.fa.blastn_vs2_self.tab.gz"),
+        "lineage": os.path.join(outdir, "lineage.tsv"),
+    }
+    write_fasta(paths["fasta"], genomes)
+    num_hsps = write_blastn_output(paths["blastn"], genomes, hsp_density, rng)
+    write_lineage_table(paths["lineage"], num_genomes)
+
+    return {
+        **paths,
+        "num_hsps": num_hsps,
+        "genera": {
+            genome_id(i): f"Gen{taxon_of(i)[1]}virus" for i in range(num_genomes - 1)
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write synthetic inputs of tax_myPHAGE")
+    parser.add_argument("-o", "--output", dest="output", required=True, help="Output folder")
+    parser.add_argument(
+        "--scale",
+        dest="scale",
+        choices=list(SCALES),
+        default="small",
+        help="Preset number of genomes, length and HSP density",
+    )
+    parser.add_argument("--genomes", dest="num_genomes", type=int, help="Number of genomes")
+    parser.add_argument("--length", dest="length", type=int, help="Length of the genomes")
+    parser.add_argument(
+        "--hsp_density",
+        dest="hsp_density",
+        type=float,
+        help="Number of HSPs per 10 kb of related genomes",
+    )
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    for name in scale:
+        if getattr(args, name) is not None:
+            scale[name] = getattr(args, name)
+
+    files = generate(args.output, seed=args.seed, **scale)
+    print(f"{files['num_hsps']} HSPs between {scale['num_genomes']} genomes written to {args.output}")
@@ -5,34 +5,192 @@ import os
 import io
 import gzip
 import time
-from argparse import ArgumentParser
-from itertools import zip_longest
+import hashlib
+import sqlite3
+import mmap
+import json
+import socket
+import socketserver
+import signal
+import threading
+import uuid
+import shlex
+from argparse import ArgumentParser, ArgumentTypeError
+from contextlib import contextmanager
+from itertools import islice
 import numpy as np
 import pandas as pd
-from icecream import ic
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio import SeqIO
-import networkx as nx
+from Bio.SeqRecord import SeqRecord
 from tqdm import tqdm
 from datetime import timedelta
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-import wget
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import shutil
 import glob
-import scipy.cluster.hierarchy as sch
-import matplotlib.colors as mcolors
 import re
 import glob
-from typing import List, Dict
 
-# Set matplotlib parameters
-import matplotlib.pyplot as plt
-
-plt.rcParams["text.color"] = "#131516"
-plt.rcParams["svg.fonttype"] = "none"  # Editable SVG text
-plt.rcParams["font.family"] = "Arial"
-plt.rcParams["font.weight"] = "light"
+# matplotlib, scipy and urllib.request are imported by the stages that use them,
+# as their import takes longer than a short run, see import_pyplot
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# cache of the processed lineage tables, see load_lineage_table
+LINEAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "lineages")
+LINEAGE_CACHE_VERSION = 2
+LINEAGE_TABLES = {}
+
+# cache of the byte offsets of the reference genomes, see load_reference_catalog
+CATALOG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "catalogs")
+CATALOG_CACHE_VERSION = 1
+REFERENCE_CATALOGS = {}
+
+# stamps of the checks of the programs and database files, see cached_check
+ENVIRONMENT_STAMP_PATH = os.path.join(
+    os.path.expanduser("~"), ".taxmyPHAGE", "environment.json"
+)
+
+# progress of a run of the command line in its output folder, see RunManifest
+RUN_MANIFEST_NAME = "run_manifest.json"
+RUN_MANIFEST_VERSION = 1
+
+# reference files downloaded on the first run, see download_references. A JSON file
+# given with --download_manifest changes their url or adds their sha256 or md5.
+# etag_is_md5 marks the files hosted on S3, whose ETag is their MD5 when uploaded
+# in one part
+REFERENCE_DOWNLOADS = {
+    "VMR": {"url": "https://ictv.global/vmr/current"},
+    "mash_index": {
+        "url": "https://millardlab-inphared.s3.climb.ac.uk/ICTV_2023.msh",
+        "etag_is_md5": True,
+    },
+    "genomes": {
+        "url": "https://millardlab-inphared.s3.climb.ac.uk/Bacteriophage_genomes.fasta.gz",
+        "etag_is_md5": True,
+    },
+}
+# attempts of a download in a row without getting more of the file, each one
+# resuming where the previous stopped
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 2**20
+
+# size of the chunks of the reference genomes given to the indexers, see prepare_database
+DATABASE_CHUNK_SIZE = 2**20
+
+# Suffixes of the ICTV names of each level, in the order they are tested
+LINEAGE_SUFFIXES = {
+    "Root": ["Viruses", "root"],
+    "Realm": ["viria", "satellitia", "viroidia", "viriformia"],
+    "Subrealm": ["vira", "satellita", "viroida", "viriforma"],
+    "Kingdom": ["virae", "satellitae", "viroidae", "viriformae"],
+    "Subkingdom": ["virites", "satellitites", "viroidites", "viriformites"],
+    "Phylum": ["viricota", "satelliticota", "viroidicota", "viriformicota"],
+    "Subphylum": [
+        "viricotina",
+        "satelliticotina",
+        "viroidicotina",
+        "viriformicotina",
+    ],
+    "Class": ["viricetes", "satelliticetes", "viroidicetes", "viriformicetes"],
+    "Subclass": [
+        "viricetidae",
+        "satelliticetidae",
+        "viroidicetidae",
+        "viriformicetidae",
+    ],
+    "Order": ["virales", "satellitales", "viroidales", "viriformales"],
+    "Suborder": ["virineae", "satellitineae", "viroidineae", "viriformineae"],
+    "Family": ["viridae", "viriformidae", "viroidae", "satellitidae"],
+    "Subfamily": ["virinae", "satellitinae", "viroidinae", "viriforminae"],
+    "Genus": ["virus", "viriform", "viroid", "satellite"],
+}
+
+# No suffix ends with the suffix of another level, so the longest matching
+# suffix gives the same level as testing them in order ("viroidae" is both a
+# Kingdom and a Family suffix, the first level in LINEAGE_SUFFIXES wins)
+LINEAGE_SUFFIX_LEVEL = {}
+for level, exts in LINEAGE_SUFFIXES.items():
+    for ext in exts:
+        LINEAGE_SUFFIX_LEVEL.setdefault(ext, level)
+LINEAGE_SUFFIX_RE = re.compile(
+    "({})$".format("|".join(sorted(LINEAGE_SUFFIX_LEVEL, key=len, reverse=True)))
+)
+
+TAXONOMY_PREFIXES = {
+    "Root": "ro__",
+    "Realm": "r__",
+    "Subrealm": "sr__",
+    "Kingdom": "k__",
+    "Subkingdom": "sk__",
+    "Phylum": "p__",
+    "Subphylum": "sp__",
+    "Class": "c__",
+    "Subclass": "sc__",
+    "Order": "o__",
+    "Suborder": "so__",
+    "Family": "f__",
+    "Subfamily": "sf__",
+    "Genus": "g__",
+    "Species": "s__",
+}
+
+
+# list of names for the headers of mash dist output
+MASH_COLUMNS = ["Reference", "Query", "distance", "p-value", "shared-hashes", "ANI"]
+
+# columns of the tabular output of blastn in PoorMansViridic
+BLASTN_COLUMNS = "qseqid sseqid pident length qlen slen mismatch nident gapopen qstart qend sstart send qseq sseq evalue bitscore".split()
+
+# columns of the compact blastn output, the alignment is given by its trace-back operations
+LEAN_BLASTN_COLUMNS = "qseqid sseqid qlen slen qstart btop".split()
+
+# levels of the lineage given in the results of the classification
+RESULT_LEVELS = ["Class", "Family", "Subfamily", "Genus", "Species"]
+
+# colors of the heatmap and the similarities they start at
+HEATMAP_COLORS = ["white", "lightgray", "skyblue", "steelblue", "darkgreen"]
+HEATMAP_BOUNDARIES = [0, 1, 50, 70, 95, 100]
+
+# number of genomes above which the heatmap is drawn as an image without labels,
+# and number of rows and columns of the image above which the cells are aggregated
+HEATMAP_LARGE_GENOMES = 150
+HEATMAP_MAX_PIXELS = 4000
+# vector formats, whose heatmap values are drawn as text to be kept editable
+HEATMAP_TEXT_FORMATS = {"svg", "svgz", "pdf", "eps", "ps"}
+
+# parameters of the native MinHash sketches, the defaults of mash sketch
+MASH_KMER_SIZE = 21
+MASH_SKETCH_SIZE = 1000
+MASH_SEED = 42
+
+# cache of the sketches of the reference genomes, see load_minhash_index
+SKETCH_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "sketches")
+SKETCH_CACHE_VERSION = 1
+MINHASH_INDEXES = {}
+
+# code of each base for the KmerAligner and the native MinHash, 4 for anything else than ACGT
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
 
 
 def print_error(txt):
@@ -43,6 +201,67 @@ def print_warn(txt):
     print(f"\033[94m{txt}\033[0m")
 
 
+class LazyIc:
+    """Stand-in for the ic function of icecream, which is only imported when the
+    debugging output is enabled, for the whole process with enable() or for the
+    calls of a thread with verbose().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+
+    def __call__(self, *args):
+        if getattr(self.local, "enabled", self.enabled):
+            from icecream import ic
+
+            # Formatted from the frame of the caller, where icecream finds the
+            # expressions of the arguments
+            ic.outputFunction(ic._format(sys._getframe(1), *args))
+        if not args:
+            return None
+        return args[0] if len(args) == 1 else args
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def verbose(self, enabled):
+        """Enable or disable the output of the calls of this thread, whatever the
+        setting of the process."""
+        previous = getattr(self.local, "enabled", None)
+        self.local.enabled = enabled
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.local.enabled
+            else:
+                self.local.enabled = previous
+
+
+ic = LazyIc()
+
+
+def import_pyplot():
+    """Import matplotlib.pyplot with the parameters of the figures.
+    Returns:
+        module: matplotlib.pyplot
+    """
+    import matplotlib.pyplot as plt
+
+    # Set matplotlib parameters
+    plt.rcParams["text.color"] = "#131516"
+    plt.rcParams["svg.fonttype"] = "none"  # Editable SVG text
+    plt.rcParams["font.family"] = "Arial"
+    plt.rcParams["font.weight"] = "light"
+
+    return plt
+
+
 def print_ok(txt):
     print(f"\033[34m{txt}\033[0m")
 
@@ -51,9 +270,105 @@ def print_res(txt):
     print(f"\033[33m{txt}\033[0m")
 
 
+class StageTrace:
+    """Wall time, CPU time, peak memory and input sizes of the stages of the
+    classification of a genome, written as JSON with --trace.
+    The CPU time of a stage is the one of the thread running it and of the child
+    processes that ended during it. The RSS high-water marks of the process and
+    of its largest child process are the ones of their whole lifetime at the end
+    of the stage, with how much the stage raised them. A stage that stays below
+    the peak of an earlier one raises them by 0. A trace that is not enabled
+    records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def usage():
+        """CPU time of the thread, CPU time of the children and peak RSS in MB."""
+        if resource is None:
+            return time.thread_time(), 0.0, None, None
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        unit = 1 if sys.platform == "darwin" else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (
+            time.thread_time(),
+            children.ru_utime + children.ru_stime,
+            own.ru_maxrss * unit / 2**20,
+            children.ru_maxrss * unit / 2**20,
+        )
+
+    @staticmethod
+    def growth(start, end):
+        """Difference of two high-water marks, None when they are not measured."""
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @contextmanager
+    def stage(self, name, **sizes):
+        """Trace a stage, the sizes of its inputs given as keywords or added to
+        the record it yields.
+        """
+        record = {"stage": name, **sizes}
+        if not self.enabled:
+            yield record
+            return
+
+        start = time.perf_counter()
+        cpu, children_cpu, peak_rss, children_peak_rss = self.usage()
+        try:
+            yield record
+        finally:
+            end_cpu, end_children_cpu, end_peak_rss, end_children_peak_rss = (
+                self.usage()
+            )
+            record.update(
+                start=start - self.start,
+                wall=time.perf_counter() - start,
+                cpu=end_cpu - cpu,
+                children_cpu=end_children_cpu - children_cpu,
+                lifetime_peak_rss_mb=end_peak_rss,
+                peak_rss_growth_mb=self.growth(peak_rss, end_peak_rss),
+                children_lifetime_peak_rss_mb=end_children_peak_rss,
+                children_peak_rss_growth_mb=self.growth(
+                    children_peak_rss, end_children_peak_rss
+                ),
+            )
+            with self.lock:
+                self.stages.append(record)
+
+    def save(self, path, **info):
+        """Write the stages, in the order they started, to a JSON file."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {**info, "stages": sorted(self.stages, key=lambda stage: stage["start"])},
+                f,
+                indent=1,
+            )
+        os.replace(tmp_path, path)
+
+
 class PoorMansViridic:
     def __init__(
-        self, file, genus_threshold=70, species_threshold=95, nthreads=1, verbose=True
+        self,
+        file,
+        genus_threshold=70,
+        species_threshold=95,
+        nthreads=1,
+        verbose=True,
+        lean_blast=False,
+        extra_thresholds=None,
+        pair_cache=None,
+        aligner=None,
+        trace=None,
     ):
         self.verbose = verbose
         self.file = file
@@ -61,20 +376,148 @@ class PoorMansViridic:
         self.nthreads = nthreads
         self.genus_threshold = genus_threshold
         self.species_threshold = species_threshold
+        self.lean_blast = lean_blast
+        # similarity thresholds of additional cluster levels, e.g. {"subfamily": 50}
+        self.extra_thresholds = extra_thresholds or {}
+        reserved = {"genus", "species"} & set(self.extra_thresholds)
+        if reserved:
+            raise ValueError(
+                f"The thresholds of {', '.join(sorted(reserved))} are not extra levels"
+            )
+        # PairCache with the identities of the pairs aligned in previous runs
+        self.pair_cache = pair_cache
+        # StageTrace of the classification, not recording when None
+        self.trace = trace or StageTrace(enabled=False)
+        # aligner computing the identities, blastn unless another one is given
+        self.aligner = aligner or BlastnAligner(file, nthreads, lean_blast, self.trace)
 
     def run(self):
         print(f"Running PoorMansViridic on {self.file}\n")
-        self.makeblastdb()
-        self.blastn()
-        self.parse_blastn_file()
-        self.calculate_distances()
-        self.cluster_all()
+        if self.pair_cache is None:
+            self.M, self.size_dict = self.align(self.file, self.file)
+        else:
+            self.align_with_cache()
+        with self.trace.stage(
+            "calculate_distances", genomes=len(self.size_dict), pairs=len(self.M)
+        ):
+            self.calculate_distances()
+        with self.trace.stage(
+            "cluster_all", genomes=len(self.size_dict), pairs=len(self.dfM)
+        ):
+            self.cluster_all()
         return self.dfT, self.pmv_outfile
 
+    def align(self, query, db, dbsize=None):
+        """Align genomes against a database of genomes with the aligner.
+        Args:
+            query (str): Path to the fasta file of the query genomes
+            db (str): Path to the fasta file of the database genomes
+            dbsize (int): Length of the database used for the e-values, when it is not db
+        Returns:
+            tuple: The identity of each pair of genomes and the size of each genome
+        """
+        with self.trace.stage("align", aligner=self.aligner.method) as stage:
+            M, size_dict = self.aligner.align(query, db, dbsize)
+            stage.update(genomes=len(size_dict), pairs=len(M))
+
+        return M, size_dict
+
+    def align_with_cache(self):
+        """Align only the pairs of genomes that are not in the pair cache.
+        The genomes whose pairs with the previous genomes of the file are all cached
+        are "cached" genomes, the others are "new" genomes. The new genomes are
+        aligned against all the genomes and the cached genomes against the new
+        ones, with the e-values computed for the whole file, then the pairs they
+        aligned are added to the cache. The files of the new and cached genomes are
+        named after a hash of their genomes, so that a resumed run only reuses the
+        alignments of the same split. The pairs are ordered by genome in the order
+        of the file.
+        """
+        with open(self.file) as fasta:
+            records = [(name.split()[0], seq) for name, seq in SimpleFastaParser(fasta)]
+
+        genomes = [name for name, _ in records]
+        keys = {name: self.pair_cache.genome_key(name, seq) for name, seq in records}
+        self.size_dict = {name: len(seq) for name, seq in records}
+
+        cached = self.pair_cache.get(list(keys.values()))
+
+        def is_cached(A, B):
+            return (keys[A], keys[B]) in cached
+
+        cached_genomes, new_genomes = [], []
+        for genome in genomes:
+            if is_cached(genome, genome) and all(
+                is_cached(genome, other) and is_cached(other, genome)
+                for other in cached_genomes
+            ):
+                cached_genomes.append(genome)
+            else:
+                new_genomes.append(genome)
+
+        print_ok(
+            f"{len(cached_genomes)} genomes have all their pairs cached, aligning {len(new_genomes)} genomes"
+        )
+
+        M = {}
+        if new_genomes and not cached_genomes:
+            M = self.align(self.file, self.file)[0]
+        elif new_genomes:
+            sequences = dict(records)
+            split = hashlib.sha1(
+                "\n".join(
+                    [keys[name] for name in new_genomes]
+                    + [""]
+                    + [keys[name] for name in cached_genomes]
+                ).encode()
+            ).hexdigest()[:16]
+            new_file = os.path.join(self.result_dir, f"new_genomes.{split}.fa")
+            cached_file = os.path.join(self.result_dir, f"cached_genomes.{split}.fa")
+            for path, names in ((new_file, new_genomes), (cached_file, cached_genomes)):
+                with open(path, "w") as fasta:
+                    for name in names:
+                        fasta.write(f">{name}\n{sequences[name]}\n")
+
+            M = self.align(new_file, self.file)[0]
+            M.update(
+                self.align(cached_file, new_file, dbsize=sum(self.size_dict.values()))[0]
+            )
+
+        # The pairs of cached genomes come from the cache
+        for A in cached_genomes:
+            for B in cached_genomes:
+                idAB = cached[(keys[A], keys[B])]
+                if idAB is not None:
+                    M[(A, B)] = idAB
+
+        # Only the pairs given to the aligner above are cached, a pair without hit
+        # as None: the new genomes against all of them and the cached genomes
+        # against the new ones
+        new_pairs = {}
+        for A in new_genomes:
+            for B in genomes:
+                new_pairs[(keys[A], keys[B])] = M.get((A, B))
+        for A in cached_genomes:
+            for B in new_genomes:
+                new_pairs[(keys[A], keys[B])] = M.get((A, B))
+        self.pair_cache.put(new_pairs)
+
+        # Order the pairs by genome, with the pair of a genome with itself first
+        order = {genome: i for i, genome in enumerate(genomes)}
+        self.M = {
+            pair: M[pair]
+            for pair in sorted(
+                M, key=lambda pair: (order[pair[0]], pair[0] != pair[1], order[pair[1]])
+            )
+        }
+
     def cluster_all(self):
-        dfTg = self.sim2cluster(self.genus_threshold, "genus")
-        dfTs = self.sim2cluster(self.species_threshold, "species")
-        dfT = pd.merge(dfTg, dfTs, on="genome").sort_values(
+        thresholds = {
+            "genus": self.genus_threshold,
+            "species": self.species_threshold,
+            **self.extra_thresholds,
+        }
+        dfT = self.sim2cluster(thresholds).sort_values(
             "species_cluster genus_cluster".split()
         )
         dfT.reset_index(drop=True, inplace=True)
@@ -84,243 +527,1133 @@ class PoorMansViridic:
         dfT.to_csv(self.pmv_outfile, index=False, sep="\t")
         self.dfT = dfT
 
-    def sim2cluster(self, th, tax_level):
-        ic("Generating graph for finding", tax_level, "clusters")
+    def sim2cluster(self, thresholds):
+        """Find the single-linkage clusters of genomes for several thresholds in one pass.
+        The pairs of genomes are added by decreasing similarity to a union-find, and the
+        clusters of a threshold are read once all the pairs above it have been added.
+        Clusters are numbered in the order their first genome appears in the pairs above
+        the threshold, genomes without such pairs are numbered last.
+        Args:
+            thresholds (dict): Similarity threshold of each level, e.g. {"genus": 70}
+        Returns:
+            pd.DataFrame: The cluster number of each genome at each level, ordered by the
+                clusters of the first level
+        """
+        ic("Finding clusters for", thresholds)
         M = self.dfM
-        G = nx.from_pandas_edgelist(
-            M[(M.sim >= th) & (M.A != M.B)], source="A", target="B"
+        codes, genomes = pd.factorize(pd.concat([M.A, M.B], ignore_index=True))
+        num_genomes = len(genomes)
+        A, B = codes[: len(M)], codes[len(M) :]
+        sim = M.sim.to_numpy()
+
+        # Pairs that can link two genomes, by decreasing similarity
+        edges = np.flatnonzero((A != B) & (sim >= min(thresholds.values())))
+        edges = edges[np.argsort(-sim[edges], kind="stable")]
+
+        parent = list(range(num_genomes))
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        levels = sorted(thresholds, key=thresholds.get, reverse=True)
+        roots = {}
+        edge = 0
+        for level in levels:
+            while edge < len(edges) and sim[edges[edge]] >= thresholds[level]:
+                root_A, root_B = find(A[edges[edge]]), find(B[edges[edge]])
+                if root_A != root_B:
+                    parent[root_A] = root_B
+                edge += 1
+            roots[level] = np.array([find(node) for node in range(num_genomes)])
+
+        L = {"genome": genomes}
+        order = {}
+        for level, th in thresholds.items():
+            # Order of first appearance of the genomes in the pairs above the threshold
+            linked = (A != B) & (sim >= th)
+            appearance = np.column_stack((A[linked], B[linked])).ravel()
+            first_seen = np.full(num_genomes, len(appearance)) + np.arange(num_genomes)
+            nodes, index = np.unique(appearance, return_index=True)
+            first_seen[nodes] = index
+
+            cluster_key = np.full(num_genomes, first_seen.max() + 1)
+            np.minimum.at(cluster_key, roots[level], first_seen)
+            L[f"{level}_cluster"] = (
+                np.unique(cluster_key[roots[level]], return_inverse=True)[1] + 1
+            )
+            order[level] = first_seen
+
+        first_level = next(iter(thresholds))
+        dfT = pd.DataFrame(L)
+        rows = np.lexsort((order[first_level], dfT[f"{first_level}_cluster"]))
+
+        return dfT.iloc[rows].reset_index(drop=True)
+
+    def calculate_distances(self):
+        M = self.M
+        size_dict = self.size_dict
+
+        dfM = pd.DataFrame(list(M.keys()), columns=["A", "B"])
+        idAB = np.fromiter(M.values(), dtype=np.int64, count=len(M))
+
+        # Map the genome names to integer ids
+        codes, names = pd.factorize(pd.concat([dfM.A, dfM.B], ignore_index=True))
+        num_genomes = len(names)
+        A, B = codes[: len(dfM)], codes[len(dfM) :]
+
+        # As the blast is double sided need to check the identity of both genomes by looking at the opposite pair
+        # The pair B, A is found by looking up its id among the ids of the pairs A, B
+        reverse_pair = pd.Index(A * num_genomes + B).get_indexer(B * num_genomes + A)
+
+        # If the pair B, A does not exist then the identity of the pair A, B is used
+        idBA = np.where(reverse_pair >= 0, idAB[reverse_pair], idAB)
+
+        # Size of the genomes
+        sizes = np.array([size_dict[name] for name in names], dtype=np.int64)
+        lA, lB = sizes[A], sizes[B]
+
+        # Calculate the similarity
+        simAB = ((idAB + idBA) * 100) / (lA + lB)
+
+        # Calculate the distance
+        dfM["distAB"] = 100 - simAB
+
+        # Calculate the aligned fraction of the genome
+        dfM["afg1"] = idAB / lA
+        dfM["afg2"] = idBA / lB
+        dfM["glr"] = np.minimum(lA, lB) / np.maximum(lA, lB)
+
+        # Calculate the similarity
+        dfM["sim"] = 100 - dfM.distAB
+
+        # Remove the duplicate pairs, whatever the order of the genomes
+        ordered_pair = np.minimum(A, B) * num_genomes + np.maximum(A, B)
+        dfM = dfM[~pd.Series(ordered_pair).duplicated().to_numpy()].reset_index(drop=True)
+
+        self.dfM = dfM
+
+    def save_similarities(self, outfile="similarities.tsv"):
+        df = self.dfM[["A", "B", "sim"]]
+        df = df[df.A != df.B]
+        df.sort_values("sim", ascending=False, inplace=True)
+        df.index.name = ""
+        df.to_csv(outfile, index=False, sep="\t")
+        self.dfM.sort_values("sim", ascending=False).to_csv(
+            outfile + ".dfM.tsv", index=False, sep="\t"
         )
-        singletons = list(set(M.A.unique().tolist()).difference(G.nodes()))
-        G.add_nodes_from(singletons)
 
-        graphs = [G.subgraph(x) for x in nx.connected_components(G)]
-        L = []
-        for n, g in enumerate(graphs):
-            L.extend([(node, n + 1) for node in g.nodes()])
 
-        return pd.DataFrame(L, columns=f"genome {tax_level}_cluster".split())
+class BlastnAligner:
+    """Compute the identities of PoorMansViridic with makeblastdb and blastn.
+    Any other aligner has a method name, used to store its pairs in the PairCache,
+    and the same align() method returning the identity of each pair of genomes,
+    with the pairs of a genome with itself when it is also in the database.
+    """
+
+    method = "blastn"
+
+    def __init__(self, file, nthreads=1, lean_blast=False, trace=None):
+        self.file = file
+        self.result_dir = os.path.dirname(self.file)
+        self.nthreads = nthreads
+        self.lean_blast = lean_blast
+        self.trace = trace or StageTrace(enabled=False)
+        # bytes of blastn output read at once by parse_blastn_output
+        self.batch_size = 64 * 1024
+
+    def align(self, query, db, dbsize=None):
+        """Align genomes against a database of genomes with blastn.
+        Args:
+            query (str): Path to the fasta file of the query genomes
+            db (str): Path to the fasta file of the database genomes
+            dbsize (int): Length of the database used for the e-values, when it is not db
+        Returns:
+            tuple: The identity of each pair of genomes and the size of each genome
+        """
+        self.makeblastdb(db)
+        outfile = None if self.lean_blast else self.blastn_outfile(query, db)
+
+        if outfile and os.path.exists(outfile):
+            self.blastn_result_file = outfile
+            return self.parse_blastn_file()
+
+        shards = self.split_query(query)
+        nthreads = max(1, int(self.nthreads) // len(shards))
+        if outfile and len(shards) > 1:
+            shard_outfiles = [
+                outfile[: -len(".tab.gz")] + f".shard{i}.tab.gz"
+                for i in range(len(shards))
+            ]
+        else:
+            shard_outfiles = [outfile] * len(shards)
+
+        def align_shard(shard, shard_outfile):
+            if self.lean_blast:
+                return self.blastn_lean(shard, db, dbsize, nthreads)
+            self.blastn(shard, db, dbsize, shard_outfile, nthreads)
+            return self.parse_blastn_file(shard_outfile)
+
+        # The shards are aligned and parsed concurrently, the blastn processes
+        # running outside the GIL, and merged in the order of the query file
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            results = list(executor.map(align_shard, shards, shard_outfiles))
+
+        M, size_dict = {}, {}
+        for shard_M, shard_size_dict in results:
+            M.update(shard_M)
+            size_dict.update(shard_size_dict)
+
+        if len(shards) > 1:
+            for shard in shards:
+                os.remove(shard)
+            if outfile:
+                # Concatenated gzip members are read as a single file
+                with open(f"{outfile}.part", "wb") as f_out:
+                    for shard_outfile in shard_outfiles:
+                        with open(shard_outfile, "rb") as f_in:
+                            shutil.copyfileobj(f_in, f_out)
+                os.replace(f"{outfile}.part", outfile)
+                for shard_outfile in shard_outfiles:
+                    os.remove(shard_outfile)
+
+        if outfile:
+            self.blastn_result_file = outfile
+
+        return M, size_dict
+
+    def split_query(self, query):
+        """Split the query genomes into one shard per thread, for blastn to run on
+        each shard concurrently. The shards are contiguous in the order of the file
+        and have about the same total length.
+        Args:
+            query (str): Path to the fasta file of the query genomes
+        Returns:
+            list: Paths to the fasta files of the shards, only query when not split
+        """
+        with open(query) as fasta:
+            records = list(SimpleFastaParser(fasta))
+
+        num_shards = min(int(self.nthreads), len(records))
+        if num_shards <= 1:
+            return [query]
+
+        lengths = np.array([len(seq) for _, seq in records], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        shard_of = starts * num_shards // max(1, lengths.sum())
+
+        shards = []
+        for shard_index in np.unique(shard_of):
+            shard = os.path.join(
+                self.result_dir, f"{os.path.basename(query)}.shard{len(shards)}.fa"
+            )
+            with open(shard, "w") as f_out:
+                for i in np.flatnonzero(shard_of == shard_index):
+                    name, seq = records[i]
+                    f_out.write(f">{name}\n{seq}\n")
+            shards.append(shard)
+
+        ic(f"Split {query} in {len(shards)} shards")
+
+        return shards
 
-    def makeblastdb(self):
+    def makeblastdb(self, db):
         # Find all the files created by makeblastdb and remove them
-        for filename in glob.glob(f"{self.file}*.n*"):
+        for filename in glob.glob(f"{db}*.n*"):
             os.remove(filename)
 
-        cmd = f"makeblastdb -in {self.file}  -dbtype nucl"
+        cmd = f"makeblastdb -in {db}  -dbtype nucl"
         ic("Creating blastn database:", cmd)
-        res = subprocess.getoutput(cmd)
+        with self.trace.stage("makeblastdb", bytes=os.path.getsize(db)):
+            res = subprocess.getoutput(cmd)
         ic(res)
 
-    def blastn(self):
-        outfile = os.path.join(
-            self.result_dir, os.path.basename(self.file) + ".blastn_vs2_self.tab.gz"
+    def blastn_cmd(self, query, db, outfmt, dbsize=None, nthreads=None):
+        nthreads = nthreads or self.nthreads
+        cmd = f'blastn -evalue 1 -max_target_seqs 10000 -num_threads {nthreads} -word_size 7 -reward 2 -penalty -3 -gapopen 5 -gapextend 2 -query {query} -db {db} -outfmt "6 {outfmt}"'
+        if dbsize:
+            cmd += f" -dbsize {dbsize}"
+        return cmd
+
+    def blastn_outfile(self, query, db):
+        if query == db:
+            return os.path.join(
+                self.result_dir, os.path.basename(query) + ".blastn_vs2_self.tab.gz"
+            )
+        return os.path.join(
+            self.result_dir,
+            f"{os.path.basename(query)}.blastn_vs_{os.path.basename(db)}.tab.gz",
         )
+
+    def blastn(self, query, db, dbsize=None, outfile=None, nthreads=None):
+        outfile = outfile or self.blastn_outfile(query, db)
         if not os.path.exists(outfile):
-            cmd = f'blastn -evalue 1 -max_target_seqs 10000 -num_threads {self.nthreads} -word_size 7 -reward 2 -penalty -3 -gapopen 5 -gapextend 2 -query {self.file} -db {self.file} -outfmt "6 qseqid sseqid pident length qlen slen mismatch nident gapopen qstart qend sstart send qseq sseq evalue bitscore" | gzip -c > {outfile}'
-            ic("Blasting against itself:", cmd)
-            ic(cmd)
-            subprocess.getoutput(cmd)
+            blastn_cmd = self.blastn_cmd(
+                query, db, " ".join(BLASTN_COLUMNS), dbsize, nthreads
+            )
+            ic("Blasting against itself:", blastn_cmd)
+
+            # The output is only moved in place once blastn succeeded, an
+            # interrupted run leaves a .part file which is written again
+            with self.trace.stage(
+                "blastn", query_bytes=os.path.getsize(query)
+            ) as stage, open(f"{outfile}.part", "wb") as f_out:
+                blastn = subprocess.Popen(blastn_cmd, shell=True, stdout=subprocess.PIPE)
+                subprocess.run(["gzip", "-c"], stdin=blastn.stdout, stdout=f_out, check=True)
+                blastn.stdout.close()
+                if blastn.wait():
+                    raise subprocess.CalledProcessError(blastn.returncode, blastn_cmd)
+                stage["bytes"] = f_out.tell()
+            os.replace(f"{outfile}.part", outfile)
 
         self.blastn_result_file = outfile
 
-    def parse_blastn_file(self):
-        ic("Reading", self.blastn_result_file)
+    def blastn_lean(self, query, db, dbsize=None, nthreads=None):
+        """Run blastn with the alignments encoded as btop and parse its output
+        while it is produced, without writing it to disk.
+        The self hits are not read, when the database is the whole file each query
+        gets an identity equal to its length with itself instead.
+        """
+        cmd = self.blastn_cmd(
+            query, db, " ".join(LEAN_BLASTN_COLUMNS), dbsize, nthreads
+        )
+        ic("Blasting against itself:", cmd)
+
+        with self.trace.stage(
+            "blastn_lean", query_bytes=os.path.getsize(query)
+        ) as stage, subprocess.Popen(
+            cmd, shell=True, stdout=subprocess.PIPE
+        ) as process:
+            M, size_dict = self.parse_blastn_output(
+                process.stdout,
+                columns=LEAN_BLASTN_COLUMNS,
+                skip_self_hits=True,
+                stage=stage,
+            )
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
 
-        num_lines = rawgencount(self.blastn_result_file)
+        if db == self.file:
+            M = self.add_self_pairs(M, size_dict, query)
 
-        self.size_dict = {}
-        M = {}
+        return M, size_dict
+
+    def parse_blastn_file(self, blastn_result_file=None):
+        blastn_result_file = blastn_result_file or self.blastn_result_file
+        ic("Reading", blastn_result_file)
 
-        previous_pair = ""
+        with self.trace.stage(
+            "parse_blastn_file", compressed_bytes=os.path.getsize(blastn_result_file)
+        ) as stage, gzip.open(blastn_result_file, "rb") as df:
+            return self.parse_blastn_output(df, stage=stage)
 
-        with gzip.open(self.blastn_result_file, "rt") as df:
-            genome_name = os.path.dirname(self.file).split("/")[-1]
-            for line in tqdm(
-                df, desc=f"{genome_name}: Blast reading:", total=num_lines, leave=False
+    def parse_blastn_output(
+        self, handle, columns=BLASTN_COLUMNS, skip_self_hits=False, stage=None
+    ):
+        """Compute the identity of each pair of genomes from a blastn output.
+        Args:
+            handle (file): Tabular blastn output opened in binary mode
+            columns (list): The columns of the blastn output
+            skip_self_hits (bool): Ignore the hits of a genome against itself
+            stage (dict): Trace record of the stage, given the number of HSPs
+                and bytes read
+        Returns:
+            tuple: The identity of each pair of genomes and the size of each genome
+        """
+        coverage = IdentityCoverage()
+        hsps = total_bytes = 0
+
+        genome_name = os.path.dirname(self.file).split("/")[-1]
+        with tqdm(
+            desc=f"{genome_name}: Blast reading:",
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            leave=False,
+        ) as progress:
+            for batch, num_hsps, num_bytes in read_blastn_batches(
+                handle, self.batch_size, columns, skip_self_hits
             ):
-                # do something with the line
-                (
-                    qseqid,
-                    sseqid,
-                    pident,
-                    length,
-                    qlen,
-                    slen,
-                    mismatch,
-                    nident,
-                    gapopen,
-                    qstart,
-                    qend,
-                    sstart,
-                    send,
-                    qseq,
-                    sseq,
-                    evalue,
-                    bitscore,
-                ) = line.rstrip().split()
-                key = (qseqid, sseqid)
-
-                # if the key is different from the previous one, convert identity vector to identity values
-                if key != previous_pair:
-                    # only do it if the previous key is not empty (first iteration)
-                    if previous_pair:
-                        M[previous_pair] = np.where(M[previous_pair] != 0, 1, 0)
-                        M[previous_pair] = np.sum(M[previous_pair])
-
-                    previous_pair = key
-
-                M.setdefault(key, np.zeros(int(qlen)))
-
-                if qseqid not in self.size_dict:
-                    self.size_dict[qseqid] = int(qlen)
-                if sseqid not in self.size_dict:
-                    self.size_dict[sseqid] = int(slen)
-
-                # convert the strings to numpy arrays
-                qseq = np.frombuffer(qseq.encode("utf-8"), dtype="S1")
-                sseq = np.frombuffer(sseq.encode("utf-8"), dtype="S1")
-
-                v = np.where(qseq == sseq, 1, 0)
-
-                # find the indices of elements that are not equal to '-'. Here it is b'-' because the array is of type bytes.
-                idx = qseq != b"-"
-
-                # add the values to the matrix
-                M[key][int(qstart) - 1 : int(qend)] += v[idx]
-
-        # Convert the last pair of the matrix to identity values
-        M[previous_pair] = np.where(M[previous_pair] != 0, 1, 0)
-        M[previous_pair] = np.sum(M[previous_pair])
-
-        self.M = M
+                hsps += num_hsps
+                total_bytes += num_bytes
+                coverage.add_batch(batch)
+                progress.update(num_bytes)
+
+        if stage is not None:
+            stage.update(hsps=hsps, bytes=total_bytes)
+
+        return coverage.close(), coverage.size_dict
+
+    def add_self_pairs(self, M, size_dict, query):
+        """Add the pair of each query genome with itself, with an identity equal to its length.
+        The pairs are inserted before the first pair of their genome in the fasta order,
+        where blastn would have reported the self hit.
+        Args:
+            M (dict): The identity of each pair of genomes
+            size_dict (dict): The size of each genome, updated with the query genomes
+            query (str): Path to the fasta file of the query genomes
+        Returns:
+            dict: The identities with the self pairs
+        """
+        with open(query) as fasta:
+            sizes = {name.split()[0]: len(seq) for name, seq in SimpleFastaParser(fasta)}
+
+        size_dict.update(sizes)
+
+        genomes = iter(sizes)
+        M_self = {}
+        for (A, B), idAB in M.items():
+            if (A, A) not in M_self:
+                for genome in genomes:
+                    M_self[(genome, genome)] = sizes[genome]
+                    if genome == A:
+                        break
+            M_self[(A, B)] = idAB
+
+        for genome in genomes:
+            M_self[(genome, genome)] = sizes[genome]
+
+        return M_self
+
+
+class KmerAligner:
+    """Estimate the identities of PoorMansViridic in-process, without BLAST.
+    The k-mers shared by two genomes, on both strands, are used as anchors.
+    Anchors on the same diagonal that are close to each other are chained, the
+    chains are extended without gaps on both sides, and the positions of a chain
+    where both genomes have the same base are counted as identical, as the
+    identical positions of the blastn HSPs would be.
+    """
 
-    def calculate_distances(self):
-        M = self.M
-        size_dict = self.size_dict
+    method = "kmer"
+
+    def __init__(self, nthreads=1, k=11, max_gap=200, batch_length=4_000_000):
+        self.nthreads = int(nthreads)
+        self.k = k
+        # largest distance between two anchors of the same chain
+        self.max_gap = max_gap
+        # chains shorter than this are random matches
+        self.min_chain = 2 * k
+        # chains with a lower fraction of identical positions are random matches
+        self.min_identity = 0.5
+        # total length of the database genomes indexed at once
+        self.batch_length = batch_length
+
+    def align(self, query, db, dbsize=None):
+        """Align genomes against a database of genomes.
+        Args:
+            query (str): Path to the fasta file of the query genomes
+            db (str): Path to the fasta file of the database genomes
+            dbsize (int): Not used, only the blastn e-values depend on it
+        Returns:
+            tuple: The identity of each pair of genomes and the size of each genome
+        """
+        queries = self.read_genomes(query)
+        subjects = queries if db == query else self.read_genomes(db)
+        size_dict = {name: len(codes) for name, codes in queries.items()}
+        size_dict.update({name: len(codes) for name, codes in subjects.items()})
+
+        batches = self.index_genomes(subjects)
+
+        M = {}
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            results = executor.map(
+                lambda genome: self.align_genome(*genome, subjects, batches),
+                queries.items(),
+            )
+            for pairs in tqdm(
+                results, desc="K-mer alignment", total=len(queries), leave=False
+            ):
+                M.update(pairs)
+
+        return M, size_dict
+
+    def read_genomes(self, fasta_path):
+        """Read the genomes of a fasta file as arrays of base codes."""
+        with open(fasta_path) as fasta:
+            return {
+                name.split()[0]: BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+                for name, seq in SimpleFastaParser(fasta)
+            }
+
+    def index_genomes(self, genomes):
+        """Index the k-mers of both strands of the genomes, by batches of genomes.
+        Returns:
+            list: For each batch, the names of its genomes, its strands joined
+                together, where they start, the genome of each strand and the
+                sorted k-mers with their positions
+        """
+        batches, batch = [], []
+        length = 0
+        for name, codes in genomes.items():
+            if batch and length + len(codes) > self.batch_length:
+                batches.append(batch)
+                batch, length = [], 0
+            batch.append(name)
+            length += len(codes)
+        if batch:
+            batches.append(batch)
+
+        indexes = []
+        for names in batches:
+            strands = []
+            for name in names:
+                codes = genomes[name]
+                reverse = codes[::-1]
+                # strands are separated by a code 4, so no k-mer spans two of them
+                strands += [codes, [4], np.where(reverse < 4, 3 - reverse, 4), [4]]
+            seq = np.concatenate(strands).astype(np.uint8)
+            lengths = np.array([len(strand) for strand in strands[::2]]) + 1
+            starts = np.cumsum(lengths) - lengths
+
+            values = kmer_values(seq, self.k)
+            positions = np.flatnonzero(values >= 0)
+            order = np.argsort(values[positions])
+            values, positions = values[positions][order], positions[order]
+
+            # The k-mers repeated in most genomes only add random anchors
+            counts = np.diff(
+                np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1, [len(values)]))
+            )
+            repeated = np.repeat(counts > 2 * len(starts), counts)
+
+            indexes.append(
+                {
+                    "names": names,
+                    "seq": seq,
+                    "starts": starts,
+                    "genome": np.repeat(np.arange(len(names)), 2),
+                    "values": values[~repeated],
+                    "positions": positions[~repeated],
+                }
+            )
+
+        return indexes
+
+    def extension(self, codes, seq, positions, d, step):
+        """Length of the ungapped extension of chains, scored as blastn does.
+        Args:
+            codes (np.ndarray): Bases of the query genome
+            seq (np.ndarray): Bases of the database strands
+            positions (np.ndarray): First position of the query to extend for each chain
+            d (np.ndarray): Diagonal of each chain
+            step (int): 1 to extend to the right, -1 to the left
+        Returns:
+            np.ndarray: Number of positions added to each chain
+        """
+        p = positions[:, None] + step * np.arange(self.max_gap)
+        q = p + d[:, None]
+        query_bases = codes[np.clip(p, 0, len(codes) - 1)]
+        db_bases = seq[np.clip(q, 0, len(seq) - 1)]
+
+        # The extension stops at the end of a genome and at a base that is not ACGT
+        valid = (p >= 0) & (p < len(codes)) & (query_bases < 4) & (db_bases < 4)
+        valid = np.logical_and.accumulate(valid, axis=1)
+
+        score = np.where(query_bases == db_bases, 2, -3)
+        score = np.cumsum(np.where(valid, score, -3 * self.max_gap), axis=1)
+
+        # Stop where the score is the highest, not extending when it is never positive
+        best = score.argmax(axis=1)
+        return np.where(score[np.arange(len(best)), best] > 0, best + 1, 0)
+
+    def align_genome(self, name, codes, subjects, batches):
+        """Identities of a query genome with each database genome, as ordered pairs."""
+        k = self.k
+        values = kmer_values(codes, self.k)
+        # sorted k-mers are looked up faster
+        query_positions = np.flatnonzero(values >= 0)
+        query_positions = query_positions[np.argsort(values[query_positions])]
+        values = values[query_positions]
+
+        identities = {}
+        for batch in batches:
+            left = np.searchsorted(batch["values"], values, side="left")
+            counts = np.searchsorted(batch["values"], values, side="right") - left
+            total = counts.sum()
+            if total == 0:
+                continue
+
+            # Anchors: position in the query, position in the strands
+            i = np.repeat(query_positions, counts)
+            j = batch["positions"][
+                np.repeat(left - (np.cumsum(counts) - counts), counts)
+                + np.arange(total)
+            ]
+            strand = np.searchsorted(batch["starts"], j, side="right") - 1
+            genome = batch["genome"][strand]
+
+            # The pair of a genome with itself is not aligned
+            not_self = np.array([subject != name for subject in batch["names"]])
+            anchors = not_self[genome]
+            i, strand, d = i[anchors], strand[anchors], (j - i)[anchors]
+            if len(i) == 0:
+                continue
+
+            # Chain the anchors of the same diagonal that are close to each other
+            order = np.lexsort((i, d, strand))
+            i, d, strand = i[order], d[order], strand[order]
+            new_chain = np.ones(len(i), dtype=bool)
+            new_chain[1:] = (
+                (strand[1:] != strand[:-1])
+                | (d[1:] != d[:-1])
+                | (i[1:] - i[:-1] > self.max_gap)
+            )
+            first = np.flatnonzero(new_chain)
+            last = np.append(first[1:], len(i)) - 1
+
+            chain_start = i[first]
+            chain_length = i[last] + k - chain_start
+            chains = chain_length >= self.min_chain
+            chain_start, chain_length = chain_start[chains], chain_length[chains]
+            chain_d, chain_strand = d[first][chains], strand[first][chains]
+            if len(chain_start) == 0:
+                continue
+
+            # Extend the chains on both sides without gaps
+            left = self.extension(codes, batch["seq"], chain_start - 1, chain_d, -1)
+            right = self.extension(
+                codes, batch["seq"], chain_start + chain_length, chain_d, 1
+            )
+            chain_start = chain_start - left
+            chain_length = chain_length + left + right
+
+            # Compare the genomes along each chain
+            total = chain_length.sum()
+            chain_offset = np.cumsum(chain_length) - chain_length
+            p = np.repeat(chain_start - chain_offset, chain_length) + np.arange(total)
+            q = p + np.repeat(chain_d, chain_length)
+            same = (codes[p] == batch["seq"][q]) & (codes[p] < 4)
+
+            # Chains between random anchors are mostly mismatches
+            chains = np.add.reduceat(same, chain_offset) >= self.min_identity * chain_length
+            same &= np.repeat(chains, chain_length)
+
+            # The positions of the query are only counted once per database genome
+            genomes, genome = np.unique(
+                batch["genome"][chain_strand], return_inverse=True
+            )
+            identical = np.zeros((len(genomes), len(codes)), dtype=bool)
+            identical[np.repeat(genome, chain_length)[same], p[same]] = True
+
+            for subject, count in zip(genomes, identical.sum(axis=1)):
+                if count:
+                    identities[batch["names"][subject]] = int(count)
+
+        pairs = {}
+        if name in subjects:
+            pairs[(name, name)] = len(codes)
+        for subject in subjects:
+            if subject in identities:
+                pairs[(name, subject)] = identities[subject]
+
+        return pairs
 
-        genome_arr = np.array(list(M.keys()))
-        
-        dfM = pd.DataFrame(
-            genome_arr, columns=["A", "B"]
+
+def read_blastn_batches(
+    handle, batch_size, columns=BLASTN_COLUMNS, skip_self_hits=False
+):
+    """Read the tabular output of blastn by batches of lines. The fields are
+    located in the bytes read with numpy, and the alignments are taken from them
+    as arrays of bytes, without building a string per field.
+    Args:
+        handle (file): Opened blastn output in binary mode, can be a pipe
+        batch_size (int): Approximate number of bytes read per batch
+        columns (list): The columns of the blastn output
+        skip_self_hits (bool): Leave out the hits of a genome against itself
+    Yields:
+        tuple: The HSPs of the batch as a dict of arrays, see parse_blastn_batch,
+            the number of HSPs and the number of bytes read
+    """
+    rest = b""
+    while True:
+        chunk = handle.read(batch_size)
+        data = rest + chunk
+        if not data:
+            return
+
+        # The batch stops at the end of its last complete line
+        if not chunk and not data.endswith(b"\n"):
+            data += b"\n"
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            rest = data
+            continue
+        rest = data[end:]
+
+        yield (
+            *parse_blastn_batch(memoryview(data)[:end], columns, skip_self_hits),
+            end,
         )
 
-        dfM["idAB"] = M.values()
 
-        # creating a dictionary of genome name identity
-        # As the blast is double sided need to check the identity of both genomes by looking at the opposite pair
-        dict_BA = dfM.set_index(["A", "B"]).idAB.to_dict()
+def parse_blastn_batch(data, columns, skip_self_hits=False):
+    """Locate the fields of complete lines of tabular blastn output.
+    Args:
+        data (memoryview): Lines of blastn output, each ending with a newline
+        columns (list): The columns of the blastn output
+        skip_self_hits (bool): Leave out the hits of a genome against itself
+    Returns:
+        tuple: The HSPs as a dict with the qseqid and sseqid of each HSP as bytes,
+            its qlen, slen and qstart, and either its aligned qseq and sseq or its
+            btop, each followed by a separator, concatenated in arrays of bytes with
+            the length of each HSP. And the number of HSPs read
+    """
+    text = np.frombuffer(data, dtype=np.uint8)
+    separators = np.flatnonzero((text == ord("\t")) | (text == ord("\n")))
+    if len(separators) % len(columns) or (
+        len(separators) and not (text[separators[len(columns) - 1 :: len(columns)]] == ord("\n")).all()
+    ):
+        raise ValueError(f"The blastn output does not have the {len(columns)} columns {' '.join(columns)}")
+
+    # start and end of each field, one row per HSP
+    ends = separators.reshape(-1, len(columns))
+    starts = np.empty_like(ends)
+    starts.ravel()[0] = 0
+    starts.ravel()[1:] = ends.ravel()[:-1] + 1
+    num_hsps = len(ends)
+
+    def field(column):
+        return starts[:, columns.index(column)], ends[:, columns.index(column)]
+
+    def names(column):
+        return [bytes(data[i:j]) for i, j in zip(*(x.tolist() for x in field(column)))]
+
+    qseqid, sseqid = names("qseqid"), names("sseqid")
+    if skip_self_hits:
+        keep = np.array([a != b for a, b in zip(qseqid, sseqid)], dtype=bool)
+        starts, ends = starts[keep], ends[keep]
+        qseqid = [a for a, kept in zip(qseqid, keep) if kept]
+        sseqid = [b for b, kept in zip(sseqid, keep) if kept]
+
+    batch = {"qseqid": qseqid, "sseqid": sseqid}
+    for column in ("qlen", "slen", "qstart"):
+        batch[column] = parse_integers(text, *field(column))
+
+    for column in ("qseq", "sseq", "btop"):
+        if column in columns:
+            start, end = field(column)
+            # The fields keep the separator after them, so that the numbers of the
+            # btop strings and the runs of identical bases stop at the end of an HSP
+            end = end + 1
+            batch[column] = np.frombuffer(
+                b"".join([data[i:j] for i, j in zip(start.tolist(), end.tolist())]),
+                dtype=np.uint8,
+            )
+            batch["lengths"] = end - start
 
-        # Creating the pair of genomes in order B, A
-        dfM["pair_BA"] = dfM.apply(lambda x: (x.B, x.A), axis=1)
+    return batch, num_hsps
 
-        # Setting the identity of the pair B, A
-        dfM["idBA"] = dfM.pair_BA.map(dict_BA)
 
-        # If the identity of the pair B, A is NaN then the pair is A, B
-        dfM.loc[dfM.idBA.isna(), "idBA"] = dfM.loc[dfM.idBA.isna(), "idAB"]
+def parse_integers(text, starts, ends):
+    """Parse fields of unsigned integers located in an array of bytes.
+    Args:
+        text (np.ndarray): The bytes
+        starts (np.ndarray): Start of each field
+        ends (np.ndarray): End of each field, excluded
+    Returns:
+        np.ndarray: The integer of each field
+    """
+    lengths = ends - starts
+    if not len(lengths):
+        return np.zeros(0, dtype=np.int64)
 
-        # Map the size of the genome to the dataframe
-        dfM["lA"] = dfM["A"].map(size_dict)
-        dfM["lB"] = dfM["B"].map(size_dict)
+    offsets = np.arange(lengths.max())
+    digits = text[np.minimum(starts[:, None] + offsets, ends[:, None] - 1)].astype(np.int64) - ord("0")
+    power = lengths[:, None] - 1 - offsets
 
-        # Calculate the similarity
-        dfM["simAB"] = ((dfM.idAB + dfM.idBA) * 100) / (dfM.lA + dfM.lB)
+    return np.where(power >= 0, digits * 10 ** np.maximum(power, 0), 0).sum(axis=1)
 
-        # Calculate the distance
-        dfM["distAB"] = 100 - dfM.simAB
 
-        # Calculate the aligned fraction of the genome
-        dfM["afg1"] = dfM.idAB / dfM.lA
-        dfM["afg2"] = dfM.idBA / dfM.lB
-        dfM["glr"] = dfM[["lA", "lB"]].min(axis=1) / dfM[["lA", "lB"]].max(axis=1)
+def identical_runs(qstart, qseq, sseq, lengths):
+    """Find the runs of query bases aligned to identical bases in a batch of HSPs.
+    Args:
+        qstart (np.ndarray): Start of each HSP on the query (1-based)
+        qseq (np.ndarray): Aligned query sequences of the HSPs, each followed by a
+            separator, as concatenated bytes
+        sseq (np.ndarray): Aligned subject sequences of the HSPs, each followed by a
+            separator, as concatenated bytes
+        lengths (np.ndarray): Length of the alignment of each HSP, with its separator
+    Returns:
+        tuple: The 0-based start and end (excluded) of each run on the query, and
+            the HSP of each run
+    """
+    starts = np.cumsum(lengths) - lengths
+
+    # The gaps ("-") and the separators sort before the bases
+    identical = (qseq == sseq) & (qseq > ord("-"))
+    edges = np.flatnonzero(np.diff(identical, prepend=False))
+    run_starts, run_ends = edges[0::2], edges[1::2]
+    run_hsps = np.searchsorted(starts, run_starts, side="right") - 1
+
+    # query bases before each run, from the start of its HSP
+    gaps = np.flatnonzero(qseq == ord("-"))
+    gaps_before = np.searchsorted(gaps, run_starts) - np.searchsorted(
+        gaps, starts[run_hsps]
+    )
+    run_first = qstart[run_hsps] - 1 + run_starts - starts[run_hsps] - gaps_before
 
-        # Calculate the similarity
-        dfM["sim"] = 100 - dfM.distAB
+    return run_first, run_first + run_ends - run_starts, run_hsps
 
-        # Remove the duplicate pairs
-        dfM["ordered_pair"] = dfM.apply(lambda x: str(sorted(x.pair_BA)), axis=1)
-        dfM = dfM.drop_duplicates("ordered_pair").reset_index(drop=True)
-
-        # Remove the columns that are not needed
-        dfM = dfM.drop(
-            columns=[
-                "pair_BA",
-                "idAB",
-                "idBA",
-                "lA",
-                "lB",
-                "simAB",
-                "ordered_pair",
-            ]
-        )
 
-        self.dfM = dfM
+def btop_identical_runs(qstart, btop, lengths):
+    """Find the runs of query bases aligned to identical bases in a batch of HSPs
+    described by their BLAST trace-back operations (btop). In a btop string a number
+    is a run of identical bases and a pair of letters is a mismatch or a gap, with
+    the query letter first.
+    Args:
+        qstart (np.ndarray): Start of each HSP on the query (1-based)
+        btop (np.ndarray): btop strings of the HSPs, each followed by a separator,
+            as concatenated bytes
+        lengths (np.ndarray): Length of the btop string of each HSP, with its separator
+    Returns:
+        tuple: The 0-based start and end (excluded) of each run on the query, and
+            the HSP of each run
+    """
+    text = btop
+    starts = np.cumsum(lengths) - lengths
+
+    is_digit = (text >= ord("0")) & (text <= ord("9"))
+    # the separators are tabs or newlines
+    is_letter = ~is_digit & (text > ord(" "))
+
+    # runs of identical bases, written as numbers
+    is_run_start = is_digit & ~np.concatenate(([False], is_digit[:-1]))
+    run_starts = np.flatnonzero(is_run_start)
+    digit_ids = (np.cumsum(is_run_start) - 1)[is_digit]
+    digit_values = (text[is_digit] - ord("0")).astype(np.int64)
+    # power of ten of each digit, counted from the last digit of its number
+    run_ends = np.flatnonzero(np.diff(digit_ids, append=len(run_starts)))
+    power = run_ends[digit_ids] - np.arange(len(digit_ids))
+    run_lengths = np.bincount(
+        digit_ids, weights=digit_values * 10**power, minlength=len(run_starts)
+    ).astype(np.int64)
+
+    # bases advanced on the query by each operation
+    advance = np.zeros(len(text), dtype=np.int64)
+    advance[run_starts] = run_lengths
+    query_letters = np.flatnonzero(is_letter)[::2]
+    advance[query_letters] = text[query_letters] != ord("-")
+
+    # offset of each run from the start of its HSP
+    offset = np.cumsum(advance)
+    offset_before = np.where(starts > 0, offset[starts - 1], 0)
+    run_hsps = np.searchsorted(starts, run_starts, side="right") - 1
+    run_first = qstart[run_hsps] - 1 + offset[run_starts] - run_lengths - offset_before[run_hsps]
+
+    return run_first, run_first + run_lengths, run_hsps
+
+
+class PairCache:
+    """On-disk cache of the identities computed by PoorMansViridic, so that the pairs
+    of reference genomes are aligned only once across queries and runs.
+    A genome is identified by its name and the hash of its sequence. An identity of
+    None records a pair that was aligned without any hit.
+    """
 
-    def save_similarities(self, outfile="similarities.tsv"):
-        df = self.dfM[["A", "B", "sim"]]
-        df = df[df.A != df.B]
-        df.sort_values("sim", ascending=False, inplace=True)
-        df.index.name = ""
-        df.to_csv(outfile, index=False, sep="\t")
-        self.dfM.sort_values("sim", ascending=False).to_csv(
-            outfile + ".dfM.tsv", index=False, sep="\t"
+    def __init__(self, path, method="blastn"):
+        create_folder(os.path.dirname(path))
+        self.method = method
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pairs (method TEXT, a TEXT, b TEXT, idAB INTEGER, PRIMARY KEY (method, a, b))"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def genome_key(name, seq):
+        return f"{name}:{hashlib.sha1(seq.upper().encode()).hexdigest()}"
+
+    def get(self, keys):
+        """Get the cached pairs between a set of genomes.
+        Args:
+            keys (list): Keys of the genomes
+        Returns:
+            dict: The identity of each cached pair, keyed by the genome keys
+        """
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS genomes (key TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM genomes")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO genomes VALUES (?)", ((key,) for key in keys)
+        )
+        rows = self.connection.execute(
+            "SELECT a, b, idAB FROM pairs WHERE method = ? AND a IN genomes AND b IN genomes",
+            (self.method,),
         )
+        return {(a, b): idAB for a, b, idAB in rows}
+
+    def put(self, pairs):
+        """Add pairs to the cache.
+        Args:
+            pairs (dict): The identity of each pair, keyed by the genome keys
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?)",
+                (
+                    (self.method, a, b, None if idAB is None else int(idAB))
+                    for (a, b), idAB in pairs.items()
+                ),
+            )
 
+    def close(self):
+        self.connection.close()
 
-def _make_gen(reader):
-    """Generator to read a file piece by piece.
-    Default chunk size: 1k.
+
+def merge_intervals(starts, ends):
+    """Union of [start, end) intervals.
     Args:
-        reader (func): Function to read a piece of the file.
-    Yields:
-        generator: A generator object that yields pieces of the file.
+        starts (np.ndarray): Start of each interval
+        ends (np.ndarray): End of each interval, excluded
+    Returns:
+        tuple: The starts and ends of the disjoint intervals of the union, sorted
+    """
+    if not len(starts):
+        return starts, ends
+
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    # an interval starts a new one of the union when it begins after the ends
+    # of all the intervals before it
+    ends = np.maximum.accumulate(ends[order])
+    first = np.concatenate(([True], starts[1:] > ends[:-1]))
+    last = np.concatenate((first[1:], [True]))
+
+    return starts[first], ends[last]
+
+
+class IdentityCoverage:
+    """Count, for each (query, subject) pair of a blastn output, the positions of the
+    query that are aligned to an identical base in at least one HSP.
+
+    The HSPs are given by batches and the HSPs of a pair must follow each other, as
+    they do in blastn output. The identical bases of the HSPs are taken as runs,
+    [start, end) intervals of the query. The runs of all the pairs of a batch are
+    merged at once, shifted apart by their pair index times a stride longer than
+    the queries, and a pair is reduced to the total length of its merged
+    intervals as soon as the next pair starts. A pair that goes on over several
+    batches keeps the merged intervals of each batch, merged together whenever
+    they outgrow four times their last merge. The memory of a pair is a few
+    integers per run of identical bases, of which there are at most half as many
+    as bases in the query; a batch adds a few bytes per alignment column.
     """
-    b = reader(1024 * 1024)
-    while b:
-        yield b
-        b = reader(1024 * 1024)
 
+    def __init__(self):
+        self.M = {}
+        self.size_dict = {}
+        # ids, names and merged intervals of the pair being read
+        self.ids = None
+        self.pair = None
+        self.chunks = []
+        self.pending = 0
+        self.merged = 0
+        # name of each genome, decoded once and shared by its pairs
+        self.names = {}
+
+    def add_batch(self, batch):
+        """Add a batch of HSPs.
+        Args:
+            batch (dict): HSPs as given by parse_blastn_batch
+        """
+        if not len(batch["qseqid"]):
+            return
+
+        if "btop" in batch:
+            run_starts, run_ends, run_hsps = btop_identical_runs(
+                batch["qstart"], batch["btop"], batch["lengths"]
+            )
+        else:
+            run_starts, run_ends, run_hsps = identical_runs(
+                batch["qstart"], batch["qseq"], batch["sseq"], batch["lengths"]
+            )
+
+        # pair of each HSP, numbered from 0 in the batch
+        qseqid, sseqid = np.array(batch["qseqid"]), np.array(batch["sseqid"])
+        new_pair = np.concatenate(
+            ([True], (qseqid[1:] != qseqid[:-1]) | (sseqid[1:] != sseqid[:-1]))
+        )
+        pair_hsps = np.flatnonzero(new_pair).tolist()
+        run_pairs = (np.cumsum(new_pair) - 1)[run_hsps]
 
-def rawgencount(filename):
-    """Count the number of lines in a file.
+        # Merge the runs of all the pairs, shifted apart so that they never overlap
+        stride = int(batch["qlen"].max()) + 1
+        starts, ends = merge_intervals(
+            run_pairs * stride + run_starts, run_pairs * stride + run_ends
+        )
+        last = len(pair_hsps) - 1
+        first_end, last_start = np.searchsorted(starts, [stride, last * stride]).tolist()
+
+        # The first pair goes on with the last one of the previous batch, and the
+        # last pair may go on in the next batch
+        if (batch["qseqid"][0], batch["sseqid"][0]) != self.ids:
+            self.flush()
+            self.start_pair(batch, 0)
+        self.add_intervals(starts[:first_end], ends[:first_end])
+        if last:
+            self.flush()
+            covered = np.bincount(
+                starts // stride, weights=ends - starts, minlength=last
+            ).tolist()
+            for pair in range(1, last):
+                self.M[self.pair_names(batch, pair_hsps[pair])] = int(covered[pair])
+            self.start_pair(batch, pair_hsps[last])
+            offset = last * stride
+            self.add_intervals(starts[last_start:] - offset, ends[last_start:] - offset)
+
+    def pair_names(self, batch, hsp):
+        """Names of the pair of an HSP, whose sizes are recorded on the way."""
+        pair = (self.name(batch["qseqid"][hsp]), self.name(batch["sseqid"][hsp]))
+        self.size_dict.setdefault(pair[0], int(batch["qlen"][hsp]))
+        self.size_dict.setdefault(pair[1], int(batch["slen"][hsp]))
+        return pair
+
+    def start_pair(self, batch, hsp):
+        """Start reading the pair of an HSP."""
+        self.ids = (batch["qseqid"][hsp], batch["sseqid"][hsp])
+        self.pair = self.pair_names(batch, hsp)
+
+    def add_intervals(self, starts, ends):
+        """Add merged intervals to the pair being read."""
+        self.chunks.append((starts, ends))
+        self.pending += len(starts)
+        if len(self.chunks) > 1 and self.pending > 4 * self.merged + 65536:
+            self.merge()
+
+    def merge(self):
+        starts, ends = merge_intervals(
+            np.concatenate([starts for starts, _ in self.chunks]),
+            np.concatenate([ends for _, ends in self.chunks]),
+        )
+        self.chunks = [(starts, ends)]
+        self.pending = self.merged = len(starts)
+
+    def name(self, genome_id):
+        name = self.names.get(genome_id)
+        if name is None:
+            name = self.names[genome_id] = genome_id.decode()
+        return name
+
+    def flush(self):
+        """Convert the intervals of the pair being read to its number of identical positions"""
+        if self.pair is not None:
+            if len(self.chunks) > 1:
+                self.merge()
+            self.M[self.pair] = int(
+                sum((ends - starts).sum() for starts, ends in self.chunks)
+            )
+        self.ids = None
+        self.pair = None
+        self.chunks = []
+        self.pending = self.merged = 0
+
+    def close(self):
+        """Finish the last pair.
+        Returns:
+            dict: The number of identical positions of each (query, subject) pair
+        """
+        self.flush()
+        return self.M
+
+
+def label_collections(labels, offsets, fontsize, ax, color="w"):
+    """Texts centred on their positions, drawn as one collection of outlines per
+    character. Each character is drawn many times from a single path, which is much
+    faster than a Text per label, but the texts are only shapes in vector figures.
+    The layout of the figure must be final, the characters are placed in data
+    coordinates from the current size of the axes.
     Args:
-        filename (str): The name of the file to count.
+        labels (list): The texts
+        offsets (np.ndarray): Positions of the centres of the texts, in data coordinates
+        fontsize (float): Size of the texts, in points
+        ax (Axes): The axes to draw on
+        color (str): Color of the texts
     Returns:
-        int: The number of lines in the file.
-    """
-    f = gzip.open(filename, "rb")
-    f_gen = _make_gen(f.read)
-    return sum(buf.count(b"\n") for buf in f_gen)
-
-
-def heatmap(dfM, outfile, matrix_out, accession_genus_dict, cmap="Greens"):
-    # define output files
-    svg_out = outfile + ".svg"
-    pdf_out = outfile + ".pdf"
-    jpg_out = outfile + ".jpg"
-    ax = plt.gca()
-    dfM["A"] = dfM["A"].map(lambda x: x + ":" + accession_genus_dict.get(x, ""))
-    dfM["B"] = dfM["B"].map(lambda x: x + ":" + accession_genus_dict.get(x, ""))
-    dfM.update(dfM.loc[dfM.A > dfM.B].rename({"A": "B", "B": "A"}, axis=1))
-    dfM = dfM.round(2)
-    df = dfM.pivot(index="A", columns="B", values="sim").fillna(0)
-    df = df.rename({"taxmyPhage": "query"}, axis=1).rename(
-        {"taxmyPhage": "query"}, axis=0
+        list: The collections, added to the axes
+    """
+    from matplotlib.collections import PathCollection
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.textpath import TextPath, text_to_path
+    from matplotlib.transforms import Affine2D
+
+    prop = FontProperties(size=fontsize)
+
+    # Width of a data unit in points
+    x_min, x_max = ax.get_xlim()
+    points_per_unit = (
+        ax.get_window_extent().width * 72 / ax.figure.dpi / abs(x_max - x_min)
     )
 
-    # Make the matrix symmetric
-    df = df + df.T - np.diag(df.values.diagonal())
+    # Labels are centred vertically on the height of the digits
+    height = TextPath((0, 0), "0", prop=prop).get_extents().height
 
-    # Perform hierarchical clustering
-    Z = sch.linkage(df, method="ward")
+    # Advance of each character, in data units
+    advances = {
+        char: text_to_path.get_text_width_height_descent(char, prop, False)[0]
+        / points_per_unit
+        for char in set("".join(labels))
+    }
 
-    # Plot the dendrogram
-    dendrogram = sch.dendrogram(Z, labels=df.index, no_plot=True)
+    # Position of each character of each label
+    chars = {}
+    for label, (x, y) in zip(labels, offsets):
+        x -= sum(advances[char] for char in label) / 2
+        for char in label:
+            chars.setdefault(char, []).append((x, y))
+            x += advances[char]
+
+    collections = []
+    for char, char_offsets in chars.items():
+        path = TextPath((0, -height / 2), char, prop=prop)
+        if not len(path.vertices):
+            continue
+        collection = PathCollection(
+            [path],
+            offsets=char_offsets,
+            offset_transform=ax.transData,
+            transform=Affine2D().scale(1 / 72) + ax.figure.dpi_scale_trans,
+            facecolors=color,
+            edgecolors="none",
+            linewidths=0,
+        )
+        ax.add_collection(collection, autolim=False)
+        collections.append(collection)
 
-    # Looking for the query leave to put at the end
+    return collections
+
+
+def label_texts(labels, offsets, fontsize, ax, color="w"):
+    """Texts centred on their positions, drawn as a Text each.
+    Args:
+        labels (list): The texts
+        offsets (np.ndarray): Positions of the centres of the texts, in data coordinates
+        fontsize (float): Size of the texts, in points
+        ax (Axes): The axes to draw on
+        color (str): Color of the texts
+    Returns:
+        list: The Text artists, added to the axes
+    """
+    return [
+        ax.text(x, y, label, ha="center", va="center", color=color, fontsize=fontsize)
+        for label, (x, y) in zip(labels, offsets.tolist())
+    ]
+
+
+def query_last(leaves):
+    """Order of the genomes in the heatmap: the leaves of the dendrogram, with the
+    added genomes and then the query moved to the end.
+    Args:
+        leaves (list): Names of the genomes, in the order of the dendrogram
+    Returns:
+        list: The names of the genomes in the order of the heatmap
+    """
     leaves_order = []
     add_genomes = []
 
-    for leave in dendrogram["ivl"]:
+    for leave in leaves:
         if "query" in leave:
             query_leave = leave
         elif "_added" in leave:
@@ -331,6 +1664,185 @@ def heatmap(dfM, outfile, matrix_out, accession_genus_dict, cmap="Greens"):
     leaves_order += add_genomes
     leaves_order.append(query_leave)
 
+    return leaves_order
+
+
+def ward_linkage(matrix, block_size=1024):
+    """Ward clustering of the rows of a matrix, as sch.linkage(matrix, "ward"),
+    from the condensed vector of the euclidean distances between the rows. The
+    distances are computed by blocks of rows from their dot products.
+    Args:
+        matrix (np.ndarray): The symmetric similarity matrix
+        block_size (int): Number of rows of the blocks
+    Returns:
+        np.ndarray: The linkage matrix
+    """
+    import scipy.cluster.hierarchy as sch
+
+    num_rows = matrix.shape[0]
+    squared_norms = np.einsum("ij,ij->i", matrix, matrix)
+
+    condensed = np.empty(num_rows * (num_rows - 1) // 2)
+    start = 0
+    for i0 in range(0, num_rows, block_size):
+        i1 = min(i0 + block_size, num_rows)
+        squared = (
+            squared_norms[i0:i1, None]
+            + squared_norms[None, :]
+            - 2 * (matrix[i0:i1] @ matrix.T)
+        )
+        distances = np.sqrt(np.maximum(squared, 0))
+        # Upper triangle of the block, row by row as in the condensed vector
+        for i in range(i0, i1):
+            row = distances[i - i0, i + 1 :]
+            condensed[start : start + len(row)] = row
+            start += len(row)
+
+    return sch.linkage(condensed, method="ward")
+
+
+def large_heatmap(dfM, outfile, matrix_out, formats=("svg", "pdf", "jpg")):
+    """Heatmap of hundreds to thousands of genomes, drawn as an image without
+    labels nor values. The reordered matrix is kept as a memory-mapped array next
+    to matrix_out, written from it by blocks of rows, and the cells are aggregated
+    by their maximum when there are more than HEATMAP_MAX_PIXELS genomes.
+    Args:
+        dfM (pd.DataFrame): The similarities of the pairs of genomes, with genus names
+        outfile (str): Path of the figures, without their extension
+        matrix_out (str): Path to write the matrix of the similarities shown
+        formats (list): Extensions of the formats of the figures to write
+    """
+    import matplotlib.colors as mcolors
+    import scipy.cluster.hierarchy as sch
+
+    plt = import_pyplot()
+
+    # Index of the genomes of each pair, in the order of their names
+    codes, names = pd.factorize(pd.concat([dfM["A"], dfM["B"]], ignore_index=True))
+    sorter = names.argsort()
+    positions = np.empty_like(sorter)
+    positions[sorter] = np.arange(len(sorter))
+    a, b = np.split(positions[codes], 2)
+    names = pd.Index(names[sorter])
+    names = names.where(names != "taxmyPhage", "query")
+    num_genomes = len(names)
+
+    # Symmetric similarity matrix, the diagonal is set once
+    matrix = np.zeros((num_genomes, num_genomes))
+    matrix[a, b] = dfM["sim"].to_numpy()
+    matrix[b, a] = dfM["sim"].to_numpy()
+
+    Z = ward_linkage(matrix)
+    order = names.get_indexer(query_last(names[sch.leaves_list(Z)]))
+    ordered_names = names[order]
+
+    # Upper triangle of the reordered matrix, kept on disk
+    top_right = np.lib.format.open_memmap(
+        f"{os.path.splitext(matrix_out)[0]}.npy",
+        mode="w+",
+        dtype=np.float64,
+        shape=(num_genomes, num_genomes),
+    )
+    block_size = max(1, 2**22 // num_genomes)
+    with open(matrix_out, "w") as f:
+        for i0 in range(0, num_genomes, block_size):
+            i1 = min(i0 + block_size, num_genomes)
+            top_right[i0:i1] = np.triu(matrix[order[i0:i1]][:, order], k=i0)
+            pd.DataFrame(
+                top_right[i0:i1],
+                index=pd.Index(ordered_names[i0:i1], name="A"),
+                columns=pd.Index(ordered_names, name="B"),
+            ).to_csv(f, sep="\t", header=i0 == 0)
+    top_right.flush()
+    del matrix
+
+    # Maximum similarity of the blocks of cells shown as one pixel
+    factor = -(-num_genomes // HEATMAP_MAX_PIXELS)
+    if factor > 1:
+        num_pixels = -(-num_genomes // factor)
+        image = np.zeros((num_pixels, num_pixels))
+        for p in range(num_pixels):
+            rows = top_right[p * factor : (p + 1) * factor].max(axis=0)
+            rows = np.pad(rows, (0, num_pixels * factor - num_genomes))
+            image[p] = rows.reshape(num_pixels, factor).max(axis=1)
+    else:
+        image = top_right
+
+    fig, ax = plt.subplots(figsize=(12, 12))
+    ax.imshow(
+        image,
+        cmap=mcolors.ListedColormap(HEATMAP_COLORS),
+        norm=mcolors.BoundaryNorm(HEATMAP_BOUNDARIES, len(HEATMAP_COLORS)),
+        interpolation="none",
+    )
+    ax.set_axis_off()
+    ax.set_title(
+        f"{num_genomes} genomes, query last"
+        + (f", maximum of {factor}x{factor} genomes per cell" if factor > 1 else "")
+    )
+    fig.tight_layout(pad=2.0)
+    fig.set_layout_engine(None)
+
+    # About one pixel per cell in the raster formats
+    dpi = max(100, int(np.ceil(image.shape[0] / 10)))
+    for extension in formats:
+        fig.savefig(f"{outfile}.{extension}", dpi=dpi)
+    plt.close(fig)
+
+
+def heatmap(
+    dfM,
+    outfile,
+    matrix_out,
+    accession_genus_dict,
+    cmap="Greens",
+    formats=("svg", "pdf", "jpg"),
+):
+    """Draw the heatmap of the similarities of the genomes, ordered by clustering.
+    Args:
+        dfM (pd.DataFrame): The similarities of the pairs of genomes, from PoorMansViridic
+        outfile (str): Path of the figures, without their extension
+        matrix_out (str): Path to write the matrix of the similarities shown
+        accession_genus_dict (dict): The genus of each reference genome
+        cmap (str): Unused, the colors are set by the similarity thresholds
+        formats (list): Extensions of the formats of the figures to write
+    """
+    import matplotlib.colors as mcolors
+    import scipy.cluster.hierarchy as sch
+
+    # Add the genus to the names, and put the pairs in the order of their names
+    names = pd.unique(pd.concat([dfM["A"], dfM["B"]]))
+    labels = {name: f"{name}:{accession_genus_dict.get(name, '')}" for name in names}
+    a = dfM["A"].map(labels).to_numpy()
+    b = dfM["B"].map(labels).to_numpy()
+    swap = a > b
+    dfM["A"] = np.where(swap, b, a)
+    dfM["B"] = np.where(swap, a, b)
+    dfM = dfM.round(2)
+
+    if len(names) > HEATMAP_LARGE_GENOMES:
+        large_heatmap(dfM, outfile, matrix_out, formats)
+        return
+
+    plt = import_pyplot()
+    fig, ax = plt.subplots()
+    df = dfM.pivot(index="A", columns="B", values="sim").fillna(0)
+    df = df.rename({"taxmyPhage": "query"}, axis=1).rename(
+        {"taxmyPhage": "query"}, axis=0
+    )
+
+    # Make the matrix symmetric
+    df = df + df.T - np.diag(df.values.diagonal())
+
+    # Perform hierarchical clustering
+    Z = sch.linkage(df, method="ward")
+
+    # Plot the dendrogram
+    dendrogram = sch.dendrogram(Z, labels=df.index, no_plot=True)
+
+    # Looking for the query leave to put at the end
+    leaves_order = query_last(dendrogram["ivl"])
+
     # Reorder the matrix
     df = df.loc[leaves_order, leaves_order]
     df.iloc[:, :] = np.triu(df.values, k=0)
@@ -339,16 +1851,18 @@ def heatmap(dfM, outfile, matrix_out, accession_genus_dict, cmap="Greens"):
 
     df.to_csv(matrix_out, sep="\t", index=True)
 
-    colors = ["white", "lightgray", "skyblue", "steelblue", "darkgreen"]
-    boundaries = [0, 1, 50, 70, 95, 100]
-
-    norm = mcolors.BoundaryNorm(boundaries, len(colors))
+    norm = mcolors.BoundaryNorm(HEATMAP_BOUNDARIES, len(HEATMAP_COLORS))
     # Create the colormap
-    custom_cmap = mcolors.ListedColormap(colors)
+    custom_cmap = mcolors.ListedColormap(HEATMAP_COLORS)
 
     # image
-    # im = plt.imshow(df.values, cmap=cmap)
-    im = plt.imshow(df.values, cmap=custom_cmap, norm=norm)
+    # im = ax.imshow(df.values, cmap=cmap)
+    im = ax.imshow(
+        df.values,
+        cmap=custom_cmap,
+        norm=norm,
+        interpolation="none",
+    )
 
     ax.set_xticks(np.arange(df.shape[1]), labels=df.columns.tolist())
     ax.set_yticks(np.arange(df.shape[0]), labels=df.index.tolist())
@@ -365,33 +1879,36 @@ def heatmap(dfM, outfile, matrix_out, accession_genus_dict, cmap="Greens"):
 
     fig_width = max(4, df.shape[1] * 0.75)
     fig_height = max(4, df.shape[0] * 0.75)
-    plt.gcf().set_size_inches(fig_width, fig_height)
-
-    for i in range(df.shape[0]):
-        for j in range(df.shape[1]):
-            font_size = (
-                min(fig_width, fig_height) / max(df.shape[0], df.shape[1])
-            ) * 10
-
-            ax.text(
-                j,
-                i,
-                df.iloc[i, j],
-                ha="center",
-                va="center",
-                color="w",
-                fontsize=font_size,
-            )
-
-    # adjust figure size based on number of rows and columns
-
-    # plot with padding
-    plt.tight_layout(pad=2.0)
-
-    plt.savefig(svg_out)
-    plt.savefig(pdf_out)
-    plt.savefig(jpg_out)
-    plt.close()
+    fig.set_size_inches(fig_width, fig_height)
+
+    # plot with padding, the layout is computed once for all the formats
+    fig.tight_layout(pad=2.0)
+
+    # Values of the upper triangle, the empty cells are white on white
+    font_size = (min(fig_width, fig_height) / max(df.shape[0], df.shape[1])) * 10
+    rows, columns = np.nonzero(df.values)
+    labels = [str(value) for value in df.values[rows, columns].tolist()]
+    offsets = np.column_stack([columns, rows])
+
+    # Each format is drawn once: tight_layout leaves a placeholder layout engine
+    # which makes savefig draw the figure before saving it, and pyplot.savefig
+    # draws it again after saving it
+    fig.set_layout_engine(None)
+    # The images get the values as outlines, faster to draw, and the vector
+    # formats as text, which svg.fonttype "none" keeps editable
+    text_formats = [ext for ext in formats if ext.lower() in HEATMAP_TEXT_FORMATS]
+    for extensions, draw_labels in (
+        ([ext for ext in formats if ext not in text_formats], label_collections),
+        (text_formats, label_texts),
+    ):
+        if not extensions:
+            continue
+        artists = draw_labels(labels, offsets, font_size, ax)
+        for extension in extensions:
+            fig.savefig(f"{outfile}.{extension}")
+        for artist in artists:
+            artist.remove()
+    plt.close(fig)
 
     return
 
@@ -406,13 +1923,6 @@ def is_program_installed_unix(program_name):
 
 def check_programs():
     # check programs are installed
-    program_name = "blastdbcmd"
-    if is_program_installed_unix(program_name):
-        ic(program_name, "is installed will proceed ")
-    else:
-        print_error(f"{program_name} is not installed.")
-        sys.exit()
-
     program_name = "mash"
     if is_program_installed_unix(program_name):
         ic(program_name, "is installed will proceed ")
@@ -421,311 +1931,1537 @@ def check_programs():
         sys.exit()
 
 
-def check_blastDB(blastdb_path):
-    # check if blastDB is present
-    if os.path.exists(blastdb_path):
-        print_ok(f"Found {blastdb_path} as expected\n")
+def environment_key(name, programs, paths):
+    """Hash of the paths and modification times of programs and files.
+    Args:
+        name (str): Name of the check
+        programs (list): Programs looked for on the PATH
+        paths (list): Paths of the files
+    Returns:
+        str: The hexadecimal hash
+    """
+    sha = hashlib.sha256(name.encode())
+    for path in [shutil.which(program) for program in programs] + paths:
+        try:
+            stat = os.stat(path)
+            sha.update(
+                f"\t{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}".encode()
+            )
+        except (OSError, TypeError):
+            sha.update(f"\t{path}\tmissing".encode())
 
-        if blastdb_path.endswith(".gz"):
-            blastdb_path_no_gz = os.path.basename(blastdb_path[:-3])
-            blastdb_path_no_gz = os.path.join(args.output, blastdb_path_no_gz)
-            try:
-                with gzip.open(f"{blastdb_path}", "rb") as f_in:
-                    with open(blastdb_path_no_gz, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+    return sha.hexdigest()
 
-                blastdb_path = blastdb_path_no_gz
-                print("File unzipped successfully!")
-            except Exception as e:
-                print(f"An error occurred while gunzipping the file: {e}")
 
-        if os.path.exists(blastdb_path + ".nhr"):
-            print_ok(f"Found {blastdb_path}.nhr as expected\n")
-        else:
-            makeblastdb_command = (
-                f"makeblastdb -in {blastdb_path} -parse_seqids -dbtype nucl"
-            )
-            try:
-                subprocess.run(makeblastdb_command, shell=True, check=True)
-                print("makeblastdb command executed successfully!\n")
-            except subprocess.CalledProcessError as e:
-                print(f"An error occurred while executing makeblastdb: {e}")
-    else:
-        print_error(f"File {blastdb_path} does not exist will create database now  ")
-        print_error("Will download the database now and create database")
-        url = (
-            "https://millardlab-inphared.s3.climb.ac.uk/Bacteriophage_genomes.fasta.gz"
-        )
-        try:
-            create_folder(os.path.dirname(blastdb_path))
-            wget.download(url, f"{blastdb_path}.gz")
-            print(f"\n{url} downloaded successfully!")
-        except Exception as e:
-            print(f"An error occurred while downloading {url}: {e}")
-        # Gunzip the file
+def cached_check(name, programs, paths, check):
+    """Run a check of the environment, unless it already passed with the same
+    programs and files. The stamps are kept in ~/.taxmyPHAGE/environment.json,
+    keyed on the paths of the programs and the size and modification time of the
+    files, and a check is only stamped when all its files exist afterwards.
+    Args:
+        name (str): Name of the check
+        programs (list): Programs the check looks for on the PATH
+        paths (list): Files the check looks for or creates
+        check (callable): The check, returning a JSON serialisable value
+    Returns:
+        The value returned by the check, or by the run of the check that was stamped
+    """
+    try:
+        with open(ENVIRONMENT_STAMP_PATH) as f:
+            stamps = json.load(f)
+    except (OSError, ValueError):
+        stamps = {}
+
+    stamp = stamps.get(name)
+    if stamp and stamp["key"] == environment_key(name, programs, paths):
+        ic(f"{name} already checked")
+        return stamp["value"]
+
+    value = check()
+
+    if all(os.path.exists(path) for path in paths):
+        stamps[name] = {"key": environment_key(name, programs, paths), "value": value}
+
+        # Write to a temporary file first as parallel runs may read it
+        create_folder(os.path.dirname(ENVIRONMENT_STAMP_PATH))
+        tmp_stamp_path = f"{ENVIRONMENT_STAMP_PATH}.{os.getpid()}.tmp"
+        with open(tmp_stamp_path, "w") as f:
+            json.dump(stamps, f)
+        os.replace(tmp_stamp_path, ENVIRONMENT_STAMP_PATH)
+
+    return value
+
+
+def load_download_manifest(path=""):
+    """Sources of the reference files, the defaults of REFERENCE_DOWNLOADS updated
+    by a JSON file mapping their names to {"url": ..., "sha256": ..., "md5": ...,
+    "etag_is_md5": ...}.
+    Args:
+        path (str): Path to the JSON file, none when empty
+    Returns:
+        dict: The url and checksums of each file, keyed by name
+    """
+    downloads = {name: dict(source) for name, source in REFERENCE_DOWNLOADS.items()}
+    if path:
+        with open(path) as f:
+            for name, source in json.load(f).items():
+                download = downloads.setdefault(name, {})
+                # Another server than the default one does not give the MD5 as ETag
+                # unless told so
+                if source.get("url", download.get("url")) != download.get("url"):
+                    download.pop("etag_is_md5", None)
+                download.update(source)
+
+    return downloads
+
+
+def etag_md5(etag):
+    """MD5 of a file given by its ETag, as with S3 for the files uploaded in one
+    part, None for the other ETags."""
+    etag = (etag or "").strip('"')
+    return etag.lower() if re.fullmatch("[0-9a-fA-F]{32}", etag) else None
+
+
+def file_checksum(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def download_file(url, path, sha256=None, md5=None, position=0, etag_is_md5=False):
+    """Download a file to path.part, resumed with a range request after an
+    interruption, even by a previous run, and moved to path once it has the size
+    announced by the server and the expected checksums. Without a checksum, the
+    ETag is checked as the MD5 of the file when the server is known to give it so.
+    Args:
+        url (str): URL of the file
+        path (str): Path to install the file to
+        sha256 (str): Expected SHA-256 of the file
+        md5 (str): Expected MD5 of the file
+        position (int): Line of the progress bar
+        etag_is_md5 (bool): Whether the ETag of the file is its MD5, as on S3
+    Raises:
+        OSError: When DOWNLOAD_ATTEMPTS attempts in a row get no farther in the file,
+            or when the whole file does not have the expected size or checksums
+    """
+    import http.client
+    import urllib.error
+    import urllib.request
+
+    part_path = f"{path}.part"
+    create_folder(os.path.dirname(os.path.abspath(path)))
+
+    etag = None
+    failures = 0
+    # farthest the part got, the attempts that restart from the beginning only count
+    # as progress once they get past it
+    farthest = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    while True:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        if offset and etag:
+            # The server sends the whole file instead when it changed
+            headers["If-Range"] = etag
+
         try:
-            with gzip.open(f"{blastdb_path}.gz", "rb") as f_in:
-                with open(blastdb_path, "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                    os.remove(f"{blastdb_path}.gz")
+            try:
+                response = urllib.request.urlopen(
+                    urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT
+                )
+            except urllib.error.HTTPError as e:
+                if e.code != 416:
+                    raise
+                # The range starts at the end of the file, the part is complete
+                # unless the file is shorter
+                total = int(e.headers.get("Content-Range", "*/-1").split("/")[-1])
+                if total != offset:
+                    os.remove(part_path)
+                    raise
+                response = None
+
+            if response is not None:
+                with response:
+                    etag = response.headers.get("ETag", etag)
+                    if response.status == 206:
+                        total = int(response.headers["Content-Range"].split("/")[-1])
+                    else:
+                        # The server ignores ranges, start over
+                        offset = 0
+                        total = int(response.headers.get("Content-Length", -1))
+
+                    with open(part_path, "ab" if offset else "wb") as f, tqdm(
+                        desc=os.path.basename(path),
+                        total=total if total >= 0 else None,
+                        initial=offset,
+                        unit="B",
+                        unit_scale=True,
+                        position=position,
+                    ) as progress:
+                        while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            progress.update(len(chunk))
+
+            size = os.path.getsize(part_path)
+            if total < 0 or size >= total:
+                break
+            error = OSError(f"{url} stopped at {size} of {total} bytes")
+
+        except urllib.error.HTTPError as e:
+            # Only the errors of the server are worth another attempt
+            if e.code < 500 and e.code != 416:
+                raise OSError(f"{url}: {e}") from e
+            error = e
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+
+        # An attempt that got farther in the file does not count as a failure
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        failures = 0 if size > farthest else failures + 1
+        farthest = max(farthest, size)
+        ic(f"Downloading {url} stopped at {size} bytes: {error}")
+        if failures >= DOWNLOAD_ATTEMPTS:
+            raise OSError(f"{url} could not be downloaded: {error}")
+        if failures:
+            time.sleep(min(2**failures, 30))
+
+    # The whole file was received, another attempt would get the same one
+    if total >= 0 and size != total:
+        os.remove(part_path)
+        raise OSError(f"{url} has {size} bytes instead of {total}")
+
+    if not (md5 or sha256) and etag_is_md5:
+        md5 = etag_md5(etag)
+    elif etag:
+        ic(f"ETag of {url}: {etag}")
+    expected = {"sha256": sha256, "md5": md5}
+    for algorithm, checksum in expected.items():
+        if checksum and file_checksum(part_path, algorithm) != checksum.lower():
+            os.remove(part_path)
+            raise OSError(f"The {algorithm} of {url} is not {checksum}")
+
+    os.replace(part_path, path)
+
+
+def download_references(downloads):
+    """Download reference files at the same time.
+    Args:
+        downloads (dict): The url and checksums of each file, keyed by the path to
+            install it to
+    Returns:
+        list: The paths of the files that could not be downloaded
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, len(downloads))) as executor:
+        futures = {
+            executor.submit(
+                download_file,
+                source["url"],
+                path,
+                source.get("sha256"),
+                source.get("md5"),
+                position,
+                source.get("etag_is_md5", False),
+            ): (path, source["url"])
+            for position, (path, source) in enumerate(downloads.items())
+        }
+        for future in as_completed(futures):
+            path, url = futures[future]
+            try:
+                future.result()
+                print_ok(f"\n{url} downloaded to {path}")
+            except OSError as e:
+                print_error(f"\nAn error occurred while downloading {url}: {e}")
+                failed.append(path)
+
+    return failed
 
-            print("File gunzipped successfully!")
-        except Exception as e:
-            print(f"An error occurred while gunzipping the file: {e}")
 
-        # Run makeblastdb
-        makeblastdb_command = (
-            f"makeblastdb -in {blastdb_path} -parse_seqids -dbtype nucl"
+def prepare_database(source_path, fasta_path, makeblastdb=True, mash_index_path="", threads="1"):
+    """Index the reference genomes in a single read of their fasta file. The file
+    is decompressed once when gzipped, and each chunk goes to the uncompressed
+    copy and to the standard input of makeblastdb and mash sketch, which index the
+    genomes at the same time. The copy is moved in place once both succeed.
+    Args:
+        source_path (str): Path to the fasta file of the genomes, gzipped or not
+        fasta_path (str): Path to the uncompressed fasta file, the BLAST database
+            is named after it
+        makeblastdb (bool): Whether to build the BLAST database
+        mash_index_path (str): Path to the mash index to sketch, none when empty
+        threads (str): Number of threads of mash sketch
+    Raises:
+        subprocess.CalledProcessError: When makeblastdb or mash sketch fails
+        OSError: When one of them stops reading the genomes before their end, the
+            others and the copy being incomplete
+    """
+    commands = []
+    if makeblastdb:
+        commands.append(
+            f"makeblastdb -in - -out {shlex.quote(fasta_path)} -title"
+            f" {shlex.quote(os.path.basename(fasta_path))} -parse_seqids -dbtype nucl"
         )
+    if mash_index_path:
+        commands.append(
+            f"mash sketch -p {threads} -o {shlex.quote(mash_index_path)} -i -"
+        )
+    ic(commands)
+
+    processes = [
+        subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE) for cmd in commands
+    ]
+    sinks = [process.stdin for process in processes]
+    tmp_path = f"{fasta_path}.{os.getpid()}.tmp"
+    if source_path != fasta_path:
+        sinks.append(open(tmp_path, "wb"))
+
+    # command of the indexer that stopped reading the genomes, if any
+    stopped = None
+    try:
+        with open_fasta(source_path, "rb") as f_in:
+            while chunk := f_in.read(DATABASE_CHUNK_SIZE):
+                for i, sink in enumerate(sinks):
+                    try:
+                        sink.write(chunk)
+                    except BrokenPipeError:
+                        stopped = commands[i]
+                        raise
+    except BrokenPipeError:
+        # An indexer stopped early, its exit status tells why
+        pass
+    finally:
+        for sink in sinks:
+            try:
+                sink.close()
+            except BrokenPipeError:
+                pass
+
+    returncodes = [process.wait() for process in processes]
+    failed = [(code, cmd) for code, cmd in zip(returncodes, commands) if code != 0]
+
+    # When an indexer failed or stopped reading, the others and the copy may have
+    # only part of the genomes, nothing is kept for the next run to find
+    if failed or stopped is not None:
+        partial_paths = [tmp_path, mash_index_path]
+        if makeblastdb:
+            partial_paths += glob.glob(f"{glob.escape(fasta_path)}.n??")
+            partial_paths += glob.glob(f"{glob.escape(fasta_path)}.[0-9][0-9].n??")
+        for path in partial_paths:
+            if path and os.path.exists(path):
+                os.remove(path)
+
+        if failed:
+            raise subprocess.CalledProcessError(*failed[0])
+        raise OSError(f"{stopped} stopped reading the genomes before their end")
+
+    if source_path != fasta_path:
+        os.replace(tmp_path, fasta_path)
+
+
+def check_blastDB(
+    blastdb_path, output, mash_index_path="", threads="1", source=None, blast=True
+):
+    """Find the database of genomes, downloaded when missing, and build its indexes.
+    A gzipped database is decompressed in the output folder, and the BLAST
+    database and mash index are built from it in the same pass, see
+    prepare_database. The program exits when the database cannot be prepared.
+    Args:
+        blastdb_path (str): Path to the fasta file of the genomes, gzipped or not
+        output (str): Path to the output folder, where a gzipped database is
+            decompressed
+        mash_index_path (str): Path to the mash index to sketch when missing,
+            none when empty
+        threads (str): Number of threads of mash sketch
+        source (dict): URL and checksums of the genomes to download when missing,
+            REFERENCE_DOWNLOADS["genomes"] when None
+        blast (bool): Whether the BLAST database is needed, it is not with the
+            kmer aligner
+    Returns:
+        str: Path to the uncompressed fasta file of the genomes
+    """
+    # check if blastDB is present
+    downloaded = False
+    if os.path.exists(blastdb_path):
+        print_ok(f"Found {blastdb_path} as expected\n")
+        source_path = blastdb_path
+
+        if blastdb_path.endswith(".gz"):
+            blastdb_path_no_gz = os.path.basename(blastdb_path[:-3])
+            blastdb_path = os.path.join(output, blastdb_path_no_gz)
+    else:
+        # The database is downloaded before, with the other reference files
+        if not os.path.exists(f"{blastdb_path}.gz"):
+            print_error(f"File {blastdb_path} does not exist will create database now  ")
+            print_error("Will download the database now and create database")
+            if download_references(
+                {f"{blastdb_path}.gz": source or REFERENCE_DOWNLOADS["genomes"]}
+            ):
+                sys.exit(1)
+        source_path = f"{blastdb_path}.gz"
+        downloaded = True
+
+    makeblastdb = blast and not (
+        source_path == blastdb_path and os.path.exists(blastdb_path + ".nhr")
+    )
+    if blast and not makeblastdb:
+        print_ok(f"Found {blastdb_path}.nhr as expected\n")
+    sketch_path = (
+        mash_index_path
+        if mash_index_path and not os.path.exists(mash_index_path)
+        else ""
+    )
+
+    if source_path != blastdb_path or makeblastdb or sketch_path:
         try:
-            subprocess.run(makeblastdb_command, shell=True, check=True)
+            prepare_database(source_path, blastdb_path, makeblastdb, sketch_path, threads)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print_error(f"An error occurred while preparing the database: {e}")
+            sys.exit(1)
+        if source_path != blastdb_path:
+            print("File gunzipped successfully!")
+        if makeblastdb:
             print("makeblastdb command executed successfully!\n")
-        except subprocess.CalledProcessError as e:
-            print(f"An error occurred while executing makeblastdb: {e}")
+        if sketch_path:
+            print("mash sketch command executed successfully!\n")
+
+    # The downloaded archive is only kept until it is decompressed
+    if downloaded:
+        os.remove(source_path)
+
+    return blastdb_path
 
 
-def get_level_lineage(name: str) -> str:
-    """Get level lineage from name .
+def normalise_lineages(lineages, genome_ids):
+    """Prefix a whole column of lineages at once.
+
+    Every distinct name is resolved to its rank only once, with the suffix
+    regex, and the rank columns are then filled by pivoting the
+    (row, rank, name) table instead of looping over the rows.
 
     Args:
-        name (str): The name of the level you want to know the lineage
+        lineages (pd.Series): ";" separated lineages, NaN when unknown
+        genome_ids (pd.Series): Id of the genome of each lineage
 
     Returns:
-        str: the level of the lineage
-    """
-
-    level_key = {
-        "Root": ["Viruses", "root"],
-        "Realm": ["viria", "satellitia", "viroidia", "viriformia"],
-        "Subrealm": ["vira", "satellita", "viroida", "viriforma"],
-        "Kingdom": ["virae", "satellitae", "viroidae", "viriformae"],
-        "Subkingdom": ["virites", "satellitites", "viroidites", "viriformites"],
-        "Phylum": ["viricota", "satelliticota", "viroidicota", "viriformicota"],
-        "Subphylum": [
-            "viricotina",
-            "satelliticotina",
-            "viroidicotina",
-            "viriformicotina",
-        ],
-        "Class": ["viricetes", "satelliticetes", "viroidicetes", "viriformicetes"],
-        "Subclass": [
-            "viricetidae",
-            "satelliticetidae",
-            "viroidicetidae",
-            "viriformicetidae",
-        ],
-        "Order": ["virales", "satellitales", "viroidales", "viriformales"],
-        "Suborder": ["virineae", "satellitineae", "viroidineae", "viriformineae"],
-        "Family": ["viridae", "viriformidae", "viroidae", "satellitidae"],
-        "Subfamily": ["virinae", "satellitinae", "viroidinae", "viriforminae"],
-        "Genus": ["virus", "viriform", "viroid", "satellite"],
-    }
+        pd.DataFrame: Lineage_prefix and one column per taxonomy level,
+            with the same index as lineages
+    """
+
+    index = lineages.index
+    lineages = lineages.reset_index(drop=True)
+    genome_ids = genome_ids.reset_index(drop=True).map("{}".format)
+
+    names = lineages.dropna().str.split(";").explode()
+    codes, uniques = pd.factorize(names, use_na_sentinel=False)
+    unique_levels = (
+        pd.Series(uniques, dtype=object)
+        .str.extract(LINEAGE_SUFFIX_RE, expand=False)
+        .map(LINEAGE_SUFFIX_LEVEL)
+    )
+    ranks = pd.DataFrame(
+        {"row": names.index, "code": codes, "level": unique_levels.values[codes]}
+    )
+
+    # Names are handled through their code in a table holding the distinct
+    # names, then "" for the missing levels, then the genome ids
+    missing = len(uniques)
+    genome_codes = np.arange(missing + 1, missing + 1 + len(lineages))
+    table = pd.Series(
+        np.concatenate([uniques, [""], genome_ids.values]).astype(object)
+    )
 
-    for level, exts in level_key.items():
-        for ext in exts:
-            if name.endswith(ext):
-                return level
-    return ""
+    # The species name is only taken from the lineage when it ends on a genus
+    last = ranks.drop_duplicates("row", keep="last").set_index("row")
+    ends_on_genus = (last["level"] == "Genus").reindex(lineages.index, fill_value=False)
+    last_codes = last["code"].reindex(lineages.index, fill_value=missing)
+
+    # Only the first name found for each level is kept
+    ranks = ranks.dropna(subset=["level"]).drop_duplicates(["row", "level"])
+    taxa = (
+        ranks.pivot(index="row", columns="level", values="code")
+        .reindex(index=lineages.index, columns=list(TAXONOMY_PREFIXES))
+        .fillna(missing)
+        .astype(np.int64)
+    )
+    taxa["Species"] = np.where(ends_on_genus, last_codes, genome_codes)
+    taxa["Genus"] = taxa["Genus"].where(taxa["Genus"] != missing, genome_codes)
+
+    # Same as splitting the prefixed name on "__" and keeping the last part
+    names = table.values
+    short_names = table.str.rsplit("__", n=1).str[-1].values
 
+    prefixed = [
+        prefix + pd.Series(names[taxa[level].values])
+        for level, prefix in TAXONOMY_PREFIXES.items()
+    ]
+    normalised = pd.DataFrame(
+        {level: short_names[taxa[level].values] for level in TAXONOMY_PREFIXES},
+        index=index,
+    )
+    normalised.insert(
+        0, "Lineage_prefix", prefixed[0].str.cat(prefixed[1:], sep=";").values
+    )
+
+    return normalised
+
+
+def check_VMR(VMR_path, genome_ids="Genome_id", lineage="Lineage"):
+    VMR_df = pd.read_table(VMR_path)
+    VMR_df = VMR_df.rename(columns={genome_ids: "Genome_id", lineage: "Lineage"})
 
-def fix_taxa_column(lineage: List[str], species_name: str, genome_id: str) -> str:
-    """Return a string with prefix_taxa .
+    taxa_df = normalise_lineages(VMR_df["Lineage"], VMR_df["Genome_id"])
 
+    # Adding the good lineage
+    VMR_df["Lineage_prefix"] = taxa_df["Lineage_prefix"].values
+
+    # Make sure that all the lineage is there
+    ranks = [taxa_df[level] for level in TAXONOMY_PREFIXES]
+    VMR_df["Lineage"] = ranks[0].str.cat(ranks[1:], sep=";").values
+
+    VMR_df[list(TAXONOMY_PREFIXES)] = taxa_df[list(TAXONOMY_PREFIXES)].values
+
+    return VMR_df
+
+
+def build_lineage_table(VMR_path, genome_ids="Genome_id", lineage="Lineage"):
+    """Read and process the VMR, or a personal lineage table.
     Args:
-        lineage (LIst(str)): List of all the lineage for a species
-        species_name (str): Name of the species
-        genome_id (str): Id of the genome
+        VMR_path (str): Path to the VMR.xlsx or to a tab separated lineage table
+        genome_ids (str): Column of the genome ids in a personal lineage table
+        lineage (str): Column of the lineages in a personal lineage table
     Returns:
-        str: The full lineage with prefixes
-    """
-
-    prefix_taxa = {
-        "Root": "ro__",
-        "Realm": "r__",
-        "Subrealm": "sr__",
-        "Kingdom": "k__",
-        "Subkingdom": "sk__",
-        "Phylum": "p__",
-        "Subphylum": "sp__",
-        "Class": "c__",
-        "Subclass": "sc__",
-        "Order": "o__",
-        "Suborder": "so__",
-        "Family": "f__",
-        "Subfamily": "sf__",
-        "Genus": "g__",
-        "Species": "s__",
-    }
+        pd.DataFrame: The lineage table with the accessions in the Genbank column
+    """
+    taxa_df = (
+        pd.read_excel(VMR_path, sheet_name=0)
+        if VMR_path.endswith(".xlsx")
+        else check_VMR(VMR_path, genome_ids, lineage)
+    )
+
+    taxa_df = taxa_df.rename(
+        columns={"Virus GENBANK accession": "Genbank", "Genome_id": "Genbank"}
+    )
 
-    level = "Species" if not lineage else get_level_lineage(lineage[0])
+    # Same types as the table read back from a tsv, with the missing values empty
+    buffer = io.StringIO()
+    taxa_df.to_csv(buffer, sep="\t", index=False)
+    buffer.seek(0)
 
-    for name in lineage:
-        level = get_level_lineage(name)
-        try:
-            level = level.rstrip()
-        except:
-            sys.exit(f"{name} : {lineage}")
+    return pd.read_csv(buffer, sep="\t").fillna("")
+
+
+def load_lineage_table(VMR_path, columns=None, genome_ids="Genome_id", lineage="Lineage"):
+    """Load the processed lineage table of the VMR from its cache under ~/.taxmyPHAGE.
+    The cache is named after the hash of the VMR file and of the options used to
+    process it, so it is rebuilt whenever one of them changes. It is stored as
+    feather with categorical columns when pyarrow is installed, as a pickle otherwise.
+    Args:
+        VMR_path (str): Path to the VMR.xlsx or to a tab separated lineage table
+        columns (list): Columns to load, all of them when None
+        genome_ids (str): Column of the genome ids in a personal lineage table
+        lineage (str): Column of the lineages in a personal lineage table
+    Returns:
+        pd.DataFrame: The lineage table with the accessions in the Genbank column
+    """
+    sha = hashlib.sha256(
+        f"{LINEAGE_CACHE_VERSION}\t{genome_ids}\t{lineage}\n".encode()
+    )
+    with open(VMR_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+
+    extension = "pkl" if feather is None else "feather"
+    cache_path = os.path.join(LINEAGE_CACHE_DIR, f"{sha.hexdigest()}.{extension}")
+
+    key = (cache_path, tuple(columns or []))
+    if key in LINEAGE_TABLES:
+        return LINEAGE_TABLES[key].copy()
+
+    if not os.path.exists(cache_path):
+        print_ok(f"Building the lineage table of {VMR_path}")
+        taxa_df = build_lineage_table(VMR_path, genome_ids, lineage)
+        for column in taxa_df.select_dtypes(include=["object", "string"]).columns:
+            taxa_df[column] = taxa_df[column].astype("category")
+
+        # Write to a temporary file first as parallel workers may read it
+        create_folder(LINEAGE_CACHE_DIR)
+        tmp_cache_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if feather is None:
+            taxa_df.to_pickle(tmp_cache_path)
+        else:
+            feather.write_feather(taxa_df, tmp_cache_path)
+        os.replace(tmp_cache_path, cache_path)
+
+    if feather is None:
+        taxa_df = pd.read_pickle(cache_path)
+    else:
+        taxa_df = feather.read_feather(cache_path, columns=columns)
+
+    if columns:
+        taxa_df = taxa_df[columns]
+
+    # The categories are only the storage format
+    for column in taxa_df.columns[taxa_df.dtypes == "category"]:
+        taxa_df[column] = taxa_df[column].astype(
+            taxa_df[column].cat.categories.dtype
+        )
+
+    LINEAGE_TABLES[key] = taxa_df
+
+    return taxa_df.copy()
+
+
+def save_lineage_table(path, VMR_path, genome_ids="Genome_id", lineage="Lineage"):
+    """Write the processed lineage table of the VMR to the results folder, with the
+    genome ids in the column of the VMR.xlsx or of the personal lineage table.
+    Args:
+        path (str): Path to the tab separated table to write
+        VMR_path (str): Path to the VMR.xlsx or to a tab separated lineage table
+        genome_ids (str): Column of the genome ids in a personal lineage table
+        lineage (str): Column of the lineages in a personal lineage table
+    """
+    taxa_df = load_lineage_table(VMR_path, genome_ids=genome_ids, lineage=lineage)
+    id_column = "Virus GENBANK accession" if VMR_path.endswith(".xlsx") else "Genome_id"
+    taxa_df = taxa_df.rename(columns={"Genbank": id_column})
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    taxa_df.to_csv(tmp_path, sep="\t", index=False)
+    os.replace(tmp_path, path)
+
+
+def index_fasta(fasta_path):
+    """Find the byte offsets and the length of every genome of a FASTA file.
+    Args:
+        fasta_path (str): Path to the uncompressed FASTA file
+    Returns:
+        pd.DataFrame: id, start and end offsets of each record and genome length
+    """
+    size = os.path.getsize(fasta_path)
+    if size == 0:
+        return pd.DataFrame(
+            {"id": [], "start": [], "end": [], "length": []}
+        ).astype({"id": object, "start": np.int64, "end": np.int64, "length": np.int64})
+
+    ids, starts, lengths = [], [], []
+    with open(fasta_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        headers = list(re.finditer(rb"^>([^\n]*)\n?", mm, re.MULTILINE))
+        ends = [header.start() for header in headers[1:]] + [size]
+        for header, end in zip(headers, ends):
+            ids.append(header.group(1).split(maxsplit=1)[0].decode())
+            starts.append(header.start())
+            sequence = mm[header.end() : end]
+            lengths.append(
+                len(sequence) - sequence.count(b"\n") - sequence.count(b"\r")
+            )
+
+    return pd.DataFrame({"id": ids, "start": starts, "end": ends, "length": lengths})
+
+
+def load_reference_catalog(
+    blastdb_path, VMR_path, genome_ids="Genome_id", lineage="Lineage"
+):
+    """Load the catalog of the reference genomes, once per process.
+    The offsets of the FASTA file are cached under ~/.taxmyPHAGE, named after the
+    path, size and modification time of the file.
+    Args:
+        blastdb_path (str): Path to the uncompressed FASTA file of the database
+        VMR_path (str): Path to the VMR.xlsx or to a tab separated lineage table
+        genome_ids (str): Column of the genome ids in a personal lineage table
+        lineage (str): Column of the lineages in a personal lineage table
+    Returns:
+        ReferenceCatalog: The catalog of the database
+    """
+    stat = os.stat(blastdb_path)
+    sha = hashlib.sha256(
+        f"{CATALOG_CACHE_VERSION}\t{os.path.abspath(blastdb_path)}\t"
+        f"{stat.st_size}\t{stat.st_mtime_ns}\n".encode()
+    )
+    cache_path = os.path.join(CATALOG_CACHE_DIR, f"{sha.hexdigest()}.tsv")
+
+    key = (cache_path, VMR_path, genome_ids, lineage)
+    if key in REFERENCE_CATALOGS:
+        return REFERENCE_CATALOGS[key]
+
+    if os.path.exists(cache_path):
+        offsets = pd.read_table(cache_path, dtype={"id": str}, keep_default_na=False)
+    else:
+        print_ok(f"Indexing the genomes of {blastdb_path}")
+        offsets = index_fasta(blastdb_path)
 
-        if level and prefix_taxa[level].endswith("_"):
-            prefix_taxa[level] += name
+        # Write to a temporary file first as parallel workers may read it
+        create_folder(CATALOG_CACHE_DIR)
+        tmp_cache_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        offsets.to_csv(tmp_cache_path, sep="\t", index=False)
+        os.replace(tmp_cache_path, cache_path)
+
+    taxa_df = load_lineage_table(
+        VMR_path, columns=["Genbank", "Genus"], genome_ids=genome_ids, lineage=lineage
+    )
+    accession_genus_dict = taxa_df.set_index("Genbank")["Genus"].to_dict()
+
+    catalog = ReferenceCatalog(blastdb_path, offsets, accession_genus_dict)
+    REFERENCE_CATALOGS[key] = catalog
+
+    return catalog
+
+
+class ReferenceCatalog:
+    """Genus index and byte offsets of the genomes of the reference database,
+    so that the genomes of a genus are read straight from the FASTA file.
+    """
+
+    def __init__(self, fasta_path, offsets, accession_genus_dict):
+        self.fasta_path = fasta_path
+
+        # Accessions can be given with or without their version, as blastdbcmd does
+        self.records = {}
+        for row in offsets.itertuples(index=False):
+            self.records.setdefault(row.id, (row.start, row.end, row.length))
+        for row in offsets.itertuples(index=False):
+            self.records.setdefault(row.id.split(".")[0], (row.start, row.end, row.length))
+
+        self.genus_index = {}
+        for accession, genus in accession_genus_dict.items():
+            self.genus_index.setdefault(genus, []).append(accession)
+
+    def accessions(self, genus):
+        """Accessions of the VMR classified in a genus."""
+        return self.genus_index.get(genus, [])
+
+    def length(self, accession):
+        """Length of a genome, None when it is not in the database."""
+        record = self.records.get(accession)
+        return None if record is None else record[2]
+
+    def write_genomes(self, accessions, outfile):
+        """Copy the records of the accessions found in the database to a FASTA file.
+        Args:
+            accessions (list): Accessions of the genomes, in the order to write them
+            outfile (str): Path to the FASTA file to write
+        Returns:
+            int: Number of genomes written
+        """
+        written = 0
+        with open(self.fasta_path, "rb") as f_in, open(outfile, "wb") as f_out:
+            for accession in accessions:
+                record = self.records.get(accession)
+                if record is None:
+                    ic(f"{accession} not found in {self.fasta_path}")
+                    continue
+                start, end, _ = record
+                f_in.seek(start)
+                data = f_in.read(end - start)
+                f_out.write(data if data.endswith(b"\n") else data + b"\n")
+                written += 1
+
+        return written
+
+
+def create_folder(mypath):
+    """
+    Created the folder that I need to store my result if it doesn't exist
+    :param mypath: path where I want the folder (write at the end of the path)
+    :type: string
+    :return: Nothing
+    """
 
     try:
-        if (level == "Species" or level == "Genus") and prefix_taxa["Species"].endswith(
-            "_"
-        ):
-            prefix_taxa["Species"] = f"s__{species_name}"
-    except Exception as e:
-        print(f"An error occurred while fixing the taxonomy: {e}")
-        sys.exit(f"{lineage} : {genome_id}")
+        os.makedirs(mypath)
+    except OSError:
+        pass
+
+    return
+
+
+def input_fasta_paths(fasta_files, suffixes=["fasta", "fna", "fsa", "fa"]):
+    """Input files of the genomes, the fasta files of the folders given included.
+    Args:
+        fasta_files (list): Paths to fasta files, gzipped or not, or to folders
+        suffixes (list): Extensions of the fasta files looked for in the folders
+    Returns:
+        list: Paths to the fasta files, in the order they are given
+    """
+    fasta_exts = re.compile("|".join([f"\.{suffix}(\.gz)?$" for suffix in suffixes]))
+    paths = []
+    for file in fasta_files:
+        if os.path.isdir(file):
+            _files = glob.glob(f"{file}/*")
+            paths.extend(x for x in _files if fasta_exts.search(x))
+
+        elif os.path.isfile(file):
+            paths.append(file)
+
+    return paths
+
+
+def open_fasta(path, mode="rt"):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def iter_input_records(paths, skip=None):
+    """Read the genomes of the input files one at a time, without the description
+    of their header.
+    Args:
+        paths (list): Paths to the fasta files, as given by input_fasta_paths
+        skip (callable): Genomes for which it returns True are left out
+    Yields:
+        SeqRecord: Each genome, in the order of the files
+    """
+    for path in paths:
+        with open_fasta(path) as handle:
+            for record in SeqIO.parse(handle, "fasta"):
+                if skip is not None and skip(record):
+                    continue
+                record.name = record.description = ""
+                yield record
+
+
+def count_input_genomes(paths):
+    """Count the genomes of the input files from the starts of their headers,
+    without parsing the sequences.
+    Args:
+        paths (list): Paths to the fasta files, as given by input_fasta_paths
+    Returns:
+        int: Number of genomes
+    """
+    num_genomes = 0
+    for path in paths:
+        with open_fasta(path, "rb") as handle:
+            previous = b"\n"
+            while chunk := handle.read(2**20):
+                num_genomes += chunk.count(b"\n>") + (
+                    previous == b"\n" and chunk[:1] == b">"
+                )
+                previous = chunk[-1:]
+
+    return num_genomes
+
+
+def create_files_and_result_paths(
+    fasta_files, tmp_fasta, suffixes=["fasta", "fna", "fsa", "fa"], skip=None
+):
+    num_genomes = 0
+    with open(tmp_fasta, "w") as f:
+        for record in iter_input_records(input_fasta_paths(fasta_files, suffixes), skip):
+            SeqIO.write(record, f, "fasta")
+            num_genomes += 1
+
+    return num_genomes
+
+
+def read_mash_output(mash_output):
+    """Read the tabular output of mash dist into a DataFrame.
+    Args:
+        mash_output (str): The text printed by mash dist
+    Returns:
+        pd.DataFrame: One row per hit with the mash columns
+    """
+    if not mash_output.strip():
+        return pd.DataFrame(columns=MASH_COLUMNS)
+
+    return pd.read_csv(
+        io.StringIO(mash_output),
+        sep="\t",
+        header=None,
+        names=MASH_COLUMNS,
+    )
+
+
+def mash_dist_batch(query_paths, mash_index_path, mash_dist, threads):
+    """Run one mash search for all the genomes of multi-fasta files.
+    The queries are sketched individually (-i) with the parameters of the index,
+    so the index is only loaded once for the whole run.
+    Args:
+        query_paths (list): Paths to the fasta files of the query genomes, gzipped or not
+        mash_index_path (str): Path to the mash index of the reference genomes
+        mash_dist (float): Maximum mash distance to report
+        threads (str): Number of threads given to mash
+    Returns:
+        Dict[str, pd.DataFrame]: The mash hits of each query, keyed by genome id
+    Raises:
+        OSError: When mash fails, with the error it printed
+    """
+    cmd = ["mash", "dist", "-i", "-d", str(mash_dist), "-p", str(threads)]
+    cmd += [mash_index_path, *query_paths]
+    ic(shlex.join(cmd))
+    process = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if process.returncode:
+        raise OSError(
+            f"{shlex.join(cmd)} failed with exit status {process.returncode}:\n"
+            f"{process.stderr.strip()}"
+        )
+
+    mash_df = read_mash_output(process.stdout)
+
+    return {
+        genome_id: hits.reset_index(drop=True)
+        for genome_id, hits in mash_df.groupby("Query", sort=False)
+    }
+
+
+def kmer_values(codes, k):
+    """Value of the k-mer starting at each position of a genome, two bits per base.
+    Args:
+        codes (np.ndarray): Bases of the genome, as given by BASE_CODES
+        k (int): Length of the k-mers, at most 31
+    Returns:
+        np.ndarray: The value of each k-mer, -1 when it has a base that is not ACGT
+    """
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    values = np.zeros(num_kmers, dtype=np.int64)
+    bases = (codes & 3).astype(np.int64)
+    for shift in range(k):
+        values = (values << 2) | bases[shift : shift + num_kmers]
+
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    values[invalid[k:] - invalid[:num_kmers] > 0] = -1
+
+    return values
+
+
+def murmurhash3_64(keys, seed=MASH_SEED):
+    """First 64 bits of the MurmurHash3_x64_128 of keys of the same length,
+    the hash used by mash for k-mers longer than 16.
+    Args:
+        keys (np.ndarray): One key per row, as bytes (uint8)
+        seed (int): Seed of the hash
+    Returns:
+        np.ndarray: The hash of each key (uint64)
+    """
+    c1, c2 = np.uint64(0x87C37B91114253D5), np.uint64(0x4CF5AD432745937F)
+
+    def rotl(x, r):
+        return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+    def fmix(h):
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xFF51AFD7ED558CCD)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xC4CEB9FE1A85EC53)
+        h ^= h >> np.uint64(33)
+        return h
+
+    num_keys, length = keys.shape
+    padded = np.zeros((num_keys, (length // 16 + 1) * 16), dtype=np.uint8)
+    padded[:, :length] = keys
+    words = padded.view("<u8")
+
+    h1 = np.full(num_keys, seed, dtype=np.uint64)
+    h2 = np.full(num_keys, seed, dtype=np.uint64)
+
+    for block in range(length // 16):
+        k1 = rotl(words[:, 2 * block] * c1, 31) * c2
+        h1 ^= k1
+        h1 = (rotl(h1, 27) + h2) * np.uint64(5) + np.uint64(0x52DCE729)
+        k2 = rotl(words[:, 2 * block + 1] * c2, 33) * c1
+        h2 ^= k2
+        h2 = (rotl(h2, 31) + h1) * np.uint64(5) + np.uint64(0x38495AB5)
+
+    # The tail is zero padded, the same as building it byte by byte
+    tail = length % 16
+    if tail > 8:
+        h2 ^= rotl(words[:, 2 * (length // 16) + 1] * c2, 33) * c1
+    if tail > 0:
+        h1 ^= rotl(words[:, 2 * (length // 16)] * c1, 31) * c2
+
+    h1 ^= np.uint64(length)
+    h2 ^= np.uint64(length)
+    h1 += h2
+    h2 += h1
+    h1 = fmix(h1)
+    h2 = fmix(h2)
+
+    return h1 + h2
+
+
+def minhash_sketch(codes, k=MASH_KMER_SIZE, sketch_size=MASH_SKETCH_SIZE):
+    """Sketch a genome as mash sketch does, with the lowest hashes of its canonical k-mers.
+    Args:
+        codes (np.ndarray): Bases of the genome, as given by BASE_CODES
+        k (int): Length of the k-mers, from 17 to 31
+        sketch_size (int): Number of hashes kept
+    Returns:
+        np.ndarray: The sorted hashes of the sketch (uint64)
+    """
+    forward = kmer_values(codes, k)
+    reverse = kmer_values(np.where(codes < 4, 3 - codes, 4)[::-1], k)[::-1]
+
+    # The canonical k-mer is the lowest of both strands in the ACGT order
+    canonical = np.minimum(forward, reverse)[forward >= 0]
+
+    shifts = 2 * np.arange(k - 1, -1, -1, dtype=np.int64)
+    keys = np.frombuffer(b"ACGT", dtype=np.uint8)[(canonical[:, None] >> shifts) & 3]
+    hashes = murmurhash3_64(keys)
+
+    # Only sort the lowest hashes, unless the repeated k-mers leave too few of them
+    if len(hashes) > 4 * sketch_size:
+        lowest = np.sort(np.partition(hashes, 4 * sketch_size)[: 4 * sketch_size])
+        lowest = lowest[np.diff(lowest, prepend=~lowest[:1]) != 0]
+        if len(lowest) >= sketch_size:
+            return lowest[:sketch_size]
+
+    hashes = np.sort(hashes)
+    return hashes[np.diff(hashes, prepend=~hashes[:1]) != 0][:sketch_size]
+
+
+class MinHashIndex:
+    """Sketches of the reference genomes, compared to query sketches as mash dist does."""
+
+    def __init__(self, names, lengths, hashes, counts, k=MASH_KMER_SIZE):
+        self.names = np.asarray(names, dtype=object)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.k = k
+
+        # All the hashes sorted, with their reference and their rank in its sketch
+        references = np.repeat(np.arange(len(self.names)), self.counts)
+        ranks = np.arange(len(hashes)) - np.repeat(
+            np.cumsum(self.counts) - self.counts, self.counts
+        )
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = np.asarray(hashes)[order]
+        self.references = references[order]
+        self.ranks = ranks[order]
+
+    def dist(self, queries, max_dist, sketch_size=MASH_SKETCH_SIZE, allowed=None):
+        """Mash distances and p-values between query sketches and the references.
+        Only the pairs sharing hashes are compared, the others have a distance of 1.
+        Args:
+            queries (list): (name, length, sketch) of each query genome
+            max_dist (float): Maximum distance to report
+            sketch_size (int): Size of the sketches
+            allowed (np.ndarray): Mask of the references to report, all when None
+        Returns:
+            pd.DataFrame: One row per hit with the mash columns
+        """
+        from scipy.stats import binom
+
+        num_references = len(self.names)
+        query_counts = np.array([len(sketch) for _, _, sketch in queries], dtype=np.int64)
+        query_hashes = np.concatenate(
+            [sketch for _, _, sketch in queries] + [np.empty(0, dtype=np.uint64)]
+        )
+        query_ids = np.repeat(np.arange(len(queries)), query_counts)
+        query_ranks = np.arange(len(query_hashes)) - np.repeat(
+            np.cumsum(query_counts) - query_counts, query_counts
+        )
+
+        # Every (query hash, reference hash) match
+        left = np.searchsorted(self.hashes, query_hashes, side="left")
+        matches = np.searchsorted(self.hashes, query_hashes, side="right") - left
+        total = matches.sum()
+        index = np.repeat(left - (np.cumsum(matches) - matches), matches) + np.arange(
+            total
+        )
+        pair = np.repeat(query_ids, matches) * num_references + self.references[index]
+        query_rank = np.repeat(query_ranks, matches)
+        reference_rank = self.ranks[index]
+
+        # A shared hash counts when it is among the lowest hashes of the union
+        # of both sketches, its rank in the union is found from its rank in each
+        # sketch and the number of lower shared hashes
+        order = np.lexsort((query_rank, pair))
+        pair, query_rank, reference_rank = (
+            pair[order],
+            query_rank[order],
+            reference_rank[order],
+        )
+        pairs, first, shared = np.unique(pair, return_index=True, return_counts=True)
+        lower_shared = np.arange(len(pair)) - np.repeat(first, shared)
+        in_union = query_rank + reference_rank - lower_shared < sketch_size
+        common = np.bincount(
+            np.searchsorted(pairs, pair[in_union]), minlength=len(pairs)
+        )
+
+        query, reference = pairs // num_references, pairs % num_references
+        union = query_counts[query] + self.counts[reference] - shared
+        denom = np.minimum(union, sketch_size)
+
+        jaccard = common / denom
+        with np.errstate(divide="ignore"):
+            distance = np.where(
+                common == denom,
+                0.0,
+                np.where(
+                    common == 0,
+                    1.0,
+                    -np.log(2 * jaccard / (1 + jaccard)) / self.k,
+                ),
+            )
+
+        # p-value of the shared hashes for random genomes of the same lengths
+        kmer_space = 4.0**self.k
+        query_lengths = np.array([length for _, length, _ in queries], dtype=np.float64)
+        pX = 1 / (1 + kmer_space / self.lengths[reference])
+        pY = 1 / (1 + kmer_space / query_lengths[query])
+        r = pX * pY / (pX + pY - pX * pY)
+        p_value = np.where(common > 0, binom.sf(common - 1, denom, r), 1.0)
+
+        hits = distance <= max_dist
+        if allowed is not None:
+            hits &= allowed[reference]
+
+        # The hits of each query in the order of the references, as mash prints them
+        hits = np.flatnonzero(hits)
+        hits = hits[np.lexsort((reference[hits], query[hits]))]
+
+        # mash prints 6 significant digits
+        def printed(values):
+            return [float(f"{value:.6g}") for value in values]
+
+        return pd.DataFrame(
+            {
+                "Reference": self.names[reference[hits]],
+                "Query": np.array([name for name, _, _ in queries], dtype=object)[
+                    query[hits]
+                ],
+                "distance": printed(distance[hits]),
+                "p-value": printed(p_value[hits]),
+                "shared-hashes": [
+                    f"{c}/{d}" for c, d in zip(common[hits], denom[hits])
+                ],
+                "ANI": np.nan,
+            },
+            columns=MASH_COLUMNS,
+        )
+
+
+def sketch_fasta(fasta_path, threads):
+    """Sketch every genome of a fasta file.
+    Args:
+        fasta_path (str): Path to the fasta file, gzipped or not
+        threads (str): Number of threads used to sketch the genomes
+    Returns:
+        list: (name, length, sketch) of each genome, in the order of the file
+    """
+
+    def sketch(record):
+        name, seq = record
+        codes = BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+        return name.split()[0], len(seq), minhash_sketch(codes)
+
+    sketches = []
+    with open_fasta(fasta_path) as fasta, ThreadPoolExecutor(
+        max_workers=int(threads)
+    ) as executor:
+        records = SimpleFastaParser(fasta)
+        # Read the genomes by chunks to keep the memory bounded
+        while chunk := list(islice(records, 256)):
+            sketches.extend(executor.map(sketch, chunk))
 
-    if prefix_taxa["Species"].endswith("_"):
-        prefix_taxa["Species"] = f"s__{genome_id}"
+    return sketches
 
-    if prefix_taxa["Genus"].endswith("_"):
-        prefix_taxa["Genus"] = f"g__{genome_id}"
 
-    return ";".join(list(prefix_taxa.values()))
+def load_minhash_index(fasta_path, threads):
+    """Load the sketches of the reference genomes, once per process.
+    They are cached under ~/.taxmyPHAGE, named after the path, size and
+    modification time of the fasta file.
+    Args:
+        fasta_path (str): Path to the fasta file of the reference genomes
+        threads (str): Number of threads used to sketch the genomes
+    Returns:
+        MinHashIndex: The sketches of the reference genomes
+    """
+    stat = os.stat(fasta_path)
+    sha = hashlib.sha256(
+        f"{SKETCH_CACHE_VERSION}\t{MASH_KMER_SIZE}\t{MASH_SKETCH_SIZE}\t{MASH_SEED}\t"
+        f"{os.path.abspath(fasta_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode()
+    )
+    cache_path = os.path.join(SKETCH_CACHE_DIR, f"{sha.hexdigest()}.npz")
+
+    if cache_path in MINHASH_INDEXES:
+        return MINHASH_INDEXES[cache_path]
+
+    if not os.path.exists(cache_path):
+        print_ok(f"Sketching the genomes of {fasta_path}")
+        sketches = sketch_fasta(fasta_path, threads)
+
+        # Write to a temporary file first as parallel workers may read it
+        create_folder(SKETCH_CACHE_DIR)
+        tmp_cache_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            tmp_cache_path,
+            names=np.array([name for name, _, _ in sketches], dtype=str),
+            lengths=np.array([length for _, length, _ in sketches], dtype=np.int64),
+            counts=np.array([len(sketch) for _, _, sketch in sketches], dtype=np.int64),
+            hashes=np.concatenate(
+                [sketch for _, _, sketch in sketches] + [np.empty(0, dtype=np.uint64)]
+            ),
+        )
+        os.replace(tmp_cache_path, cache_path)
+
+    with np.load(cache_path) as sketches:
+        index = MinHashIndex(
+            sketches["names"].astype(object),
+            sketches["lengths"],
+            sketches["hashes"],
+            sketches["counts"],
+        )
+    MINHASH_INDEXES[cache_path] = index
+
+    return index
+
+
+def native_mash_dist_batch(query_paths, index, taxa_df, mash_dist, threads):
+    """Same as mash_dist_batch, with the sketches computed in-process.
+    Only the reference genomes of the lineage table are reported, as in the ICTV
+    mash index.
+    Args:
+        query_paths (list): Paths to the fasta files of the query genomes, gzipped or not
+        index (MinHashIndex): Sketches of the reference genomes, see load_minhash_index
+        taxa_df (pd.DataFrame): Lineage table with the accessions in the Genbank column
+        mash_dist (float): Maximum mash distance to report
+        threads (str): Number of threads used to sketch the genomes
+    Returns:
+        Dict[str, pd.DataFrame]: The mash hits of each query, keyed by genome id
+    """
+    accessions = set(taxa_df["Genbank"])
+    allowed = np.array(
+        [name.split(".")[0] in accessions for name in index.names], dtype=bool
+    )
+
+    queries = [
+        sketch for path in query_paths for sketch in sketch_fasta(path, threads)
+    ]
+    mash_df = index.dist(queries, float(mash_dist), allowed=allowed)
+
+    return {
+        genome_id: hits.reset_index(drop=True)
+        for genome_id, hits in mash_df.groupby("Query", sort=False)
+    }
+
+
+def search_mash_hits(query_paths, config, references=None):
+    """Search all the genomes of multi-fasta files against the reference genomes,
+    with mash or in-process as set in the configuration.
+    Args:
+        query_paths (list): Paths to the fasta files of the query genomes, gzipped or not
+        config (Config): Parameters of the classification
+        references (ReferenceData): Reference data of the configuration, loaded
+            when None
+    Returns:
+        Dict[str, pd.DataFrame]: The mash hits of each query, keyed by genome id
+    """
+    if config.native_mash:
+        references = references or ReferenceData(config)
+        return native_mash_dist_batch(
+            query_paths,
+            references.minhash_index,
+            references.lineage_table(["Genbank"]),
+            config.mash_dist,
+            config.threads,
+        )
 
+    return mash_dist_batch(
+        query_paths, config.mash_index_path, config.mash_dist, config.threads
+    )
 
-def check_VMR(VMR_path):
-    VMR_df = pd.read_table(VMR_path)
-    VMR_df = VMR_df.rename(columns={args.genome_ids: "Genome_id", args.lineage: "Lineage"})
 
-    records = VMR_df.to_dict("records")
-    good_lineage = []
+class Config:
+    """Parameters of the classification of genomes, the options of the command line.
+    The database files are expected to be ready, as left by a run of the command
+    line which downloads them and builds their indexes.
+    """
 
-    for row in tqdm(
-        records,
-        colour="blue",
-        desc="Adding prefix to lineage",
-        leave=False,
+    def __init__(
+        self,
+        output="taxmyphage_results",
+        VMR_path=os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "VMR.xlsx"),
+        blastdb_path=os.path.join(
+            os.path.expanduser("~"), ".taxmyPHAGE", "Bacteriophage_genomes.fasta"
+        ),
+        mash_index_path=os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "ICTV.msh"),
+        threads="8",
+        mash_dist=0.2,
+        prefix="",
+        figures=True,
+        figure_formats=("svg", "pdf", "jpg"),
+        add_genomes="",
+        extra_thresholds=(),
+        pair_cache="",
+        lean_blast=False,
+        native_mash=False,
+        aligner="blastn",
+        genome_ids="Genome_id",
+        lineage="Lineage",
+        verbose=False,
+        trace=False,
+        profile=False,
     ):
-        if row["Lineage"] == row["Lineage"]:
-            good_lineage.append(
-                fix_taxa_column(
-                    lineage=row["Lineage"].split(";"),
-                    species_name=row["Lineage"].split(";")[-1],
-                    genome_id=row["Genome_id"],
-                )
-            )
-        else:
-            good_lineage.append(
-                fix_taxa_column(
-                    lineage="",
-                    species_name=row["Genome_id"],
-                    genome_id=row["Genome_id"],
-                )
-            )
-    # Adding the good lineage
-    VMR_df["Lineage_prefix"] = good_lineage
+        self.output = output
+        self.VMR_path = VMR_path
+        self.blastdb_path = blastdb_path
+        self.mash_index_path = mash_index_path
+        self.threads = str(threads)
+        self.mash_dist = mash_dist
+        self.prefix = prefix
+        self.figures = figures
+        self.figure_formats = list(figure_formats)
+        self.add_genomes = add_genomes
+        self.extra_thresholds = list(extra_thresholds)
+        self.pair_cache = pair_cache
+        self.lean_blast = lean_blast
+        self.native_mash = native_mash
+        self.aligner = aligner
+        self.genome_ids = genome_ids
+        self.lineage = lineage
+        self.verbose = verbose
+        # write the StageTrace and a cProfile of Run() in the results folders
+        self.trace = trace
+        self.profile = profile
+
+    @classmethod
+    def from_args(cls, args, VMR_path, blastdb_path, mash_index_path):
+        """Configuration given on the command line, with the checked database paths."""
+        return cls(
+            output=args.output,
+            VMR_path=VMR_path,
+            blastdb_path=blastdb_path,
+            mash_index_path=mash_index_path,
+            threads=args.threads,
+            mash_dist=args.dist,
+            prefix=args.prefix,
+            figures=args.Figure,
+            figure_formats=args.figure_formats,
+            add_genomes=args.add_genomes,
+            extra_thresholds=args.extra_thresholds,
+            pair_cache=args.pair_cache,
+            lean_blast=args.lean_blast,
+            native_mash=args.native_mash,
+            aligner=args.aligner,
+            genome_ids=args.genome_ids,
+            lineage=args.lineage,
+            verbose=args.verbose,
+            trace=args.trace,
+            profile=args.profile,
+        )
 
-    # Make sure that all the lineage is there
-    VMR_df["Lineage"] = VMR_df["Lineage_prefix"].apply(
-        lambda row: ";".join([name.split("__")[-1] for name in row.split(";")])
-    )
-
-    taxonomy_level = [
-        "Root",
-        "Realm",
-        "Subrealm",
-        "Kingdom",
-        "Subkingdom",
-        "Phylum",
-        "Subphylum",
-        "Class",
-        "Subclass",
-        "Order",
-        "Suborder",
-        "Family",
-        "Subfamily",
-        "Genus",
-        "Species",
-    ]
+    def replace(self, **changes):
+        """Copy of the configuration with some of its parameters changed."""
+        return Config(**{**vars(self), **changes})
 
-    try:
-        split_df = VMR_df["Lineage"].str.split(";")
-        VMR_df[taxonomy_level] = pd.DataFrame.from_records(
-            zip_longest(*split_df.values)
-        ).T.values
-    except Exception as e:
-        print(f"An error occurred while splitting the lineage: {e}")
-        split_df = VMR_df["Lineage"].str.split(";")
-        print(f"Lineage: {pd.DataFrame.from_records(zip_longest(*split_df.values)).T}")
-        sys.exit()
 
-    return VMR_df
+class ClassificationResult:
+    """Predicted taxonomy of a genome, as returned by Run().
+    The status is one of:
+        no_hits: mash found no close relative, the genome is not classified
+        new_genus: the genome is the first of a new genus and species
+        new_species: the genome is in a current genus, as a new species
+        current_species: the genome is in a current genus and species
+        undetermined: the genus clusters and the ICTV genera disagree
+    """
 
+    def __init__(
+        self,
+        genome_id,
+        results_path,
+        status,
+        lineage=None,
+        mash_hits=None,
+        consistent=None,
+        run_time=None,
+    ):
+        self.genome_id = genome_id
+        self.results_path = results_path
+        self.status = status
+        # Class, Family, Subfamily, Genus and Species, when they are known
+        self.lineage = lineage or {}
+        self.mash_hits = mash_hits
+        # whether the genus clusters match the ICTV genera of the references
+        self.consistent = consistent
+        self.run_time = run_time
+
+    def __repr__(self):
+        return (
+            f"ClassificationResult({self.genome_id!r}, status={self.status!r}, "
+            f"lineage={self.lineage!r})"
+        )
 
-def create_folder(mypath):
-    """
-    Created the folder that I need to store my result if it doesn't exist
-    :param mypath: path where I want the folder (write at the end of the path)
-    :type: string
-    :return: Nothing
+    def to_dict(self):
+        """The result as JSON serialisable values."""
+        return {
+            "genome_id": self.genome_id,
+            "results_path": self.results_path,
+            "status": self.status,
+            "lineage": self.lineage,
+            "consistent": self.consistent,
+            "run_time": self.run_time,
+            "mash_hits": (
+                [] if self.mash_hits is None else self.mash_hits.to_dict("records")
+            ),
+        }
+
+
+class ReferenceData:
+    """Reference data of a configuration: the lineage table, the catalog of the
+    database and, with native_mash, the sketches of its genomes. They are read
+    from the caches of the loaders and only read afterwards, so that they can be
+    shared by threads.
     """
 
-    try:
-        os.makedirs(mypath)
-    except OSError:
-        pass
+    def __init__(self, config):
+        self.taxa_df = load_lineage_table(
+            config.VMR_path, genome_ids=config.genome_ids, lineage=config.lineage
+        )
+        self.catalog = load_reference_catalog(
+            config.blastdb_path, config.VMR_path, config.genome_ids, config.lineage
+        )
+        self.minhash_index = (
+            load_minhash_index(config.blastdb_path, config.threads)
+            if config.native_mash
+            else None
+        )
 
-    return
+    def lineage_table(self, columns=None):
+        """Copy of the lineage table, of some of its columns."""
+        return (self.taxa_df[columns] if columns else self.taxa_df).copy()
 
 
-def read_write_fasta(input_file, f):
-    handle = (
-        gzip.open(input_file, "rt")
-        if input_file.endswith(".gz")
-        else open(input_file, "rt")
-    )
+class Classifier:
+    """Classify phage genomes in-process, for use as a library. The reference data
+    of the configuration are loaded once, when the classifier is created, and
+    shared by all its classifications:
 
-    num = 0
+        classifier = Classifier(Config(output="results", threads=4))
+        for result in classifier.classify(SeqIO.parse("phages.fasta", "fasta")):
+            print(result.genome_id, result.status, result.lineage)
 
-    parser = SeqIO.parse(handle, "fasta")
-    for record in parser:
-        record.name = record.description = ""
-        SeqIO.write(record, f, "fasta")
-        num += 1
-    handle.close()
+    A classifier can be used by several threads at once, as long as they classify
+    different genomes or write to different results folders. The debug output of
+    icecream is switched on or off by config.verbose for the calls of the
+    classifier only.
+    """
 
-    return num
+    def __init__(self, config):
+        self.config = config
+        with ic.verbose(config.verbose):
+            self.references = ReferenceData(config)
+
+    def classify(self, records):
+        """Classify genomes one after the other, searching them against the mash
+        index all at once first.
+        Args:
+            records (iterable): The genomes to classify, as SeqRecord
+        Yields:
+            ClassificationResult: The result of each genome, in the order of the records
+        """
+        create_folder(self.config.output)
+        query_fasta = os.path.join(
+            self.config.output, f"queries.{uuid.uuid4().hex}.fasta"
+        )
+        try:
+            with open(query_fasta, "w") as f:
+                for record in records:
+                    record = SeqRecord(record.seq, id=record.id, name="", description="")
+                    SeqIO.write(record, f, "fasta")
+
+            with ic.verbose(self.config.verbose):
+                mash_hits = search_mash_hits(
+                    [query_fasta], self.config, self.references
+                )
 
+            for record in SeqIO.parse(query_fasta, "fasta"):
+                results_path = os.path.join(self.config.output, record.id)
+                genome_mash_df = mash_hits.get(
+                    record.id, pd.DataFrame(columns=MASH_COLUMNS)
+                )
+                # The setting is left before handing the result to the caller
+                with ic.verbose(self.config.verbose):
+                    result = Run(
+                        record, results_path, self.config, genome_mash_df, self.references
+                    )
+                yield result
+        finally:
+            os.remove(query_fasta)
 
-def create_files_and_result_paths(
-    fasta_files, tmp_fasta, suffixes=["fasta", "fna", "fsa", "fa"]
-):
-    fasta_exts = re.compile("|".join([f"\.{suffix}(\.gz)?$" for suffix in suffixes]))
-    num_genomes = 0
-    with open(tmp_fasta, "w") as f:
-        for file in fasta_files:
-            if os.path.isdir(file):
-                _files = glob.glob(f"{file}/*")
-                _files = [x for x in _files if fasta_exts.search(x)]
 
-                for _file in _files:
-                    num = read_write_fasta(_file, f)
-                    num_genomes += num
+def classify(records, config):
+    """Classify genomes in-process.
+    Args:
+        records (iterable): The genomes to classify, as SeqRecord
+        config (Config): Parameters of the classification
+    Returns:
+        List[ClassificationResult]: The result of each genome, in the order of the records
+    """
+    return list(Classifier(config).classify(records))
 
-            elif os.path.isfile(file):
-                num = read_write_fasta(file, f)
-                num_genomes += num
 
-    return num_genomes
+def Run(record, results_path, config, mash_df=None, references=None):
+    """Classify a genome against the genomes of the closest genera.
+    With config.trace the stages are traced to trace.json in the results folder,
+    and with config.profile the classification is profiled to profile.prof.
+    Args:
+        record (SeqRecord): The genome to classify
+        results_path (str): Path to the folder of the results of the genome
+        config (Config): Parameters of the classification
+        mash_df (pd.DataFrame): The mash hits of the genome, searched when None
+        references (ReferenceData): Reference data of the configuration, loaded
+            when None
+    Returns:
+        ClassificationResult: The predicted taxonomy of the genome
+    """
+    trace = StageTrace(enabled=config.trace)
+    profile = None
+    if config.profile:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    try:
+        with trace.stage("total"):
+            return classify_genome(
+                record, results_path, config, mash_df, trace, references
+            )
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(
+                os.path.join(results_path, config.prefix + "profile.prof")
+            )
+        if config.trace:
+            trace.save(
+                os.path.join(results_path, config.prefix + "trace.json"),
+                genome_id=record.id,
+                genome_length=len(record.seq),
+                threads=int(config.threads),
+            )
 
 
-def Run(record, results_path):
+def classify_genome(record, results_path, config, mash_df, trace, references=None):
+    """Classification of a genome by Run(), with its stages traced.
+    Args:
+        record (SeqRecord): The genome to classify
+        results_path (str): Path to the folder of the results of the genome
+        config (Config): Parameters of the classification
+        mash_df (pd.DataFrame): The mash hits of the genome, searched when None
+        trace (StageTrace): Trace of the stages of the classification
+        references (ReferenceData): Reference data of the configuration, loaded
+            when None
+    Returns:
+        ClassificationResult: The predicted taxonomy of the genome
+    """
     timer_start = time.time()
+    references = references or ReferenceData(config)
 
-    ic("Number of set threads", threads)
+    ic("Number of set threads", config.threads)
     # create results folder
     query = os.path.join(results_path, "query.fasta")
 
     # path to the combined df containing mash and VMR data
-    out_csv_of_taxonomy = args.prefix + "Output_of_taxonomy.csv"
+    out_csv_of_taxonomy = config.prefix + "Output_of_taxonomy.csv"
     taxa_csv_output_path = os.path.join(results_path, out_csv_of_taxonomy)
 
     # path the final results summary file
-    summary_results = args.prefix + "Summary_file.txt"
+    summary_results = config.prefix + "Summary_file.txt"
     summary_output_path = os.path.join(results_path, summary_results)
 
     # fasta file to store known taxa
@@ -764,50 +3500,33 @@ def Run(record, results_path):
     # create the results folder
     create_folder(results_path)
 
+    # The record of the caller is left untouched
+    result = ClassificationResult(record.id, results_path, "undetermined")
+    record = SeqRecord(record.seq, id=f"query_{record.id}", name="", description="")
     with open(query, "w") as output_fid:
-        record.name = record.description = ""
-        record.id = f"query_{record.id}"
         SeqIO.write(record, output_fid, "fasta")
 
-    new_VMR_path = os.path.join(os.path.dirname(results_path), "lineages.tsv")
-
-    # Read the viral master species record into a DataFrame
-    if os.path.exists(new_VMR_path):
-        taxa_df = pd.read_csv(new_VMR_path, sep="\t").fillna("")
-    else:
-        taxa_df = (
-            pd.read_excel(VMR_path, sheet_name=0)
-            if VMR_path.endswith(".xlsx")
-            else check_VMR(VMR_path)
-        )
-        taxa_df.to_csv(new_VMR_path, sep="\t", index=False)
+    # Read the accessions and genera of the viral master species record into a DataFrame
+    taxa_df = references.lineage_table(["Genbank", "Genus"])
 
-    # Print the DataFrame and rename a column
+    # Print the DataFrame
     ic(taxa_df.head())
 
-    taxa_df = taxa_df.rename(
-        columns={"Virus GENBANK accession": "Genbank", "Genome_id": "Genbank"}
-    )
-    taxa_df["Genbank"].fillna("", inplace=True)
-    # Get the column headings as a list
-
-    # headings = list(taxa_df.columns)
     # create a dictionary of Accessions linking to Genus
     accession_genus_dict = taxa_df.set_index("Genbank")["Genus"].to_dict()
 
     # run mash to get top hit and read into a pandas dataframe
-    cmd = f"mash dist -d {mash_dist} -p {threads} {mash_index_path} {query}"
-    ic(cmd)
-    mash_output = subprocess.getoutput(cmd)
-    # mash_output = subprocess.check_output(['mash', 'dist', '-d', mash_dist, '-p', threads, mash_index_path, query])
+    # (skipped when the hits were already computed for the whole batch)
+    if mash_df is None:
+        cmd = f"mash dist -d {config.mash_dist} -p {config.threads} {config.mash_index_path} {query}"
+        ic(cmd)
+        with trace.stage("mash", genomes=1) as stage:
+            mash_output = subprocess.getoutput(cmd)
+            # mash_output = subprocess.check_output(['mash', 'dist', '-d', mash_dist, '-p', threads, mash_index_path, query])
+
+            mash_df = read_mash_output(mash_output)
+            stage["hits"] = len(mash_df)
 
-    # list of names for the headers
-    mash_df = pd.read_csv(
-        io.StringIO(mash_output),
-        sep="\t",
-        header=None,
-        names=["Reference", "Query", "distance", "p-value", "shared-hashes", "ANI"],
-    )
     number_hits = mash_df.shape[0]
 
     # get the number of genomes wih mash distance < 0.2
@@ -821,16 +3540,20 @@ def Run(record, results_path):
               """
         )
         os.system(f"touch {taxa_csv_output_path}")
-        sys.exit()
+        result.status = "no_hits"
+        result.mash_hits = mash_df
+        result.run_time = time.time() - timer_start
+        return result
     else:
         print_res(
             f"""
-        Number of phage genomes detected with mash distance of < {args.dist} is:{number_hits}"""
+        Number of phage genomes detected with mash distance of < {config.mash_dist} is:{number_hits}"""
         )
 
     # sort dataframe by distance so they are at the top
     mash_df = mash_df.sort_values(by="distance", ascending=True)
     mash_df.to_csv(os.path.join(results_path, "mash.txt"), index=False)
+    result.mash_hits = mash_df
     minimum_value = mash_df["distance"].min()
     maximum_value = mash_df.head(10)["distance"].max()
 
@@ -877,8 +3600,9 @@ def Run(record, results_path):
 
     print_ok(f"Found {number_of_genera} genera associated with this query genome\n")
 
-    # get all the keys for from a dictionary of accessions and genus names
-    keys = [k for k, v in accession_genus_dict.items() if v == unique_genera[0]]
+    # get all the keys for from the genus index of the reference catalog
+    catalog = references.catalog
+    keys = catalog.accessions(unique_genera[0])
 
     # print the keys
     ic(keys)
@@ -888,14 +3612,12 @@ def Run(record, results_path):
         print_ok(
             "Only found 1 genus so will proceed with getting all genomes associated with that genus"
         )
-        keys = [k for k, v in accession_genus_dict.items() if v == unique_genera[0]]
         number_ok_keys = len(keys)
         print_ok(f"Number of known species in the genus is {number_ok_keys} \n ")
-        # create a command string for blastdbcmd
-        get_genomes_cmd = f"blastdbcmd -db {blastdb_path} -entry {','.join(keys)} -out {known_taxa_path} "
-        # subprocess.run(get_genomes_cmd, shell=True, check=True)
-        ic(get_genomes_cmd)
-        res = subprocess.getoutput(get_genomes_cmd)
+        # read the genomes of the genus from the database
+        with trace.stage("reference_genomes", genomes=len(keys)):
+            number_genomes = catalog.write_genomes(keys, known_taxa_path)
+        ic(number_genomes)
 
     elif len(unique_genera) > 1:
         print_ok(
@@ -903,15 +3625,18 @@ def Run(record, results_path):
         )
         list_of_genus_accessions = []
         for i in unique_genera:
-            keys = [k for k, v in accession_genus_dict.items() if v == i]
+            keys = catalog.accessions(i)
             number_of_keys = len(keys)
             # ic(keys)
             list_of_genus_accessions.extend(keys)
             print_ok(f"Number of known species in the genus {i} is {number_of_keys}")
         ic(list_of_genus_accessions)
         ic(len(list_of_genus_accessions))
-        get_genomes_cmd = f"blastdbcmd -db {blastdb_path} -entry {','.join(list_of_genus_accessions)} -out {known_taxa_path}"
-        res = subprocess.getoutput(get_genomes_cmd)
+        with trace.stage("reference_genomes", genomes=len(list_of_genus_accessions)):
+            number_genomes = catalog.write_genomes(
+                list_of_genus_accessions, known_taxa_path
+            )
+        ic(number_genomes)
 
     # get smallest mash distance
 
@@ -943,24 +3668,59 @@ def Run(record, results_path):
         for file in list_genomes:
             SeqIO.write(SeqIO.parse(file, "fasta"), merged_file, "fasta")
 
-        if args.add_genomes:
-            parser = SeqIO.parse(args.add_genomes, "fasta")
-            for record in parser:
-                record.id = record.id + "_added"
-                record.name = record.description = ""
-                SeqIO.write(record, merged_file, "fasta")
-
-    PMV = PoorMansViridic(viridic_in_path, nthreads=threads, verbose=verbose)
-    df1, pmv_outfile = PMV.run()
+        if config.add_genomes:
+            parser = SeqIO.parse(config.add_genomes, "fasta")
+            for added in parser:
+                added.id = added.id + "_added"
+                added.name = added.description = ""
+                SeqIO.write(added, merged_file, "fasta")
+
+    # The identities of the lean blastn output are cached apart from the full ones
+    pair_cache = (
+        PairCache(
+            config.pair_cache,
+            method=(
+                "blastn-lean"
+                if config.aligner == "blastn" and config.lean_blast
+                else config.aligner
+            ),
+        )
+        if config.pair_cache
+        else None
+    )
+    PMV = PoorMansViridic(
+        viridic_in_path,
+        nthreads=config.threads,
+        verbose=config.verbose,
+        lean_blast=config.lean_blast and config.aligner == "blastn",
+        extra_thresholds=dict(config.extra_thresholds),
+        pair_cache=pair_cache,
+        aligner=KmerAligner(config.threads) if config.aligner == "kmer" else None,
+        trace=trace,
+    )
+    try:
+        df1, pmv_outfile = PMV.run()
+    finally:
+        if pair_cache is not None:
+            pair_cache.close()
 
     ic(df1)
     ic(pmv_outfile)
     ic(PMV.dfM)
 
     # heatmap and distances
-    if args.Figure:
+    if config.figures:
         print_ok("\nWill calculate and save heatmaps now")
-        heatmap(PMV.dfM, heatmap_file, top_right_matrix, accession_genus_dict)
+        with trace.stage(
+            "heatmap", genomes=len(PMV.size_dict), pairs=len(PMV.dfM)
+        ):
+            heatmap(
+                PMV.dfM,
+                heatmap_file,
+                top_right_matrix,
+                accession_genus_dict,
+                formats=config.figure_formats,
+            )
     else:
         print_error("\n Skipping calculating heatmaps and saving them \n ")
 
@@ -968,6 +3728,7 @@ def Run(record, results_path):
 
     # merge the ICTV dataframe with the results of viridic
     # fill in missing with Not Defined yet
+    taxa_df = references.lineage_table()
     merged_df = pd.merge(
         df1, taxa_df, left_on="genome", right_on="Genbank", how="left"
     ).fillna("Not Defined Yet")
@@ -1002,6 +3763,7 @@ def Run(record, results_path):
     Number of VIRIDIC-algorithm predicted genera (excluding query) was: {num_unique_viridic_genus_clusters} """
     )
 
+    result.consistent = bool(num_unique_ICTV_genera == num_unique_viridic_genus_clusters)
     if num_unique_ICTV_genera == num_unique_viridic_genus_clusters:
         print(
             f"""\n\nCurrent ICTV and VIRIDIC-algorithm predictions are consistent for the data that was used to compare against"""
@@ -1063,17 +3825,20 @@ def Run(record, results_path):
             file.write(
                 f"""Try running again with if you larger distance if you want a Figure.
             The query is both a new genus and species\n
-            {args.prefix}\tNew genus\tNew species\n"""
+            {config.prefix}\tNew genus\tNew species\n"""
             )
 
-        run_time = str(timedelta(seconds=time.time() - timer_start))
-        print(f"Run time for {genome.id}: {run_time}\n")
+        result.status = "new_genus"
+        result.run_time = time.time() - timer_start
+        run_time = str(timedelta(seconds=result.run_time))
+        print(f"Run time for {record.id}: {run_time}\n")
         print("-" * 80)
-        return
+        return result
 
     predicted_genus_name = dict_genus_cluster_2_genus_name[query_genus_cluster_number]
 
     print(f"\nPredicted genus is: {predicted_genus_name}\n")
+    result.lineage = {"Genus": predicted_genus_name}
     # create a dict of species to species_cluster
 
     # if number of ICTV genera and predicted VIRIDIC genera match:
@@ -1106,6 +3871,8 @@ def Run(record, results_path):
             ic(matching_species_row)
 
             list_of_S_data = matching_species_row.iloc[0].to_dict()
+            result.status = "current_species"
+            result.lineage = {level: list_of_S_data[level] for level in RESULT_LEVELS}
             ic(list_of_S_data)
             print_res(
                 f"""\nQuery sequence is: 
@@ -1144,6 +3911,11 @@ def Run(record, results_path):
                 merged_df["genus_cluster"] == query_genus_cluster_number
             ]
             dict_exemplar_genus = matching_genus_rows.iloc[0].to_dict()
+            result.status = "new_species"
+            result.lineage = {
+                level: dict_exemplar_genus[level] for level in RESULT_LEVELS
+            }
+            result.lineage["Species"] = None
             genus_value = dict_exemplar_genus["Genus"]
             ic(matching_genus_rows)
             ic(genus_value)
@@ -1179,6 +3951,8 @@ def Run(record, results_path):
             WARNING taxmyPHAGE does not compare against all other known phages, only those that have been classified
             \n"""
             )
+            result.status = "new_genus"
+            result.lineage = {}
 
             with open(summary_output_path, "a") as file:
                 file.write(
@@ -1228,6 +4002,10 @@ def Run(record, results_path):
                 ic(matching_species_row)
 
                 list_of_S_data = matching_species_row.iloc[0].to_dict()
+                result.status = "current_species"
+                result.lineage = {
+                    level: list_of_S_data[level] for level in RESULT_LEVELS
+                }
                 ic(list_of_S_data)
                 print_res(
                     f"""\nQuery sequence is: 
@@ -1263,6 +4041,11 @@ def Run(record, results_path):
                 merged_df["genus_cluster"] == query_genus_cluster_number
             ]
             dict_exemplar_genus = matching_genus_rows.iloc[0].to_dict()
+            result.status = "new_species"
+            result.lineage = {
+                level: dict_exemplar_genus[level] for level in RESULT_LEVELS
+            }
+            result.lineage["Species"] = None
             genus_value = dict_exemplar_genus["Genus"]
             ic(matching_genus_rows)
             ic(genus_value)
@@ -1290,10 +4073,588 @@ def Run(record, results_path):
                 summary_output_path, mode="a", header=True, index=False, sep="\t"
             )
 
-    run_time = str(timedelta(seconds=time.time() - timer_start))
-    print(f"Run time for {genome.id}: {run_time}\n", file=sys.stderr)
+    result.run_time = time.time() - timer_start
+    run_time = str(timedelta(seconds=result.run_time))
+    print(f"Run time for {record.id}: {run_time}\n", file=sys.stderr)
     print("-" * 80, file=sys.stderr)
 
+    return result
+
+
+def level_threshold(value):
+    """Parse a LEVEL=SIM cluster threshold given on the command line.
+    Args:
+        value (str): The level name and its similarity threshold, e.g. subfamily=50
+    Returns:
+        tuple: The level name and the threshold
+    Raises:
+        ArgumentTypeError: When the level has no name or is genus or species, whose
+            thresholds are the ICTV ones
+    """
+    level, _, th = value.partition("=")
+    try:
+        th = float(th)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not of the form LEVEL=SIM")
+    if not level.strip():
+        raise ArgumentTypeError(f"{value} has no level name")
+    if level in ("genus", "species"):
+        raise ArgumentTypeError(
+            f"The {level} threshold cannot be changed, use another level name"
+        )
+
+    return level, th
+
+
+def init_worker(config, daemon=False):
+    """Prepare a worker process classifying genomes with Run().
+    Args:
+        config (Config): Parameters of the classification
+        daemon (bool): Worker of the daemon mode, the reference data are loaded
+            now and interruptions are left to the daemon
+    """
+    if config.verbose:
+        ic.enable()
+    else:
+        ic.disable()
+
+    if daemon:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        Classifier(config)
+
+
+def worker_config(config, jobs):
+    """Configuration of the worker processes.
+    The threads given with --threads are shared between the workers.
+    Args:
+        config (Config): Parameters of the classification
+        jobs (int): Number of worker processes
+    Returns:
+        Config: The configuration with the threads of a worker
+    """
+    return config.replace(threads=str(max(1, int(config.threads) // jobs)))
+
+
+class RunManifest:
+    """Progress of a run of the command line, kept in run_manifest.json in the
+    output folder so that a run started again with --resume skips the genomes
+    already classified. Each genome is recorded with the hash of its sequence,
+    as "running" once given to Run() and "done" once its results are written,
+    and the manifest with the parameters of the run. It is written to a
+    temporary file and moved in place after each change, a crash leaves the
+    previous version.
+    """
+
+    def __init__(self, path, params, resume=False):
+        self.path = path
+        self.params = json.loads(json.dumps(params))
+        self.resume = resume
+        self.genomes = {}
+
+        if resume:
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = None
+
+            if manifest is None or manifest.get("version") != RUN_MANIFEST_VERSION:
+                print_warn(f"No manifest of a previous run in {path}, classifying all the genomes")
+            elif manifest["params"] != self.params:
+                print_warn(
+                    "The parameters or the database changed since the previous run, classifying all the genomes again"
+                )
+            else:
+                self.genomes = manifest["genomes"]
+                done = sum(genome["state"] == "done" for genome in self.genomes.values())
+                print_ok(f"Resuming the previous run, {done} genomes are already classified")
+
+        self.save()
+
+    @staticmethod
+    def params_of(config):
+        """Parameters of a configuration that change the results of the genomes,
+        with a hash of the size and modification time of the database files.
+        """
+        params = {
+            name: value
+            for name, value in vars(config).items()
+            if name not in ("output", "threads", "verbose", "trace", "profile")
+        }
+        params["database"] = environment_key(
+            "database", [], [config.VMR_path, config.blastdb_path, config.mash_index_path]
+        )
+        return params
+
+    @staticmethod
+    def sequence_hash(record):
+        return hashlib.sha256(str(record.seq).upper().encode()).hexdigest()
+
+    def is_done(self, record):
+        """Whether a genome with the same sequence was classified by the run."""
+        genome = self.genomes.get(record.id)
+        return (
+            genome is not None
+            and genome["state"] == "done"
+            and genome["sha256"] == self.sequence_hash(record)
+        )
+
+    def start(self, record, results_path):
+        """Record that a genome is given to Run(), without saving the manifest.
+        When resuming, the results folder of a genome left running is cleaned of
+        everything but the blastn outputs, which are only written once complete,
+        and the folder of a genome unknown to the manifest is removed.
+        """
+        sha256 = self.sequence_hash(record)
+        genome = self.genomes.get(record.id)
+
+        if self.resume and os.path.isdir(results_path):
+            if genome is not None and genome["sha256"] == sha256:
+                for path in glob.glob(os.path.join(results_path, "*")):
+                    name = os.path.basename(path)
+                    if not (name.endswith(".tab.gz") and ".shard" not in name):
+                        ic(f"Removing {path} left by the previous run")
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+            else:
+                ic(f"Removing {results_path} of another genome or run")
+                shutil.rmtree(results_path)
+
+        self.genomes[record.id] = {
+            "sha256": sha256,
+            "results_path": results_path,
+            "state": "running",
+        }
+
+    def finish(self, result):
+        """Record the result of a genome and save the manifest."""
+        self.genomes[result.genome_id].update(
+            state="done", status=result.status, run_time=result.run_time
+        )
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": RUN_MANIFEST_VERSION,
+                    "params": self.params,
+                    "genomes": self.genomes,
+                },
+                f,
+                indent=1,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def run_parallel(parser, mash_hits, config, jobs, manifest, total=None):
+    """Classify the genomes in parallel worker processes.
+    The threads given with --threads are shared between the workers. Only twice
+    as many genomes as workers are submitted at once, the next ones are read from
+    the parser as they finish.
+    Args:
+        parser (iterator): The genomes to classify
+        mash_hits (dict): The mash hits of each genome, keyed by genome id
+        config (Config): Parameters of the classification
+        jobs (int): Number of worker processes
+        manifest (RunManifest): Progress of the run, updated as genomes finish
+        total (int): Number of genomes of the parser, for the progress bar
+    """
+    config = worker_config(config, jobs)
+
+    print_ok(f"Classifying with {jobs} workers of {config.threads} threads each\n")
+
+    genomes = iter(parser)
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker, initargs=(config,)
+    ) as executor, tqdm(desc="Classifying", total=total) as progress:
+        futures = set()
+        while True:
+            for genome in genomes:
+                if manifest.is_done(genome):
+                    progress.update()
+                    continue
+                results_path = os.path.join(config.output, genome.id)
+                genome_mash_df = mash_hits.get(
+                    genome.id, pd.DataFrame(columns=MASH_COLUMNS)
+                )
+                manifest.start(genome, results_path)
+                futures.add(
+                    executor.submit(Run, genome, results_path, config, genome_mash_df)
+                )
+                if len(futures) >= 2 * jobs:
+                    break
+
+            if not futures:
+                break
+            manifest.save()
+
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                manifest.finish(future.result())
+                progress.update()
+
+
+class ClassificationService:
+    """Queue of the classification jobs of the daemon mode.
+    The genomes of the jobs are classified by a pool of worker processes started
+    once, with the lineage table and the catalog of the database already loaded,
+    so that a job only pays for its own mash search and alignments. The pool is
+    started again when a worker dies, and the finished jobs are forgotten with
+    their folder after retention seconds.
+    """
+
+    def __init__(self, config, jobs, max_queued=100, retention=86400):
+        self.jobs = {}
+        self.events = {}
+        self.lock = threading.Lock()
+        self.workers_lock = threading.Lock()
+        self.config = config
+        self.max_queued = max_queued
+        self.retention = retention
+        self.num_workers = jobs
+
+        self.worker_config = worker_config(config, jobs)
+        print_ok(
+            f"Starting {jobs} workers of {self.worker_config.threads} threads each\n"
+        )
+        self.executor = self.start_workers()
+
+        # The mash searches of the jobs run in the daemon, next to their warm index
+        self.dispatcher = ThreadPoolExecutor(max_workers=jobs)
+        if config.native_mash:
+            Classifier(config)
+
+    def start_workers(self):
+        """Start a pool of worker processes with the reference data loaded."""
+        executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=init_worker,
+            initargs=(self.worker_config, True),
+        )
+        # The workers are started on demand, submit one task per worker to warm them all
+        for future in [executor.submit(os.getpid) for _ in range(self.num_workers)]:
+            future.result()
+
+        return executor
+
+    def restart_workers(self, broken):
+        """Replace a pool broken by the death of a worker, unless another job
+        already did.
+        Args:
+            broken (ProcessPoolExecutor): The broken pool
+        """
+        with self.workers_lock:
+            if self.executor is not broken:
+                return
+            print_warn("A worker process died, starting the workers again")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.start_workers()
+
+    def submit_genome(self, genome, results_path, genome_mash_df):
+        """Classify a genome in a worker process.
+        Returns:
+            tuple: The future of the result and the pool running it
+        """
+        executor = self.executor
+        try:
+            future = executor.submit(
+                Run, genome, results_path, self.worker_config, genome_mash_df
+            )
+        except BrokenProcessPool:
+            self.restart_workers(executor)
+            executor = self.executor
+            future = executor.submit(
+                Run, genome, results_path, self.worker_config, genome_mash_df
+            )
+
+        return future, executor
+
+    def evict(self):
+        """Forget the jobs finished more than retention seconds ago and remove
+        their folder."""
+        expired = time.time() - self.retention
+        with self.lock:
+            job_ids = [
+                job_id
+                for job_id, job in self.jobs.items()
+                if job.get("finished", expired) < expired
+            ]
+            evicted = [self.jobs.pop(job_id) for job_id in job_ids]
+            for job_id in job_ids:
+                del self.events[job_id]
+
+        for job in evicted:
+            shutil.rmtree(job["results_path"], ignore_errors=True)
+
+    def pending(self):
+        """Number of jobs queued or running."""
+        with self.lock:
+            return sum(
+                job["status"] in ("queued", "running") for job in self.jobs.values()
+            )
+
+    def submit(self, fasta):
+        """Queue the classification of the genomes of a FASTA text.
+        Args:
+            fasta (bytes): The genomes to classify, in FASTA format
+        Returns:
+            dict: The job, None when the queue is full
+        Raises:
+            ValueError: When the text has no genome
+        """
+        self.evict()
+        if self.pending() >= self.max_queued:
+            return None
+
+        job_id = uuid.uuid4().hex
+        job_path = os.path.join(self.config.output, "jobs", job_id)
+        create_folder(job_path)
+
+        raw_fasta = os.path.join(job_path, "raw.fasta")
+        with open(raw_fasta, "wb") as f:
+            f.write(fasta)
+
+        input_fasta = os.path.join(job_path, "input.fasta")
+        try:
+            num_genomes = create_files_and_result_paths([raw_fasta], input_fasta)
+            if num_genomes == 0:
+                raise ValueError("No genome found in the request")
+        except ValueError:
+            shutil.rmtree(job_path)
+            raise
+        os.remove(raw_fasta)
+
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "submitted": time.time(),
+            "num_genomes": num_genomes,
+            "results_path": job_path,
+            "genomes": [],
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self.events[job_id] = threading.Event()
+
+        self.dispatcher.submit(self.run_job, job_id)
+
+        return self.get(job_id)
+
+    def get(self, job_id, wait=0):
+        """Copy of a job, None when it does not exist.
+        Args:
+            job_id (str): Identifier of the job
+            wait (float): Seconds to wait for the job to finish
+        Returns:
+            dict: The job
+        """
+        self.evict()
+        with self.lock:
+            event = self.events.get(job_id)
+        if event is None:
+            return None
+        if wait > 0:
+            event.wait(wait)
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def list(self):
+        """Identifier and status of the jobs."""
+        self.evict()
+        with self.lock:
+            return [
+                {"id": job["id"], "status": job["status"]} for job in self.jobs.values()
+            ]
+
+    def run_job(self, job_id):
+        """Search the genomes of a job against the mash index and classify them."""
+        # The event is kept from now on, evict() forgets it once the job is finished
+        with self.lock:
+            job = self.jobs[job_id]
+            event = self.events[job_id]
+            job["status"] = "running"
+
+        input_fasta = os.path.join(job["results_path"], "input.fasta")
+        try:
+            mash_hits = search_mash_hits([input_fasta], self.config)
+
+            futures = {}
+            for genome in SeqIO.parse(input_fasta, "fasta"):
+                results_path = os.path.join(job["results_path"], genome.id)
+                genome_mash_df = mash_hits.get(
+                    genome.id, pd.DataFrame(columns=MASH_COLUMNS)
+                )
+                future, executor = self.submit_genome(
+                    genome, results_path, genome_mash_df
+                )
+                futures[future] = (genome.id, results_path, executor)
+
+            for future, (genome_id, results_path, executor) in futures.items():
+                try:
+                    genome = future.result().to_dict()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self.restart_workers(executor)
+                    genome = {
+                        "genome_id": genome_id,
+                        "results_path": results_path,
+                        "status": "failed",
+                        "error": repr(e),
+                    }
+
+                summary = os.path.join(
+                    results_path, f"{self.config.prefix}Summary_file.txt"
+                )
+                if os.path.exists(summary):
+                    with open(summary) as f:
+                        genome["summary"] = f.read()
+
+                with self.lock:
+                    job["genomes"].append(genome)
+
+            status = "done"
+        except Exception as e:
+            with self.lock:
+                job["error"] = repr(e)
+            status = "failed"
+
+        with self.lock:
+            job["status"] = status
+            job["finished"] = time.time()
+            event.set()
+
+    def shutdown(self):
+        """Cancel the queued genomes and wait for the running ones."""
+        self.dispatcher.shutdown(wait=False, cancel_futures=True)
+        with self.workers_lock:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of the daemon mode.
+    POST /jobs with a FASTA body queues a job, GET /jobs lists the jobs and
+    GET /jobs/<id>?wait=SECONDS gives the status and results of a job.
+    """
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+
+        if parts == ["jobs"]:
+            self.send_json(200, self.server.service.list())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            try:
+                wait = float(parse_qs(url.query).get("wait", ["0"])[0])
+            except ValueError:
+                self.send_json(400, {"error": "wait must be a number of seconds"})
+                return
+            job = self.server.service.get(parts[1], wait)
+            if job is None:
+                self.send_json(404, {"error": f"No job {parts[1]}"})
+            else:
+                self.send_json(200, job)
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "jobs":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_json(400, {"error": "Content-Length must be a number of bytes"})
+            return
+        if length > self.server.max_request_size:
+            # The body is not read, the connection cannot be used again
+            self.close_connection = True
+            self.send_json(
+                413,
+                {"error": f"Requests are limited to {self.server.max_request_size} bytes"},
+            )
+            return
+
+        try:
+            job = self.server.service.submit(self.rfile.read(length))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        if job is None:
+            self.send_json(503, {"error": "Too many jobs queued, try again later"})
+        else:
+            self.send_json(202, job)
+
+    def log_message(self, format, *args):
+        ic(format % args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer listening on a Unix socket."""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def serve(address, config, jobs, max_queued, retention=86400, max_request_size=2**30):
+    """Run the daemon mode until it is interrupted.
+    Args:
+        address (str): HOST:PORT or PORT to listen on, or the path of a Unix socket
+        config (Config): Parameters of the classification
+        jobs (int): Number of genomes classified at the same time
+        max_queued (int): Maximum number of jobs queued or running
+        retention (float): Seconds the finished jobs and their results are kept
+        max_request_size (int): Maximum size in bytes of the FASTA text of a job
+    """
+    if ":" in address or address.isdigit():
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer(
+            (host or "127.0.0.1", int(port)), ServiceRequestHandler
+        )
+        where = f"http://{host or '127.0.0.1'}:{port}"
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, ServiceRequestHandler)
+        where = f"unix:{address}"
+
+    server.daemon_threads = True
+    server.max_request_size = max_request_size
+    server.service = ClassificationService(config, jobs, max_queued, retention)
+
+    print_ok(f"Listening on {where}, POST a FASTA file to /jobs to classify it\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+        if server.address_family == socket.AF_UNIX:
+            os.remove(address)
+
 
 if __name__ == "__main__":
     description = """Takes a phage genome as as fasta file and compares against all phage genomes that are currently classified 
@@ -1313,13 +4674,20 @@ if __name__ == "__main__":
         default="8",
         help="Maximum number of threads that will be used",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of genomes classified in parallel. The threads are shared between the jobs",
+    )
     parser.add_argument(
         "-i",
         "--input",
         dest="in_fasta",
         type=str,
         help="Path to an input fasta file(s), or directory containing fasta files",
-        required=True,
         nargs="+",
     )
     parser.add_argument(
@@ -1341,11 +4709,22 @@ if __name__ == "__main__":
         help="Path to the prebuilt MASH index of ICTV genomes",
         default="",
     )
+    parser.add_argument(
+        "--download_manifest",
+        dest="download_manifest",
+        type=str,
+        default="",
+        help="JSON file giving the url, sha256 or md5 of the reference files downloaded when"
+        " missing, keyed by VMR, mash_index and genomes, with etag_is_md5 set to true when"
+        " the ETag of a file is its MD5, as on S3",
+    )
     parser.add_argument(
         "--VMR",
         dest="VMR_file",
         type=str,
-        help="Path to an input fasta file",
+        help="Path to the VMR.xlsx or to a tab separated lineage table. Its processed"
+        " table is written to lineages.tsv in the output folder and cached in"
+        " ~/.taxmyPHAGE/lineages, which can be deleted to clear the cache",
         default=os.path.abspath(
             os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "VMR.xlsx")
         ),
@@ -1377,6 +4756,14 @@ if __name__ == "__main__":
         action="store_false",
         help="Use this option if you don't want to generate Figures. This will speed up the time it takes to run the script - but you get no Figures. ",
     )
+    parser.add_argument(
+        "--figure-formats",
+        dest="figure_formats",
+        choices=["svg", "pdf", "jpg", "png"],
+        nargs="+",
+        default=["svg", "pdf", "jpg"],
+        help="Formats of the heatmap figures to write (default: svg pdf jpg)",
+    )
     parser.add_argument(
         "-o",
         "--output",
@@ -1393,6 +4780,107 @@ if __name__ == "__main__":
         help="Path to a fasta file containing genomes to add to the viridic. This will be added to the viridic and the viridic"
         " figure will be updated",
     )
+    parser.add_argument(
+        "--extra_thresholds",
+        dest="extra_thresholds",
+        type=level_threshold,
+        nargs="+",
+        default=[],
+        metavar="LEVEL=SIM",
+        help="Additional similarity thresholds to cluster the genomes at, e.g. subfamily=50."
+        " A LEVEL_cluster column is added to the outputs for each of them",
+    )
+    parser.add_argument(
+        "--pair_cache",
+        dest="pair_cache",
+        type=str,
+        nargs="?",
+        const=os.path.abspath(
+            os.path.join(os.path.expanduser("~"), ".taxmyPHAGE", "pair_cache.sqlite")
+        ),
+        default="",
+        help="Keep the identities of the aligned pairs of genomes in a cache (default: ~/.taxmyPHAGE/pair_cache.sqlite)"
+        " so that only the pairs that were never aligned before, usually the ones of the query, are aligned",
+    )
+    parser.add_argument(
+        "--lean_blast",
+        dest="lean_blast",
+        action="store_true",
+        help="Ask blastn for a compact alignment encoding (btop) and read its output as it is produced"
+        " instead of writing it to a compressed file. The self hits are not read, each genome is given"
+        " an identity equal to its length with itself",
+    )
+    parser.add_argument(
+        "--native_mash",
+        dest="native_mash",
+        action="store_true",
+        help="Compute the mash distances in-process instead of running mash. The genomes of the"
+        " database are sketched once (k=21, s=1000) and the sketches cached in ~/.taxmyPHAGE",
+    )
+    parser.add_argument(
+        "--aligner",
+        dest="aligner",
+        choices=["blastn", "kmer"],
+        default="blastn",
+        help="Aligner used to compute the identities between the genomes. kmer estimates them"
+        " in-process from chained k-mer anchors, faster and without BLAST but less sensitive"
+        " for distant genomes (default: blastn)",
+    )
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        action="store_true",
+        help="Write the wall and CPU time, peak memory and input sizes of each stage of the"
+        " classification of a genome to trace.json in its results folder, and of the mash"
+        " search of all the genomes to mash_trace.json in the output folder",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Profile the classification of each genome with cProfile, to profile.prof in its"
+        " results folder. Read it with python -m pstats",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Resume the previous run in the output folder from its run_manifest.json, skipping"
+        " the genomes already classified with the same sequence and parameters",
+    )
+    parser.add_argument(
+        "--serve",
+        dest="serve",
+        type=str,
+        default="",
+        metavar="ADDRESS",
+        help="Run as a daemon instead of classifying the input, keeping the reference data loaded."
+        " It listens on ADDRESS, HOST:PORT or PORT for HTTP or a path for a Unix socket. POST a"
+        " FASTA file to /jobs to queue a job and GET /jobs/<id>?wait=SECONDS for its results."
+        " --jobs genomes are classified at the same time",
+    )
+    parser.add_argument(
+        "--max_queued",
+        dest="max_queued",
+        type=int,
+        default=100,
+        help="Maximum number of jobs queued or running in daemon mode, more are refused",
+    )
+    parser.add_argument(
+        "--job_retention",
+        dest="job_retention",
+        type=float,
+        default=24,
+        help="Hours the finished jobs of the daemon mode and their results are kept",
+    )
+    parser.add_argument(
+        "--max_request_mb",
+        dest="max_request_mb",
+        type=float,
+        default=1024,
+        help="Maximum size in MB of the FASTA file of a job in daemon mode, larger ones are"
+        " refused",
+    )
     parser.add_argument(
         "--perso_database",
         default=False,
@@ -1416,6 +4904,8 @@ if __name__ == "__main__":
     )
 
     args, nargs = parser.parse_known_args()
+    if not args.in_fasta and not args.serve:
+        parser.error("the following arguments are required: -i/--input")
     verbose = args.verbose
     # Defined and set some parameters
     threads = args.threads
@@ -1424,7 +4914,9 @@ if __name__ == "__main__":
     create_folder(args.output)
 
     # turn on ICECREAM reporting
-    if not verbose:
+    if verbose:
+        ic.enable()
+    else:
         ic.disable()
 
     # this is the location of where the script and the databases are (instead of current_directory which is the users current directory)
@@ -1439,6 +4931,9 @@ if __name__ == "__main__":
     )
 
     print("Looking for database files...\n")
+    sources = load_download_manifest(args.download_manifest)
+    downloads = {}
+    sketch_path = ""
 
     if os.path.exists(VMR_path):
         print_ok(f"Found {VMR_path} as expected")
@@ -1448,15 +4943,11 @@ if __name__ == "__main__":
     else:
         print_error(f"File {VMR_path} does not exist will try downloading now")
         print_error("Will download the current VMR now")
-        url = "https://ictv.global/vmr/current"
-        try:
-            create_folder(os.path.dirname(VMR_path))
-            wget.download(url, VMR_path)
-            print(f"\n{url} downloaded successfully!")
-        except Exception as e:
-            print(f"An error occurred while downloading {url}: {e}")
+        downloads[VMR_path] = sources["VMR"]
 
-    if os.path.exists(mash_index_path):
+    if args.native_mash:
+        print_ok("The genomes of the database will be sketched in-process")
+    elif os.path.exists(mash_index_path):
         print_ok(f"Found {mash_index_path} as expected")
     elif args.perso_database and not os.path.exists(mash_index_path):
         mash_index_path = os.path.join(
@@ -1466,40 +4957,137 @@ if __name__ == "__main__":
         if os.path.exists(mash_index_path):
             print_ok(f"Found {mash_index_path} as expected")
         else:
-            mash_index_subcommand = (
-                f"mash sketch -p {threads} -o {mash_index_path} -i {blastdb_path}"
-            )
-            try:
-                subprocess.run(mash_index_subcommand, shell=True, check=True)
-                print("mash sketch command executed successfully!\n")
-            except subprocess.CalledProcessError as e:
-                print(f"An error occurred while executing mash sketch: {e}")
-                sys.exit()
+            # Sketched while the BLAST database is built, see check_blastDB
+            sketch_path = mash_index_path
     else:
         print_error(f"File {mash_index_path} does not exist will create database now  ")
         print_error("Will download the database now and create database")
-        url = "https://millardlab-inphared.s3.climb.ac.uk/ICTV_2023.msh"
-        try:
-            create_folder(os.path.dirname(mash_index_path))
-            wget.download(url, mash_index_path)
-            print(f"\n{url} downloaded successfully!")
-        except Exception as e:
-            print(f"An error occurred while downloading {url}: {e}")
+        downloads[mash_index_path] = sources["mash_index"]
+
+    if not os.path.exists(blastdb_path) and not os.path.exists(f"{blastdb_path}.gz"):
+        print_error(f"File {blastdb_path} does not exist will create database now  ")
+        print_error("Will download the database now and create database")
+        downloads[f"{blastdb_path}.gz"] = sources["genomes"]
+
+    # The missing reference files are downloaded at the same time
+    if downloads and download_references(downloads):
+        sys.exit(1)
+
+    # The checks are skipped when the programs and files did not change since the last run
+    if not args.native_mash:
+        cached_check("programs", ["mash"], [], check_programs)
+
+    unzipped_blastdb_path = (
+        os.path.join(args.output, os.path.basename(blastdb_path[:-3]))
+        if blastdb_path.endswith(".gz")
+        else blastdb_path
+    )
+    # The kmer aligner only reads the genomes, without the BLAST database
+    blast = args.aligner == "blastn"
+    blastdb_path = cached_check(
+        f"database\t{os.path.abspath(unzipped_blastdb_path)}",
+        (["makeblastdb"] if blast else []) + (["mash"] if sketch_path else []),
+        list(
+            dict.fromkeys(
+                [blastdb_path, unzipped_blastdb_path]
+                + ([f"{unzipped_blastdb_path}.nhr"] if blast else [])
+                + ([sketch_path] if sketch_path else [])
+            )
+        ),
+        lambda: check_blastDB(
+            blastdb_path, args.output, sketch_path, threads, sources["genomes"], blast
+        ),
+    )
+    config = Config.from_args(args, VMR_path, blastdb_path, mash_index_path)
+
+    # The lineage table used by the run, built or read from its cache
+    save_lineage_table(
+        os.path.join(args.output, "lineages.tsv"),
+        config.VMR_path,
+        config.genome_ids,
+        config.lineage,
+    )
 
-    check_programs()
-    check_blastDB(blastdb_path)
+    if args.serve:
+        serve(
+            args.serve,
+            config,
+            max(1, args.jobs),
+            args.max_queued,
+            args.job_retention * 3600,
+            int(args.max_request_mb * 2**20),
+        )
+        sys.exit()
+
+    manifest = RunManifest(
+        os.path.join(args.output, RUN_MANIFEST_NAME),
+        RunManifest.params_of(config),
+        args.resume,
+    )
 
     suffixes = ["fasta", "fna", "fsa", "fa"]
-    tmp_fasta = os.path.join(args.output, "tmp.fasta")
-    # Create a multifasta file to parse line by line
-    num_genomes = create_files_and_result_paths(args.in_fasta, tmp_fasta, suffixes)
+    # The genomes are read from the input files as they are classified
+    input_paths = input_fasta_paths(args.in_fasta, suffixes)
+    num_genomes = count_input_genomes(input_paths)
+
+    # When resuming, only the genomes left to classify are searched, copied to a
+    # temporary file unless none is classified yet
+    query_paths = input_paths
+    if args.resume and any(
+        genome["state"] == "done" for genome in manifest.genomes.values()
+    ):
+        query_paths = [os.path.join(args.output, f"queries.{uuid.uuid4().hex}.fasta")]
+        with open(query_paths[0], "w") as f:
+            num_queries = SeqIO.write(
+                iter_input_records(input_paths, skip=manifest.is_done), f, "fasta"
+            )
+        if not num_queries:
+            os.remove(query_paths[0])
+            print_ok("All the genomes are already classified")
+            sys.exit()
+    else:
+        num_queries = num_genomes
+
+    # Search all the queries against the mash index at once
+    print_ok("Searching all the genomes against the mash index...\n")
+    mash_trace = StageTrace(enabled=args.trace)
+    try:
+        with mash_trace.stage(
+            "mash",
+            genomes=num_queries,
+            query_bytes=sum(os.path.getsize(path) for path in query_paths),
+        ) as stage:
+            mash_hits = search_mash_hits(query_paths, config)
+            stage["hits"] = sum(len(hits) for hits in mash_hits.values())
+    except OSError as e:
+        print_error(f"An error occurred while searching the mash index: {e}")
+        sys.exit(1)
+    finally:
+        if query_paths is not input_paths:
+            os.remove(query_paths[0])
+    if args.trace:
+        mash_trace.save(
+            os.path.join(args.output, config.prefix + "mash_trace.json"),
+            threads=int(config.threads),
+            native_mash=config.native_mash,
+        )
 
-    parser = SeqIO.parse(tmp_fasta, "fasta")
+    # The genomes already classified are skipped by the manifest as they are read
+    parser = iter_input_records(input_paths)
 
-    for genome in tqdm(parser, desc="Classifying", total=num_genomes):
-        results_path = os.path.join(args.output, genome.id)
-        print_ok(f"\nClassifying {genome.id} in result folder {results_path}...")
-        Run(genome, results_path)
+    jobs = max(1, min(args.jobs, num_genomes))
 
-    # clean up
-    os.remove(tmp_fasta)
+    if jobs > 1:
+        run_parallel(parser, mash_hits, config, jobs, manifest, num_genomes)
+    else:
+        for genome in tqdm(parser, desc="Classifying", total=num_genomes):
+            if manifest.is_done(genome):
+                continue
+            results_path = os.path.join(args.output, genome.id)
+            print_ok(f"\nClassifying {genome.id} in result folder {results_path}...")
+            genome_mash_df = mash_hits.get(
+                genome.id, pd.DataFrame(columns=MASH_COLUMNS)
+            )
+            manifest.start(genome, results_path)
+            manifest.save()
+            manifest.finish(Run(genome, results_path, config, genome_mash_df))